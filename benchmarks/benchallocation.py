@@ -0,0 +1,68 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark for the allocation strategies.
+
+For a worst case client, with many open bills of awkward amounts, a
+number of payments is allocated with each strategy. The payments are the
+sum of a random selection of the bills, so an exact match exists but is
+seldom found by the greedy strategy. Run it from the project directory
+with
+
+    python -m benchmarks.benchallocation [number of bills] [payments]
+
+"""
+
+import sys
+import random
+from time import perf_counter
+from debtors import app
+from debtmodels.allocation import STRATEGIES
+
+
+def worst_case_client(number_of_bills, number_of_payments, seed=20):
+    """ Return the bill totals, largest first, and the payments """
+
+    generator = random.Random(seed)
+    totals = sorted((generator.randint(1000, 250000)
+                     for _ in range(number_of_bills)), reverse=True)
+    payments = [sum(generator.sample(totals, generator.randint(3, 12)))
+                for _ in range(number_of_payments)]
+    return totals, payments
+
+
+def run_benchmark(number_of_bills=300, number_of_payments=20):
+    """ Allocate the payments with each strategy and report """
+
+    totals, payments = worst_case_client(number_of_bills, number_of_payments)
+    with app.app_context():
+        for name, strategy in sorted(STRATEGIES.items()):
+            exact = 0
+            left = 0
+            start = perf_counter()
+            for payment in payments:
+                used = sum(totals[index]
+                           for index in strategy(totals, payment))
+                exact += used == payment
+                left += payment - used
+            elapsed = perf_counter() - start
+            print(f"{name:10} {elapsed / len(payments) * 1000:8.2f} ms/payment,",
+                  f"{exact} of {len(payments)} exact, {left} left unassigned")
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,165 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark for parsing CAMT053 statements.
+
+A synthetic statement with many entries is generated and parsed by the
+CAMT53Handler. Storing the entries is switched off, so the figure shown
+is the speed of the parser itself, in entries per second. Run it from the
+project directory with
+
+    python -m benchmarks.benchcamt [number of entries]
+
+"""
+
+import sys
+from time import perf_counter
+from xml.sax import make_parser
+from debtors import app
+from debtmodels.payments import IncomingAmountsList
+from debtors.processCAMT import CAMT53Handler
+
+STATEMENT_START = """<?xml version="1.0" encoding="utf-8" ?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+ <BkToCstmrStmt>
+  <GrpHdr>
+   <MsgId>201401030009999_20140104015504378</MsgId>
+   <CreDtTm>2014-01-04T01:55:04.378+01:00</CreDtTm>
+  </GrpHdr>
+  <Stmt>
+   <Id>201401030009999</Id>
+   <CreDtTm>2014-01-04T01:55:04.378+01:00</CreDtTm>
+   <Acct>
+    <Id>
+     <IBAN>NL08INGB0000001234</IBAN>
+    </Id>
+    <Ccy>EUR</Ccy>
+    <Ownr>
+     <Nm>ING Bank NV</Nm>
+    </Ownr>
+   </Acct>
+   <Bal>
+    <Amt Ccy="EUR">1000.00</Amt>
+    <CdtDbtInd>CRDT</CdtDbtInd>
+    <Dt>
+     <Dt>2014-01-02</Dt>
+    </Dt>
+   </Bal>
+"""
+
+STATEMENT_ENTRY = """   <Ntry>
+    <NtryRef>0111113333069998880{number:08d}</NtryRef>
+    <Amt Ccy="EUR">{euros}.{cents:02d}</Amt>
+    <CdtDbtInd>CRDT</CdtDbtInd>
+    <Sts>BOOK</Sts>
+    <BookgDt>
+     <Dt>2014-01-03</Dt>
+    </BookgDt>
+    <ValDt>
+     <Dt>2014-01-03</Dt>
+    </ValDt>
+    <AcctSvcrRef>59999208N9</AcctSvcrRef>
+    <BkTxCd>
+     <Domn>
+      <Cd>PMNT</Cd>
+      <Fmly>
+       <Cd>RCDT</Cd>
+       <SubFmlyCd>ESCT</SubFmlyCd>
+      </Fmly>
+     </Domn>
+     <Prtry>
+      <Cd>00100</Cd>
+      <Issr>ING Group</Issr>
+     </Prtry>
+    </BkTxCd>
+    <NtryDtls>
+     <TxDtls>
+      <RltdPties>
+       <Dbtr>
+        <Nm>ING Testrekening {number}</Nm>
+       </Dbtr>
+       <DbtrAcct>
+        <Id>
+         <IBAN>NL20INGB0001234567</IBAN>
+        </Id>
+       </DbtrAcct>
+      </RltdPties>
+      <RltdAgts>
+       <DbtrAgt>
+        <FinInstnId>
+         <BIC>INGBNL2A</BIC>
+        </FinInstnId>
+       </DbtrAgt>
+      </RltdAgts>
+      <RmtInf>
+       <Strd>
+        <CdtrRefInf>
+         <Ref>{number} 2014</Ref>
+        </CdtrRefInf>
+       </Strd>
+      </RmtInf>
+      <RltdDts>
+       <TxDtTm>2014-01-03T19:07:37</TxDtTm>
+      </RltdDts>
+     </TxDtls>
+    </NtryDtls>
+   </Ntry>
+"""
+
+STATEMENT_END = """  </Stmt>
+ </BkToCstmrStmt>
+</Document>
+"""
+
+
+def synthetic_statement(number_of_entries):
+    """ Return a statement with number_of_entries entries as bytes """
+
+    parts = [STATEMENT_START]
+    for number in range(number_of_entries):
+        parts.append(STATEMENT_ENTRY.format(number=number,
+                                            euros=number % 1000 + 1,
+                                            cents=number % 100))
+    parts.append(STATEMENT_END)
+    return "".join(parts).encode("utf-8")
+
+
+def no_storage():
+    """ Switch off storing of amounts, we measure only parsing """
+
+    IncomingAmountsList.store_all = lambda self: None
+
+
+def run_benchmark(number_of_entries=100000):
+    """ Parse the synthetic statement and report entries per second """
+
+    statement = synthetic_statement(number_of_entries)
+    no_storage()
+    with app.app_context():
+        handler = CAMT53Handler()
+        parser = make_parser()
+        parser.setContentHandler(handler)
+        start = perf_counter()
+        parser.feed(statement)
+        parser.close()
+        elapsed = perf_counter() - start
+    print(f"{len(handler.entries)} entries in {elapsed:.2f} s:",
+          f"{len(handler.entries) / elapsed:.0f} entries/second")
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,82 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark for rendering bills in worker processes.
+
+A number of paper and mail bills is rendered from made up views, first
+in this process and then with an increasing number of workers. The
+database is not used. Run it from the project directory with
+
+    python -m benchmarks.benchrender [number of bills] [max workers]
+
+"""
+
+import os
+import sys
+from time import perf_counter
+from debtors import app
+from debtviews.physicalbill import PaperBill, HTMLMailBill
+from debtviews.rendering import rendering_pool, render_documents
+
+
+def bill_view(bill_id, number_of_lines=8):
+    """ Return a made up view of a bill, as BillDictView makes it """
+
+    lines = [{"id": line, "short_desc": f"Article {line}",
+              "long_desc": "A very fine product, made to last",
+              "number_of": line, "unit_price": "12,50",
+              "total": f"{12.5 * line:.2f}".replace(".", ",")}
+             for line in range(1, number_of_lines + 1)]
+    return {"bill": {"bill_id": bill_id, "date_sale": "18-03-2020",
+                     "date_bill": "19 March 2020", "billing_ccy": "Euro",
+                     "lines": lines, "total": "450,00"},
+            "client": {"initials": "F.", "surname": "Wanders",
+                       "street": "Hoofdstraat", "house_number": "12",
+                       "postcode": "1234 AB", "town_or_village": "Bergen",
+                       "email": "f.wanders@example.com"},
+            "date": "19 March 2020"}
+
+
+def bill_documents(number_of_bills):
+    """ Return the documents for the bills, half of them mail bills """
+
+    return [("bill" + str(bill_id),
+             HTMLMailBill if bill_id % 2 else PaperBill,
+             (bill_id,), bill_view(bill_id))
+            for bill_id in range(number_of_bills)]
+
+
+def run_benchmark(number_of_bills=2000, max_workers=None):
+    """ Render the bills with 1 up to max_workers workers and report """
+
+    documents = bill_documents(number_of_bills)
+    max_workers = max_workers or os.cpu_count()
+    with app.app_context():
+        workers = 1
+        while workers <= max_workers:
+            with rendering_pool(workers) as pool:
+                start = perf_counter()
+                rendered = list(render_documents(documents, pool))
+                elapsed = perf_counter() - start
+            failed = sum(1 for _, _, error in rendered if error)
+            print(f"{workers:3} workers {number_of_bills / elapsed:8.1f} "
+                  f"bills/second, {failed} failed")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
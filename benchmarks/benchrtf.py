@@ -0,0 +1,72 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmark for the rtf encoding.
+
+The values of a letter (names, currencies, dates and descriptions of
+bill lines) are encoded with rtf and with the letter by letter encoding
+it replaced, which is kept here to compare with. Run it from the
+project directory with
+
+    python -m benchmarks.benchrtf [number of letters]
+
+"""
+
+import sys
+from time import perf_counter
+from debtviews.outputenvironments import rtf
+
+
+def rtf_by_letter(to_encode):
+    """ The former rtf, adding the string together letter by letter """
+
+    result = ""
+    if not to_encode:
+        return to_encode
+    for letter in to_encode:
+        i = ord(letter)
+        if i < 128:
+            result = result + letter
+        else:
+            result = result + "\\u" + str(i) + '?'
+    return result
+
+
+LETTER_VALUES = (["Hölscher", "Zoë", "Euro", "Złoty", "18 März 2020",
+                  "2. Oktober 2020", "Česká koruna", "Pietersen"]
+                 + ["Bevestigingsmateriaal voor de aanbouw, één doos à 250 "
+                    "stuks; geleverd in Ålesund"] * 40
+                 + ["Consultancy in the months of March and April"] * 20)
+
+
+def run_benchmark(number_of_letters=2000):
+    """ Encode the values of the letters with both and report """
+
+    for value in LETTER_VALUES:
+        assert rtf(value) == rtf_by_letter(value), value
+    for name, encode in (("by letter", rtf_by_letter), ("rtf", rtf)):
+        start = perf_counter()
+        for _ in range(number_of_letters):
+            for value in LETTER_VALUES:
+                encode(value)
+        elapsed = perf_counter() - start
+        print(f"{name:10} {elapsed / number_of_letters * 1000000:8.1f} "
+              "µs/letter")
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(arg) for arg in sys.argv[1:]])
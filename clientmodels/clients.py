@@ -21,10 +21,13 @@ delivered with debtors.
 All models will be in this file, because the model is to be as simple as
 can be. After all, it is just for showing what debtors needs.
 """
+from collections import OrderedDict
 from datetime import date, datetime
-from sqlalchemy import event, text
+from threading import Lock
+from time import monotonic
+from sqlalchemy import event, text, inspect
 from sqlalchemy.orm import validates, Session
-from debtors import db
+from debtors import db, config
 
 query = db.session.query
 
@@ -93,6 +96,12 @@ class NoAccountFoundError(ValueError):
     pass
 
 
+class MoreThanOnAccountError(ValueError):
+    """ More than one account was found for an IBAN """
+
+    pass
+
+
 class DuplicateMailError(Exception):
     """ A mail address must be unique for a client """
 
@@ -206,10 +215,13 @@ class Clients(db.Model):
         database.
         """
 
-        try:
-            return BankAccounts.get_account_by_iban(iban).owner
-        except NoAccountFoundError as naf:
-            raise NoClientFoundError(str(naf)) from naf
+        client_ids = iban_cache.client_ids(iban)
+        if len(client_ids) == 0:
+            raise NoClientFoundError('No account for {}'.format(iban))
+        if len(client_ids) > 1:
+            raise MoreThanOnAccountError(
+                'More than 1 account for {}'.format(iban))
+        return db.session.get(Clients, client_ids[0])
 
     @staticmethod
     def get_clients_by_name(surname):
@@ -503,6 +515,183 @@ class BankAccounts(db.Model):
             raise NoAccountFoundError('No account for this id')
         return account
 
+
+class IBANClientCache(object):
+    """ An in process index from IBAN to the ids of the clients owning it
+
+    Statement processing looks up the client for each payment by the IBAN
+    it came from. The cache keeps the answer, also when there is no or
+    more than one client, so the lookup is done once for each IBAN.
+
+    On first use the cache is loaded in bulk with the accounts for as many
+    IBANs as it can hold. It holds at most max_size IBANs (IBAN_CACHE_SIZE
+    in the configuration, default 10000); when full, the IBAN used least
+    recently is dropped.
+
+    An IBAN is invalidated as soon as it is given to an account, and the
+    before_flush listener below invalidates it again when an account for
+    it is added, changed or deleted; deleting a client clears the cache.
+    When the transaction is committed or rolled back, the IBANs are
+    invalidated again, as another session may have cached the old owner
+    in between. Changes made by other processes, e.g. the web application
+    adding an account, are not seen by these listeners. So an answer is
+    kept at most max_age seconds (IBAN_CACHE_SECONDS in the
+    configuration, default 300), then it is looked up again.
+
+        :hits: The number of lookups answered from the cache
+        :misses: The number of lookups that needed a query
+
+    """
+
+    def __init__(self, max_size=None, max_age=None):
+
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def size(self):
+        """ The number of IBANs the cache can hold """
+
+        return self.max_size or config.get("IBAN_CACHE_SIZE") or 10000
+
+    def time_to_live(self):
+        """ The number of seconds an answer is kept """
+
+        return self.max_age or config.get("IBAN_CACHE_SECONDS") or 300
+
+    def store(self, iban, client_ids):
+        """ Keep the client ids for iban, dropping the oldest if full """
+
+        self.entries[iban] = (client_ids, monotonic())
+        self.entries.move_to_end(iban)
+        while len(self.entries) > self.size():
+            self.entries.popitem(last=False)
+
+    def query(self, ibans):
+        """ Return a dictionary of the client ids for each of ibans """
+
+        found = {iban: [] for iban in ibans}
+        for iban, client_id in db.session.execute(
+                db.select(BankAccounts.iban, BankAccounts.client_id).
+                where(BankAccounts.iban.in_(ibans))):
+            found[iban].append(client_id)
+        return {iban: tuple(sorted(client_ids))
+                for iban, client_ids in found.items()}
+
+    def fresh(self, iban):
+        """ Is the answer for iban cached and not too old? Hold the lock """
+
+        entry = self.entries.get(iban)
+        return (entry is not None
+                and monotonic() - entry[1] < self.time_to_live())
+
+    def load(self):
+        """ Load the accounts for the first IBANs in bulk """
+
+        first_ibans = (db.select(BankAccounts.iban).distinct().
+                       order_by(BankAccounts.iban).limit(self.size()).
+                       scalar_subquery())
+        found = {}
+        for iban, client_id in db.session.execute(
+                db.select(BankAccounts.iban, BankAccounts.client_id).
+                where(BankAccounts.iban.in_(first_ibans))):
+            found.setdefault(iban, []).append(client_id)
+        with self.lock:
+            for iban, client_ids in found.items():
+                if iban not in self.entries:
+                    self.store(iban, tuple(sorted(client_ids)))
+            self.loaded = True
+
+    def preload(self, ibans):
+        """ Make sure the IBANs are in the cache, with one query """
+
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            missing = [iban for iban in set(ibans) if not self.fresh(iban)]
+        if not missing:
+            return
+        found = self.query(missing)
+        with self.lock:
+            for iban, client_ids in found.items():
+                self.store(iban, client_ids)
+
+    def client_ids(self, iban):
+        """ Return a tuple of the ids of the clients with an account iban """
+
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            if self.fresh(iban):
+                self.hits += 1
+                self.entries.move_to_end(iban)
+                return self.entries[iban][0]
+            self.misses += 1
+        client_ids = self.query([iban])[iban]
+        with self.lock:
+            self.store(iban, client_ids)
+        return client_ids
+
+    def invalidate(self, iban):
+        """ Forget what is known about iban """
+
+        with self.lock:
+            self.entries.pop(iban, None)
+
+    def clear(self):
+        """ Forget everything, the next use loads the cache again """
+
+        with self.lock:
+            self.entries.clear()
+            self.loaded = False
+
+
+iban_cache = IBANClientCache()
+
+
+def changed_ibans(session):
+    """ The IBANs of the accounts changed in this flush
+
+    None in the set means the cache is to be cleared.
+    """
+
+    ibans = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, BankAccounts):
+            ibans.add(instance.iban)
+            ibans.update(inspect(instance).attrs.iban.history.deleted)
+        elif isinstance(instance, Clients) and instance in session.deleted:
+            ibans.add(None)
+    return ibans
+
+
+def invalidate_ibans(ibans):
+    """ Invalidate the IBANs in the cache """
+
+    if None in ibans:
+        iban_cache.clear()
+        return
+    for iban in ibans:
+        iban_cache.invalidate(iban)
+
+
+@event.listens_for(BankAccounts.iban, "set")
+def account_iban_set(account, iban, old_iban, initiator):
+    """ Invalidate an IBAN given to or taken from an account at once
+
+    Until the flush the account is not in the database. The next lookup
+    of the IBAN queries it, which flushes the session as any query does.
+    """
+
+    for value in (iban, old_iban):
+        if isinstance(value, str):
+            iban_cache.invalidate(value)
+
+
 @event.listens_for(Session, "before_flush")
 def before_flush(session, flush_context, instances):
     """ This is the place to do cross item edits.
@@ -514,3 +703,37 @@ def before_flush(session, flush_context, instances):
     for instance in session.dirty | session.new:
         if isinstance(instance, EMail) or isinstance(instance, BankAccounts):
             instance.check_before_flushing(session)
+    ibans = changed_ibans(session)
+    if ibans:
+        invalidate_ibans(ibans)
+        session.info.setdefault("changed_ibans", set()).update(ibans)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def after_soft_rollback(session, previous_transaction):
+    """ The accounts flushed are gone, invalidate them again """
+
+    invalidate_ibans(session.info.get("changed_ibans", ()))
+    if previous_transaction.parent is None:
+        session.info.pop("changed_ibans", None)
+
+
+@event.listens_for(Session, "after_commit")
+def after_commit(session):
+    """ The accounts flushed are committed, invalidate them again
+
+    Between the flush and the commit another session may have read and
+    cached the owners as they were before.
+    """
+
+    invalidate_ibans(session.info.pop("changed_ibans", ()))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def bulk_account_change(orm_execute_state):
+    """ Bulk updates and deletes bypass the flush, clear the cache """
+
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in (BankAccounts, Clients):
+            iban_cache.clear()
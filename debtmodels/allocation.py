@@ -0,0 +1,124 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the strategies to allocate a payment to bills.
+
+A strategy gets the totals of the candidate bills, largest first, and the
+amount of the payment. It returns the indexes of the bills to pay.
+
+    :greedy: Pays the bills from the largest down, as long as the rest of
+        the payment is enough. This is the original rule.
+    :best-fit: Looks for the combination of bills that uses as much of the
+        payment as possible, an exact match if there is one.
+
+The strategy used is set by ASSIGNMENT_STRATEGY in the configuration, the
+default is greedy.
+"""
+
+from math import gcd, isqrt
+from debtors import config, InvalidDataError
+
+
+class UnknownStrategyError(InvalidDataError):
+    """ There is no allocation strategy by this name """
+
+    pass
+
+
+def greedy_allocation(totals, amount):
+    """ Pay the bills that fit, from the largest down """
+
+    chosen = []
+    left = amount
+    for index, total in enumerate(totals):
+        if total <= left:
+            chosen.append(index)
+            left -= total
+            if left == 0:
+                break
+    return chosen
+
+
+def best_fit_allocation(totals, amount, max_bits=None):
+    """ Pay the combination of bills that leaves the smallest remainder
+
+    The sums that can be made from the bills are kept as bits in an
+    integer, bit n is set if n can be paid. Adding a bill is a shift and
+    an or, so the search takes a number of steps equal to the number of
+    bills, each on amount bits. Amounts are divided by their greatest
+    common divisor first.
+
+    To find the bills back, the sums are needed as they were before each
+    bill. Only every so many of these are kept, the ones in between are
+    computed again when needed. So the memory used grows with the square
+    root of the number of bills. If the search would need more than
+    max_bits bits (BEST_FIT_MAX_BITS in the configuration, default 2 ** 28,
+    32 MB), or the greedy allocation is exact already, the greedy
+    allocation is returned.
+    """
+
+    greedy = greedy_allocation(totals, amount)
+    greedy_total = sum(totals[index] for index in greedy)
+    if greedy_total == amount or min(totals, default=0) < 0:
+        return greedy
+    max_bits = max_bits or config.get("BEST_FIT_MAX_BITS") or 2 ** 28
+    divisor = gcd(amount, *totals)
+    target = amount // divisor
+    step = max(1, isqrt(len(totals)))
+    if (len(totals) // step + step + 1) * (target + 1) > max_bits:
+        return greedy
+    sizes = [total // divisor for total in totals]
+    mask = (1 << (target + 1)) - 1
+    reachable = 1
+    kept = {0: reachable}
+    for index, size in enumerate(sizes, start=1):
+        reachable = (reachable | (reachable << size)) & mask
+        if index % step == 0:
+            kept[index] = reachable
+    best = reachable.bit_length() - 1
+    if best * divisor <= greedy_total:
+        return greedy
+    chosen = []
+    end = len(sizes)
+    for start in sorted(kept, reverse=True):
+        if start >= end:
+            continue
+        before = [kept[start]]
+        for size in sizes[start:end - 1]:
+            before.append((before[-1] | (before[-1] << size)) & mask)
+        for index in range(end - 1, start - 1, -1):
+            if not (before[index - start] >> best) & 1:
+                chosen.append(index)
+                best -= sizes[index]
+        end = start
+    chosen.reverse()
+    return chosen
+
+
+STRATEGIES = {"greedy": greedy_allocation,
+              "best-fit": best_fit_allocation}
+
+
+def allocation_strategy(name=None):
+    """ Return the strategy by name, default from the configuration """
+
+    name = name or config.get("ASSIGNMENT_STRATEGY") or "greedy"
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise UnknownStrategyError(
+            'No allocation strategy {}'.format(name)) from None
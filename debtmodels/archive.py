@@ -0,0 +1,158 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module moves settled bills to the archive
+
+Paid and replaced bills are only needed for the history of the client.
+Some time after they were settled (ARCHIVE_AFTER_DAYS in the
+configuration, default 365 days since the last change of the bill, or its
+date if the last change is not known) they are moved to the archive
+tables, with their lines, assignments and overdue actions. The live
+tables then only hold the bills that may still be worked on.
+
+A replaced bill is referred to by the bill replacing it. A bill is only
+archived if the bills referring to it are archived too, in the same
+chunk or before.
+"""
+
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import delete, func, insert, literal, select
+from debtors import db, config
+from debtmodels.debtbilling import (Bills, BillLines, ArchivedBills,
+                                    ArchivedBillLines)
+from debtmodels.payments import AssignedAmounts, ArchivedAssignments
+from debtmodels.overdue import OverdueActions, ArchivedActions
+
+
+class BillArchiver(object):
+    """ Moves settled bills and what belongs to them to the archive
+
+    The bills are archived in chunks, newest first; each chunk is moved
+    with one insert and one delete per table and committed. The rows are
+    moved in the database, they are not read into the session.
+
+        :retention_days: The number of days after the last change a
+            settled bill is archived; by default ARCHIVE_AFTER_DAYS from
+            the configuration, else 365
+        :chunk_size: The number of bills archived in one transaction, by
+            default ARCHIVE_CHUNK_SIZE from the configuration, else 1000
+        :report: The number of bills, lines, assignments and actions
+            archived
+
+    """
+
+    MOVED = ((OverdueActions, ArchivedActions, "actions"),
+             (AssignedAmounts, ArchivedAssignments, "assignments"),
+             (BillLines, ArchivedBillLines, "lines"))
+
+    def __init__(self, retention_days=None, chunk_size=None):
+
+        self.retention_days = (retention_days
+                               or config.get("ARCHIVE_AFTER_DAYS") or 365)
+        self.chunk_size = (chunk_size or config.get("ARCHIVE_CHUNK_SIZE")
+                           or 1000)
+        self.report = {"bills": 0, "lines": 0, "assignments": 0,
+                       "actions": 0}
+
+    def settled_before(self):
+        """ The moment before which a settled bill is archived """
+
+        return datetime.combine(
+            date.today() - timedelta(days=self.retention_days), time())
+
+    def settled_bills(self, before_id=None):
+        """ Return the ids of the next chunk of settled bills
+
+        The chunk holds the newest bills with an id below before_id. Bills
+        stored before updated_at was added have no last change, for them
+        the bill date (or else the date of sale) is used.
+        """
+
+        last_change = func.coalesce(Bills.updated_at, Bills.date_bill,
+                                    Bills.date_sale)
+        bills = (select(Bills.bill_id).
+                 where(Bills.status.in_((Bills.PAID, Bills.REPLACED))).
+                 where(last_change < self.settled_before()))
+        if before_id is not None:
+            bills = bills.where(Bills.bill_id < before_id)
+        bills = bills.order_by(Bills.bill_id.desc()).limit(self.chunk_size)
+        return db.session.scalars(bills).all()
+
+    @staticmethod
+    def archivable(bill_ids):
+        """ Leave out the bills that a bill staying live refers to """
+
+        archivable = set(bill_ids)
+        referrers = db.session.execute(
+            select(Bills.prev_bill, Bills.bill_id).
+            where(Bills.prev_bill.in_(bill_ids))).all()
+        left_out = True
+        while left_out:
+            left_out = {prev_bill for prev_bill, bill_id in referrers
+                        if prev_bill in archivable
+                        and bill_id not in archivable}
+            archivable -= left_out
+        return archivable
+
+    @staticmethod
+    def copy(live, archived, where, **extra):
+        """ Copy the rows selected by where to the archive table
+
+        Extra columns of the archive table are given as keywords.
+        """
+
+        columns = [column.name for column in live.__table__.c]
+        db.session.execute(insert(archived.__table__).from_select(
+            columns + list(extra),
+            select(*live.__table__.c,
+                   *[literal(value) for value in extra.values()]).
+            where(where)))
+
+    def archive_chunk(self, bill_ids):
+        """ Move the bills with their lines, assignments and actions
+
+        The archived bills are inserted before the rows referring to
+        them, the live rows referring to a bill are deleted before it.
+        """
+
+        self.copy(Bills, ArchivedBills, Bills.bill_id.in_(bill_ids),
+                  archived_at=datetime.now())
+        for live, archived, _ in self.MOVED:
+            self.copy(live, archived, live.bill_id.in_(bill_ids))
+        for live, _, counted_as in self.MOVED:
+            self.report[counted_as] += db.session.execute(
+                delete(live.__table__).
+                where(live.bill_id.in_(bill_ids))).rowcount
+        self.report["bills"] += db.session.execute(
+            delete(Bills.__table__).
+            where(Bills.bill_id.in_(bill_ids))).rowcount
+
+    def archive(self):
+        """ Archive the settled bills, a chunk at a time """
+
+        db.session.flush()
+        before_id = None
+        while True:
+            bill_ids = self.settled_bills(before_id)
+            if not bill_ids:
+                break
+            before_id = min(bill_ids)
+            archivable = self.archivable(bill_ids)
+            if archivable:
+                self.archive_chunk(sorted(archivable))
+            db.session.commit()
+        return self.report
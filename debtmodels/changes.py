@@ -0,0 +1,211 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the log of changes for external systems
+
+Each insert, update and delete of a bill, payment, assignment, overdue
+action or debtor signal is logged in the table changelog. When the
+transaction commits, its changes are given a position that goes up in the
+order of the commits. An external system keeps in sync by reading the
+changes after the last position it has seen, its cursor.
+
+The entities logged are the models with a CHANGE_ENTITY, the name under
+which their changes are logged. Changes through the session are logged
+when the session is flushed. Bulk inserts and updates do not go through
+the session, the code doing those logs its changes with ChangeLog.log or
+ChangeLog.log_select.
+"""
+
+from datetime import datetime
+from sqlalchemy import DDL, event, insert, inspect, literal, select, update
+from sqlalchemy.orm import Session
+from debtors import db
+
+# Set in the info of a session that logged changes in its transaction
+CHANGES_LOGGED = "changes_logged"
+POSITION_CHUNK_SIZE = 1000
+
+
+class ChangeLog(db.Model):
+    """ A change to an entity that external systems keep in sync
+
+        :id: The generated sequence number
+        :position: The cursor, given when the transaction commits
+        :entity: The kind of entity changed, its CHANGE_ENTITY
+        :entity_id: The primary key of the entity changed
+        :operation: insert, update or delete
+        :changed_at: When the change was flushed
+
+    """
+
+    INSERT = 'insert'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    __tablename__ = 'changelog'
+    id = db.Column(db.Integer, db.Sequence('change_seq'), primary_key=True)
+    position = db.Column(db.Integer, unique=True)
+    entity = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(6), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.now)
+
+    @staticmethod
+    def log(entity, entity_ids, operation=UPDATE):
+        """ Log a change to entities written without the session """
+
+        rows = [{"entity": entity, "entity_id": entity_id,
+                 "operation": operation} for entity_id in entity_ids]
+        if rows:
+            db.session.execute(insert(ChangeLog.__table__), rows)
+            db.session.info[CHANGES_LOGGED] = True
+
+    @staticmethod
+    def log_select(entity, entity_ids, operation=UPDATE):
+        """ Log a change to the entities whose ids are selected
+
+        The ids are selected and logged in one statement, before a bulk
+        update changes the rows they are selected by.
+        """
+
+        ids = entity_ids.subquery()
+        db.session.execute(insert(ChangeLog.__table__).from_select(
+            ["entity", "entity_id", "operation", "changed_at"],
+            select(literal(entity), list(ids.c)[0], literal(operation),
+                   literal(datetime.now()))))
+        db.session.info[CHANGES_LOGGED] = True
+
+    @staticmethod
+    def changes_since(change_id=None, limit=500):
+        """ Return at most limit changes after the id change_id, by id
+
+        This reads the log as the transaction sees it, with its own
+        changes not yet committed, e.g. to check what is logged. The ids
+        are not in the order of the commits; external systems read with
+        committed_since.
+        """
+
+        changes = db.select(ChangeLog).order_by(ChangeLog.id).limit(limit)
+        if change_id is not None:
+            changes = changes.where(ChangeLog.id > change_id)
+        return db.session.scalars(changes).all()
+
+    @staticmethod
+    def committed_since(cursor=None, limit=500):
+        """ Return at most limit committed changes after cursor, in order
+
+        A change committed later has a higher position, so a reader that
+        has read up to its cursor does not miss a change committed after.
+        """
+
+        changes = (db.select(ChangeLog).
+                   where(ChangeLog.position.is_not(None)).
+                   order_by(ChangeLog.position).limit(limit))
+        if cursor is not None:
+            changes = changes.where(ChangeLog.position > cursor)
+        return db.session.scalars(changes).all()
+
+
+class ChangeCounter(db.Model):
+    """ The last position given to a change, in a table of one row
+
+    The row is updated in each transaction that logged changes, just
+    before the commit. It stays locked until the commit, so transactions
+    committing at the same time get their positions in the order of
+    their commits.
+    """
+
+    __tablename__ = 'changecounter'
+    id = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Integer, nullable=False)
+
+
+event.listen(ChangeCounter.__table__, "after_create",
+             DDL("INSERT INTO changecounter (id, position) VALUES (1, 0)"))
+
+
+def flushed_changes(session):
+    """ Return the changes in a flush as rows for the change log """
+
+    changes = []
+    for instances, operation in ((session.new, ChangeLog.INSERT),
+                                 (session.dirty, ChangeLog.UPDATE),
+                                 (session.deleted, ChangeLog.DELETE)):
+        for instance in instances:
+            entity = getattr(instance, "CHANGE_ENTITY", None)
+            if entity is None:
+                continue
+            if (operation == ChangeLog.UPDATE
+                    and not session.is_modified(instance)):
+                continue
+            entity_id = inspect(instance).mapper.\
+                primary_key_from_instance(instance)[0]
+            changes.append({"entity": entity, "entity_id": entity_id,
+                            "operation": operation})
+    return changes
+
+
+@event.listens_for(Session, "after_flush")
+def log_changes(session, flush_context):
+    """ Log the changes to the entities with a CHANGE_ENTITY
+
+    This is done after the flush, when new entities have their key.
+    """
+
+    changes = flushed_changes(session)
+    if changes:
+        session.execute(insert(ChangeLog.__table__), changes)
+        session.info[CHANGES_LOGGED] = True
+
+
+@event.listens_for(Session, "before_commit")
+def position_changes(session):
+    """ Give the changes of the transaction their position
+
+    The positions are the ids moved up past the counter, so they are
+    unique and, by the lock on the counter, in the order of the commits.
+    Changes of other transactions are not visible here, only those of
+    this transaction lack a position.
+    """
+
+    session.flush()
+    if not session.info.pop(CHANGES_LOGGED, False):
+        return
+    change_ids = session.scalars(
+        select(ChangeLog.id).where(ChangeLog.position.is_(None)).
+        order_by(ChangeLog.id)).all()
+    if not change_ids:
+        return
+    increase = change_ids[-1] - change_ids[0] + 1
+    counted = session.execute(
+        update(ChangeCounter.__table__).where(ChangeCounter.id == 1).
+        values(position=ChangeCounter.position + increase))
+    if counted.rowcount:
+        last = session.scalar(select(ChangeCounter.position).
+                             where(ChangeCounter.id == 1))
+    else:
+        session.execute(insert(ChangeCounter.__table__).
+                        values(id=1, position=increase))
+        last = increase
+    offset = last - change_ids[-1]
+    for start in range(0, len(change_ids), POSITION_CHUNK_SIZE):
+        session.execute(
+            update(ChangeLog.__table__).
+            where(ChangeLog.id.in_(
+                change_ids[start:start + POSITION_CHUNK_SIZE])).
+            values(position=ChangeLog.id + offset))
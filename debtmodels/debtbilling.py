@@ -23,13 +23,17 @@
 
 """
 
-from datetime import date
+from datetime import date, datetime, timedelta
 from dateutil.parser import parse
-from sqlalchemy import event
-from sqlalchemy.orm import validates, Session
+from sqlalchemy import event, func, update, inspect, case
+from sqlalchemy.orm import validates, Session, selectinload
 from iso4217 import raw_table  # This is the currency table
-from clientmodels.clients import Clients, BankAccounts
+from clientmodels.clients import Clients, iban_cache, NoClientFoundError
 from debtors import InvalidDataError, db
+from debtmodels.changes import ChangeLog
+
+# The errors create_from_dicts reports per bill instead of raising
+BULK_ERRORS = (ValueError, KeyError, TypeError)
 
 
 class BillNotFoundError(ValueError):
@@ -136,6 +140,9 @@ class Bills(db.Model):
             the number that this bill is replacing (so found on the new bill)
         :status: What can we do with this bill? E.g. a paid bill cannot
             be resent
+        :total_amount: The total of the lines, kept up to date when the
+            session is flushed
+        :updated_at: When the bill was last changed
 
     """
 
@@ -147,6 +154,7 @@ class Bills(db.Model):
     STATUS_NAME = {'new': 'New', 'issued': 'Billed, unpaid',
                    'paid': 'Fully paid', 'replaced': 'Bill replaced',
                    'dubious': 'Debtor dubious'}
+    CHANGE_ENTITY = 'bill'
 
     __tablename__ = 'bill'
     bill_id = db.Column(db.Integer,  db.Sequence('bill_sequence'),
@@ -158,6 +166,10 @@ class Bills(db.Model):
     prev_bill = db.Column(db.Integer, db.ForeignKey('bill.bill_id'),
                           nullable=True)
     status = db.Column(db.String(8), server_default='new')
+    total_amount = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
+    updated_at = db.Column(db.DateTime, onupdate=datetime.now,
+                           default=datetime.now, index=True)
     lines = db.relationship('BillLines', backref='bill',
                             cascade='all, delete')
     client = db.relationship('Clients', backref='bills')
@@ -227,13 +239,71 @@ class Bills(db.Model):
         self.status = self.DUBIOUS
 
     def total(self):
-        """ Return the total bill amount """
+        """ Return the total bill amount
+
+        If the lines are in memory, they are added up, as they may have
+        been changed since the last flush. Else the stored total is used,
+        so the lines are not loaded for it.
+        """
 
+        if 'lines' not in self.__dict__:
+            return self.total_amount or 0
         total = 0
         for line in self.lines:
             total += line.total()
         return total
 
+    def add_to_total(self, amount):
+        """ Add amount (negative if a line is removed) to the total
+
+        A line of the bill changed, so the bill has changed, even if its
+        total stays the same.
+        """
+
+        if amount:
+            self.total_amount = (self.total_amount or 0) + amount
+        self.updated_at = datetime.now()
+
+    @staticmethod
+    def computed_totals():
+        """ The bill totals computed from the lines, as a subquery """
+
+        return (db.select(func.coalesce(func.sum(
+                    func.coalesce(BillLines.number_of, 1)
+                    * BillLines.unit_price), 0)).
+                where(BillLines.bill_id == Bills.bill_id).
+                scalar_subquery())
+
+    @staticmethod
+    def backfill_totals():
+        """ Compute the total of all bills from the lines
+
+        Returns the number of bills updated.
+        """
+
+        computed = Bills.computed_totals()
+        ChangeLog.log_select(Bills.CHANGE_ENTITY, db.select(Bills.bill_id).
+                             where(Bills.total_amount != computed))
+        result = db.session.execute(
+            update(Bills).
+            where(Bills.total_amount != computed).
+            values(total_amount=computed).
+            execution_options(synchronize_session=False))
+        db.session.expire_all()
+        return result.rowcount
+
+    @staticmethod
+    def wrong_totals():
+        """ Return (bill id, total amount, computed total) of the bills for
+        which the stored total does not match the lines
+        """
+
+        computed = Bills.computed_totals()
+        return [tuple(row) for row in db.session.execute(
+            db.select(Bills.bill_id, Bills.total_amount, computed).
+            where(Bills.total_amount != computed).
+            order_by(Bills.bill_id))]
+
     @staticmethod
     def get_bill_by_id(id_requested):
         """Get a bill by reading it by bill_id  """
@@ -254,8 +324,10 @@ class Bills(db.Model):
         if not prev_bill:
             return prev_bill
         try:
-            old = Bills.get_bill_by_id(prev_bill)
-        except BillNotFoundError:
+            old = db.session.get(Bills, int(prev_bill))
+        except (ValueError, TypeError):
+            old = None
+        if not old:
             raise ReplacedBillError('The bill {0} to replace does not exist'.
                                     format(prev_bill))
         if old.status not in {Bills.NEW, Bills.ISSUED}:
@@ -268,7 +340,11 @@ class Bills(db.Model):
     def get_bills_with_status(client, statuses):
         """ Return a list of bills for a client with passed in status """
 
-        return [bill for bill in client.bills if bill.status in statuses]
+        return db.session.scalars(
+            db.select(Bills).
+            where(Bills.client == client).
+            where(Bills.status.in_(statuses)).
+            order_by(Bills.bill_id)).all()
 
     @staticmethod
     def get_outstanding_bills(client):
@@ -276,13 +352,52 @@ class Bills(db.Model):
 
         return Bills.get_bills_with_status(client, [Bills.NEW, Bills.ISSUED])
 
+    @staticmethod
+    def client_bills_page(client, statuses=None, after=None, limit=100):
+        """ Return a page of the bills of client, in order of bill id
+
+        Only bills with a status in statuses are returned, all bills if
+        it is empty. The page starts after the bill id after and holds
+        at most limit bills, all bills if limit is None. Archived bills
+        are included.
+        """
+
+        for status in statuses or ():
+            if status not in Bills.STATUS_NAME:
+                raise BillStatusInvalidError(
+                    'Status {} is invalid'.format(status))
+        page = []
+        for model in (Bills, ArchivedBills):
+            if (model is ArchivedBills and statuses
+                    and not set(statuses) & {Bills.PAID, Bills.REPLACED}):
+                continue
+            bills = db.select(model).where(model.client_id == client.id)
+            if statuses:
+                bills = bills.where(model.status.in_(statuses))
+            if after is not None:
+                bills = bills.where(model.bill_id > after)
+            bills = bills.order_by(model.bill_id).limit(limit)
+            page.extend(db.session.scalars(bills))
+        return sorted(page, key=lambda bill: bill.bill_id)[:limit]
+
+    @staticmethod
+    def client_bills_changed(client):
+        """ Return the number of bills of client and when they last changed
+
+        A new, changed or deleted bill changes the answer, so it can be
+        used to see if the bills of a client have changed.
+        """
+
+        return tuple(db.session.execute(
+            db.select(func.count(Bills.bill_id), func.max(Bills.updated_at)).
+            where(Bills.client_id == client.id)).one())
+
     @staticmethod
     def bills_for_IBAN(IBAN):
         """ Get a list of bills with the IBAN passed in """
 
-        accounts = (db.session.query(BankAccounts).filter_by(iban=IBAN).
-            all())
-        clients = [account.owner for account in accounts]
+        clients = [db.session.get(Clients, client_id)
+                   for client_id in iban_cache.client_ids(IBAN)]
         return [bill for client in clients for bill in client.bills
                 if bill.status == Bills.ISSUED]
 
@@ -297,18 +412,22 @@ class Bills(db.Model):
             bill_list.extend(Bills.get_outstanding_bills(client))
         return bill_list
 
+    @staticmethod
+    def bill_id_in_reference(reference):
+        """ The bill id in a reference: the first number in it, or None """
+
+        for word in reference.split():
+            if word.isnumeric():
+                return int(word)
+        return None
+
     @staticmethod
     def bills_having_id(reference):
         """ Collect bills having an id which is in the reference """
 
         if not reference:
             raise ValueError('A reference is required')
-        word_list = reference.split()
-        search_for = None
-        for word in word_list:
-            if word.isnumeric():
-                search_for = int(word)
-                break
+        search_for = Bills.bill_id_in_reference(reference)
         if not search_for:
             return []
         bills = Bills.query.filter_by(bill_id=search_for)
@@ -352,11 +471,21 @@ class Bills(db.Model):
         """
 
         client = Clients.get_by_id(int(bill_dict['client']))
+        return cls.create_for_client(bill_dict, client)
+
+    @classmethod
+    def create_for_client(cls, bill_dict, client):
+        """ Create a bill and bill lines from a dictionary for a client
+
+        The client is not read or checked, that is up to the caller.
+        The bill is attached to the client last, so a bill in error is
+        not added to the session.
+        """
+
         try:
             bill = cls(date_sale=parse(bill_dict["date-sale"]))
         except KeyError:
             raise NoSaleDateError("date-sale missing")
-        bill.client = client
         if bill_dict.get('currency'):
             bill.billing_ccy = bill_dict['currency']
         if bill_dict.get('bill-replaced'):
@@ -365,33 +494,112 @@ class Bills(db.Model):
             BillLines.create_line_from_dict(bill, bill_line)
         if bill_dict.get("debtor-preferences", None):
             DebtorPreferences.create_from_dict(bill_dict["debtor-preferences"],
-                                               bill.client)
+                                               client)
+        bill.client = client
         return bill
 
+    @classmethod
+    def create_from_dicts(cls, bill_dicts):
+        """ Create bills from a list of dictionaries, checked together
+
+        The dictionaries are as for create_from_dict. The clients, the
+        clients that have a signal and the bills to replace are read for
+        all dictionaries at once, instead of for each bill. Returned is
+        a list with for each dictionary the bill created or the error
+        that prevented it, e.g. ClientHasSignalError or ReplacedBillError.
+        """
+
+        client_ids = set()
+        replaced_ids = set()
+        for bill_dict in bill_dicts:
+            try:
+                client_ids.add(int(bill_dict["client"]))
+                if bill_dict.get("bill-replaced"):
+                    replaced_ids.add(int(bill_dict["bill-replaced"]))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                pass
+        clients = {client.id: client for client in db.session.scalars(
+            db.select(Clients).where(Clients.id.in_(client_ids)).
+            options(selectinload(Clients.debtor_prefs)))}
+        signalled = set(db.session.scalars(
+            db.select(DebtorSignal.client_id).
+            where(DebtorSignal.client_id.in_(client_ids)).distinct()))
+        # Read into the session, check_prev_bill finds them there
+        replaced = db.session.scalars(
+            db.select(cls).where(cls.bill_id.in_(replaced_ids))).all()
+        bills = []
+        # The replaced bills get their status at flush, so a second bill
+        # replacing the same bill is only found here
+        replaced_in_batch = set()
+        for bill_dict in bill_dicts:
+            try:
+                client = clients.get(int(bill_dict["client"]))
+                if client is None:
+                    raise NoClientFoundError(
+                        'No client with id {}'.format(bill_dict["client"]))
+                if client.id in signalled:
+                    raise ClientHasSignalError("Client has signal")
+                replaced_id = bill_dict.get("bill-replaced")
+                if replaced_id and int(replaced_id) in replaced_in_batch:
+                    raise ReplacedBillError(
+                        'Bill to replace {0} is replaced already'.
+                        format(replaced_id))
+                bills.append(cls.create_for_client(bill_dict, client))
+                if replaced_id:
+                    replaced_in_batch.add(int(replaced_id))
+            except BULK_ERRORS as error:
+                bills.append(error)
+        return bills
+
     @classmethod
     def debt_for_period(cls, start_debt_period, end_debt_period):
-        """ Return the debt for a period 
+        """ Return the debt for a period
 
         The start and end of period are passed in as dates. The start
-        date is not included, the end date is. If start or end date is
+        date is included, the end date is not. If start or end date is
         None, that means unbounded, any start date or end date.
+        The totals by currency are added up in the database.
         """
 
-        bills = db.session.query(cls)
-        bills = bills.filter(cls.status == Bills.ISSUED)
+        bills = (db.select(cls.billing_ccy, func.sum(cls.total_amount)).
+                 where(cls.status == Bills.ISSUED))
         if start_debt_period:
-            bills = bills.filter(cls.date_bill >= start_debt_period)
+            bills = bills.where(cls.date_bill >= start_debt_period)
         if end_debt_period:
-            bills = bills.filter(cls.date_bill < end_debt_period)
-        bills = bills.all()
-        amount_bill_total = dict()
-        for bill in bills:
-            if bill.billing_ccy in amount_bill_total:
-                amount_bill_total[bill.billing_ccy] += bill.total()
-            else:
-                amount_bill_total[bill.billing_ccy] = bill.total()
-        return amount_bill_total
+            bills = bills.where(cls.date_bill < end_debt_period)
+        bills = bills.group_by(cls.billing_ccy)
+        return {ccy: total for ccy, total in db.session.execute(bills)}
+
+    @classmethod
+    def debt_by_age(cls, age_limits, as_of=None):
+        """ Return the issued debt by age and currency in one query
+
+        The age_limits are the ages in days, youngest first, that bound
+        the age buckets. Bucket 0 holds the bills at most age_limits[0]
+        days old (counted from as_of, default today), bucket 1 those
+        older, up to age_limits[1] days, and so on. Bucket
+        len(age_limits) holds the bills older than the last limit.
+        Returned is a dictionary of buckets, each a dictionary of the
+        totals by currency; buckets without debt are left out.
+        """
 
+        as_of = as_of or date.today()
+        bucket = case(*[(cls.date_bill >= as_of - timedelta(days=limit),
+                         index)
+                        for index, limit in enumerate(age_limits)],
+                      else_=len(age_limits))
+        bills = (db.select(bucket.label("bucket"), cls.billing_ccy,
+                           cls.total_amount).
+                 where(cls.status == Bills.ISSUED).
+                 where(cls.date_bill.is_not(None)).
+                 subquery())
+        debt = (db.select(bills.c.bucket, bills.c.billing_ccy,
+                          func.sum(bills.c.total_amount)).
+                group_by(bills.c.bucket, bills.c.billing_ccy))
+        debt_by_age = dict()
+        for age_bucket, ccy, total in db.session.execute(debt):
+            debt_by_age.setdefault(age_bucket, dict())[ccy] = total
+        return debt_by_age
 
 
 class BillLines(db.Model):
@@ -446,8 +654,46 @@ class BillLines(db.Model):
     def total(self):
         """ Calculate a total amount billed on this line """
 
+        if self.number_of is None:
+            return self.unit_price
         return self.number_of * self.unit_price
 
+    def flushed_total(self):
+        """ The total of this line as it is in the database """
+
+        state = inspect(self)
+        values = []
+        for key in ('number_of', 'unit_price'):
+            history = state.attrs[key].history
+            values.append(history.deleted[0] if history.deleted
+                          else (history.unchanged or history.added
+                                or [None])[0])
+        number_of, unit_price = values
+        return (1 if number_of is None else number_of) * (unit_price or 0)
+
+    def flushed_bill(self):
+        """ The bill this line belongs to in the database """
+
+        history = inspect(self).attrs.bill.history
+        if history.deleted:
+            return history.deleted[0]
+        return self.bill
+
+    def update_bill_totals(self, session):
+        """ Change the total of the bill(s) for the change of this line """
+
+        if self in session.new:
+            if self.bill is not None:
+                self.bill.add_to_total(self.total())
+            return
+        old_bill = self.flushed_bill()
+        if old_bill is not None and old_bill not in session.deleted:
+            old_bill.add_to_total(-self.flushed_total())
+        if self in session.deleted:
+            return
+        if self.bill is not None and self.bill not in session.deleted:
+            self.bill.add_to_total(self.total())
+
     @staticmethod
     def get_by_id(line_id):
         """ Get a line by id """
@@ -478,8 +724,85 @@ class BillLines(db.Model):
         bill.lines.append(line)
 
 
+class ArchivedBills(db.Model):
+    """ A settled bill, moved out of the bill table
+
+    Paid and replaced bills are moved to the archive by the BillArchiver
+    (debtmodels.archive) some time after they were settled, with their
+    lines, assignments and overdue actions. The archived bill has the
+    columns of the bill and the moment it was archived.
+
+        :archived_at: When the bill was moved to the archive
+
+    """
+
+    STATUS_NAME = Bills.STATUS_NAME
+    __tablename__ = 'archbill'
+    bill_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    client_id = db.Column(db.Integer, index=True)
+    billing_ccy = db.Column(db.String(3))
+    date_sale = db.Column(db.Date, nullable=False)
+    date_bill = db.Column(db.Date, nullable=True)
+    prev_bill = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(8))
+    total_amount = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.now)
+    lines = db.relationship('ArchivedBillLines', backref='bill',
+                            cascade='all, delete')
+    client = db.relationship('Clients', viewonly=True,
+                             primaryjoin='foreign(ArchivedBills.client_id)'
+                                         ' == Clients.id')
+
+    def total(self):
+        """ Return the total bill amount """
+
+        return self.total_amount
+
+    @staticmethod
+    def get_bill_by_id(id_requested):
+        """ Get an archived bill by bill_id """
+
+        bill = db.session.get(ArchivedBills, id_requested)
+        if not bill:
+            raise BillNotFoundError(
+                'Bill with id {0} was not found'.format(id_requested))
+        return bill
+
+    @staticmethod
+    def bills_for_client(client):
+        """ Return the archived bills of client, in order of bill id """
+
+        return db.session.scalars(
+            db.select(ArchivedBills).
+            where(ArchivedBills.client_id == client.id).
+            order_by(ArchivedBills.bill_id)).all()
+
+
+class ArchivedBillLines(db.Model):
+    """ A line of an archived bill, with the columns of the bill line """
+
+    __tablename__ = 'archbilllines'
+    bill_id = db.Column(db.Integer, db.ForeignKey('archbill.bill_id'),
+                        nullable=False, index=True)
+    line_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    short_desc = db.Column(db.String(10), nullable=False)
+    long_desc = db.Column(db.String(40))
+    number_of = db.Column(db.Integer)
+    measured_in = db.Column(db.String(10), nullable=True)
+    unit_price = db.Column(db.Integer, nullable=False)
+
+    def total(self):
+        """ Calculate a total amount billed on this line """
+
+        if self.number_of is None:
+            return self.unit_price
+        return self.number_of * self.unit_price
+
+
 class DebtorSignal(db.Model):
 
+    CHANGE_ENTITY = 'signal'
     __tablename__ = "debtsignals"
     id = db.Column(db.Integer, db.Sequence("signal_seq"),
                    primary_key=True)
@@ -521,7 +844,13 @@ class DebtorSignal(db.Model):
         the signal.
         """
 
-        client_signals = db.session.query(cls).filter_by(client=bill.client).all()
+        return cls.signals_for_client(bill.client)
+
+    @classmethod
+    def signals_for_client(cls, client):
+        """ Return the signals of client that have not ended before today """
+
+        client_signals = db.session.query(cls).filter_by(client=client).all()
         client_signals = [signal for signal in client_signals
                            if not signal.date_end or signal.date_end >= date.today()]
         return client_signals
@@ -603,10 +932,9 @@ class DebtorPreferences(db.Model):
             prefs.bill_medium = preference_dict["bill-medium"]
             prefs.letter_medium = preference_dict["letter-medium"]
             return
-        prefs = DebtorPreferences(client=client,
-                                bill_medium=preference_dict["bill-medium"],
-                                letter_medium=preference_dict["letter-medium"]
-                                )
+        prefs = DebtorPreferences(bill_medium=preference_dict["bill-medium"],
+                                letter_medium=preference_dict["letter-medium"],
+                                client=client)
 
     def add(self):
         """ Add these preferences to the session """
@@ -627,3 +955,8 @@ def before_flush(session, flush_context, instances):
             instance.set_bill_status_replaced(session)
         if isinstance(instance, DebtorPreferences):
             instance.check_media(session)
+    for instance in session.dirty | session.new | session.deleted:
+        if (isinstance(instance, BillLines)
+                and (instance in session.new or instance in session.deleted
+                     or session.is_modified(instance))):
+            instance.update_bill_totals(session)
@@ -0,0 +1,159 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the mail messages to be delivered to clients
+
+Mail bills and overdue mails are queued here when they are produced. The
+delivery worker in debtors.maildelivery sends them to the SMTP server and
+records per message how that went: sent, to be tried again later or
+failed.
+"""
+
+from datetime import datetime
+from email.parser import HeaderParser
+from email.utils import parseaddr
+from sqlalchemy import func, select, update
+from debtors import db
+
+
+class MailDelivery(db.Model):
+    """ A mail message for a client and the state of its delivery
+
+        :id: The generated sequence number
+        :name: The name of the document, e.g. mailfom12
+        :bill_id: The bill the message is about
+        :sender: The address the message is sent from
+        :recipient: The address the message is sent to
+        :domain: The domain of the recipient, deliveries are limited per
+            domain
+        :message: The complete message, as text
+        :status: queued, sent or failed
+        :attempts: The number of times sending was tried
+        :next_attempt: When the message may be sent (again)
+        :last_error: The answer of the server to the last attempt that
+            failed
+        :created_at: When the message was queued
+        :sent_at: When the server accepted the message
+
+    """
+
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    __tablename__ = 'maildelivery'
+    id = db.Column(db.Integer, db.Sequence('delivery_seq'), primary_key=True)
+    name = db.Column(db.String(40))
+    bill_id = db.Column(db.Integer, index=True)
+    sender = db.Column(db.String(254), nullable=False)
+    recipient = db.Column(db.String(254))
+    domain = db.Column(db.String(254))
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(6), nullable=False, default=QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False,
+                             default=datetime.now)
+    last_error = db.Column(db.String(400))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('deliverydue', 'status', 'next_attempt'),)
+
+    def add(self):
+        """ Add the delivery to the session """
+
+        db.session.add(self)
+        return self
+
+    @staticmethod
+    def queue(name, message, bill_id=None):
+        """ Queue a message (the text of an email) for delivery
+
+        The sender and recipient are taken from the From and To headers,
+        of the recipient only the address is kept. A message without a
+        recipient is stored as failed, so it shows up with the other failed
+        deliveries.
+        """
+
+        headers = HeaderParser().parsestr(message, headersonly=True)
+        recipient = parseaddr(headers["To"] or "")[1]
+        delivery = MailDelivery(name=name, bill_id=bill_id,
+                                sender=headers["From"], recipient=recipient,
+                                message=message)
+        if "@" in recipient:
+            delivery.domain = recipient.rpartition("@")[2].lower()
+        else:
+            delivery.status = MailDelivery.FAILED
+            delivery.last_error = "The message has no recipient"
+        return delivery.add()
+
+    @staticmethod
+    def claim_due(number_of_messages, claimed_until):
+        """ Claim at most number_of_messages deliveries due to be sent
+
+        The deliveries are returned as rows of id, sender, recipient,
+        domain, message and attempts. They are claimed by counting the
+        attempt and moving their next attempt to claimed_until, so after
+        the commit no other worker takes them. The locks are only held
+        until then; rows locked by another worker are skipped, so more
+        workers can claim at the same time. A claim that is not followed
+        by the outcome, e.g. because the worker died, ends at
+        claimed_until and the deliveries are due again.
+        """
+
+        due = (select(MailDelivery.id, MailDelivery.sender,
+                      MailDelivery.recipient, MailDelivery.domain,
+                      MailDelivery.message, MailDelivery.attempts).
+               where(MailDelivery.status == MailDelivery.QUEUED).
+               where(MailDelivery.next_attempt <= datetime.now()).
+               order_by(MailDelivery.next_attempt, MailDelivery.id).
+               limit(number_of_messages).
+               with_for_update(skip_locked=True))
+        deliveries = db.session.execute(due).all()
+        if deliveries:
+            db.session.execute(
+                update(MailDelivery).
+                where(MailDelivery.id.in_([delivery.id
+                                           for delivery in deliveries])).
+                values(attempts=MailDelivery.attempts + 1,
+                       next_attempt=claimed_until))
+        return deliveries
+
+    @staticmethod
+    def record(outcomes):
+        """ Store the outcomes of deliveries, a dictionary per delivery
+
+        Each dictionary has the id and the columns changed.
+        """
+
+        if outcomes:
+            db.session.execute(update(MailDelivery), outcomes)
+
+    @staticmethod
+    def status_counts():
+        """ The number of deliveries by status """
+
+        return dict(db.session.execute(
+            select(MailDelivery.status, func.count(MailDelivery.id)).
+            group_by(MailDelivery.status)).all())
+
+    @staticmethod
+    def backlog():
+        """ The number of messages waiting to be sent """
+
+        return db.session.scalar(
+            select(func.count(MailDelivery.id)).
+            where(MailDelivery.status == MailDelivery.QUEUED))
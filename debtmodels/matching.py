@@ -0,0 +1,240 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the matching of a batch of payments to bills.
+
+IncomingAmounts.assign_amount assigns one payment at a time, reading the
+client and its bills for each payment. For a large number of payments the
+BatchMatcher does the same work with a few queries for the whole batch:
+the clients for the IBANs and the totals of the outstanding bills are
+read up front, the payments are matched in memory and the results are
+written with set based inserts and updates.
+
+The matching rule is the same as that of assign_amount: the candidate
+bills are the outstanding bills of the client, followed by the bill whose
+id is in the clients reference, that are in the currency of the payment
+and not larger than the payment. Which of these are paid is decided by
+the allocation strategy, by default from the largest down, as long as the
+rest of the payment is enough.
+"""
+
+from collections import defaultdict
+from sqlalchemy import insert, update, or_
+from debtors import db
+from clientmodels.clients import Clients, iban_cache
+from debtmodels.debtbilling import Bills
+from debtmodels.payments import (IncomingAmounts, AssignedAmounts,
+                                 ArchivedAssignments)
+from debtmodels.allocation import allocation_strategy
+from debtmodels.changes import ChangeLog
+
+
+class OutstandingBill(object):
+    """ What the matcher needs to know about an outstanding bill """
+
+    __slots__ = ("bill_id", "client_id", "ccy", "total", "paid")
+
+    def __init__(self, bill_id, client_id, ccy, total):
+
+        self.bill_id = bill_id
+        self.client_id = client_id
+        self.ccy = ccy
+        self.total = total
+        self.paid = False
+
+
+class BatchMatcher(object):
+    """ Matches a batch of incoming amounts to outstanding bills
+
+    Only credit amounts that are not a reversal and have nothing assigned
+    yet are matched, the others are left alone. Pending changes in the
+    session are flushed first; objects in the session that are changed by
+    the bulk writes are expired, so they are read again when used.
+
+        :amounts: The incoming amounts to match
+        :strategy: The allocation strategy, see debtmodels.allocation
+        :client_for_iban: The client id for each IBAN of the payments that
+            belongs to exactly one client
+        :bills: The outstanding bills by bill id
+        :client_bills: The outstanding bills by client and currency, in
+            order of bill id
+        :assignments: The assignments made, as (amount id, bill id,
+            currency, amount)
+        :attached: The client id for amounts attached to a client
+        :fully_assigned: The ids of the amounts that are fully assigned
+
+    """
+
+    def __init__(self, amounts, strategy=None):
+
+        self.amounts = amounts
+        self.strategy = allocation_strategy(strategy)
+        self.client_for_iban = {}
+        self.bills = {}
+        self.client_bills = defaultdict(list)
+        self.assignments = []
+        self.attached = {}
+        self.fully_assigned = set()
+
+    def load(self):
+        """ Read clients and outstanding bills for the batch """
+
+        db.session.flush()
+        amount_ids = [amount.id for amount in self.amounts]
+        with_assignments = set()
+        for assignments in (AssignedAmounts, ArchivedAssignments):
+            with_assignments.update(db.session.execute(
+                db.select(assignments.amount_id).distinct().
+                where(assignments.amount_id.in_(amount_ids))).scalars())
+        self.amounts = [amount for amount in self.amounts
+                        if amount.debcred == IncomingAmounts.CREDIT
+                        and not amount.rvslind
+                        and not amount.fully_assigned
+                        and amount.id not in with_assignments]
+        ibans = {amount.creditor_iban for amount in self.amounts
+                 if amount.creditor_iban}
+        iban_cache.preload(ibans)
+        for iban in ibans:
+            owners = iban_cache.client_ids(iban)
+            if len(owners) == 1:
+                self.client_for_iban[iban] = owners[0]
+        client_ids = {self.client_for(amount) for amount in self.amounts}
+        client_ids.discard(None)
+        referred_ids = {Bills.bill_id_in_reference(amount.client_ref)
+                        for amount in self.amounts if amount.client_ref}
+        referred_ids.discard(None)
+        bill_totals = db.session.execute(
+            db.select(Bills.bill_id, Bills.client_id, Bills.billing_ccy,
+                      Bills.total_amount).
+            where(Bills.status.in_([Bills.NEW, Bills.ISSUED])).
+            where(or_(Bills.client_id.in_(client_ids),
+                      Bills.bill_id.in_(referred_ids))).
+            order_by(Bills.bill_id)).all()
+        for bill_id, client_id, ccy, total in bill_totals:
+            bill = OutstandingBill(bill_id, client_id, ccy, total)
+            self.bills[bill_id] = bill
+            self.client_bills[(client_id, ccy)].append(bill)
+
+    def client_for(self, amount):
+        """ The client of the amount: the owner of the IBAN if known """
+
+        return self.client_for_iban.get(amount.creditor_iban,
+                                        amount.client_id)
+
+    def candidates(self, amount):
+        """ The bills that may be paid from amount, largest first """
+
+        client_id = self.client_for(amount)
+        usable_bills = [bill for bill in
+                        self.client_bills.get((client_id, amount.payment_ccy),
+                                              [])
+                        if not bill.paid
+                        and bill.total <= amount.payment_amount]
+        if amount.client_ref:
+            referred = self.bills.get(
+                Bills.bill_id_in_reference(amount.client_ref))
+            if (referred and not referred.paid
+                    and referred.ccy == amount.payment_ccy
+                    and referred.total <= amount.payment_amount
+                    and referred not in usable_bills):
+                usable_bills.append(referred)
+        usable_bills.sort(key=lambda bill: bill.total, reverse=True)
+        return usable_bills
+
+    def match(self):
+        """ Match the amounts to the bills, in memory """
+
+        for amount in self.amounts:
+            client_id = self.client_for_iban.get(amount.creditor_iban)
+            if client_id and client_id != amount.client_id:
+                self.attached[amount.id] = client_id
+            candidates = self.candidates(amount)
+            assigned_until_now = 0
+            for index in self.strategy([bill.total for bill in candidates],
+                                       amount.payment_amount):
+                bill = candidates[index]
+                self.assignments.append((amount.id, bill.bill_id,
+                                         amount.payment_ccy, bill.total))
+                bill.paid = True
+                assigned_until_now += bill.total
+            if candidates and amount.payment_amount == assigned_until_now:
+                self.fully_assigned.add(amount.id)
+
+    def store(self):
+        """ Write the assignments, paid bills and payments in bulk
+
+        The bulk writes bypass the session, so the changes are logged
+        here for the change log.
+        """
+
+        if self.assignments:
+            assignments = AssignedAmounts.__table__
+            rows = [{"amount_id": amount_id, "bill_id": bill_id, "ccy": ccy,
+                     "amount_assigned": total, "amount_to": 0,
+                     "reversed": False}
+                    for amount_id, bill_id, ccy, total in self.assignments]
+            if db.session.get_bind().dialect.insert_executemany_returning:
+                assignment_ids = db.session.execute(
+                    insert(assignments).returning(assignments.c.id),
+                    rows).scalars().all()
+            else:
+                assignment_ids = [db.session.execute(insert(assignments), row).
+                                  inserted_primary_key[0] for row in rows]
+            ChangeLog.log(AssignedAmounts.CHANGE_ENTITY, assignment_ids,
+                          ChangeLog.INSERT)
+            paid_ids = [bill_id for _, bill_id, _, _ in self.assignments]
+            db.session.execute(update(Bills).
+                where(Bills.bill_id.in_(paid_ids)).
+                values(status=Bills.PAID).
+                execution_options(synchronize_session=False))
+            ChangeLog.log(Bills.CHANGE_ENTITY, paid_ids)
+        assigned = defaultdict(int)
+        for amount_id, _, _, total in self.assignments:
+            assigned[amount_id] += total
+        changed = self.attached.keys() | self.fully_assigned | assigned.keys()
+        if changed:
+            db.session.execute(update(IncomingAmounts), [
+                {"id": amount.id,
+                 "client_id": self.attached.get(amount.id, amount.client_id),
+                 "fully_assigned": amount.id in self.fully_assigned,
+                 "assigned_total": amount.assigned() + assigned[amount.id]}
+                for amount in self.amounts if amount.id in changed])
+            ChangeLog.log(IncomingAmounts.CHANGE_ENTITY, sorted(changed))
+        self.expire_changed()
+
+    def expire_changed(self):
+        """ Objects in the session changed by the bulk writes are reloaded """
+
+        paid_ids = {bill_id for _, bill_id, _, _ in self.assignments}
+        amount_ids = {amount_id for amount_id, _, _, _ in self.assignments}
+        amount_ids |= self.attached.keys()
+        client_ids = set(self.attached.values())
+        for instance in list(db.session.identity_map.values()):
+            if ((isinstance(instance, Bills) and instance.bill_id in paid_ids)
+                    or (isinstance(instance, IncomingAmounts)
+                        and instance.id in amount_ids)
+                    or (isinstance(instance, Clients)
+                        and instance.id in client_ids)):
+                db.session.expire(instance)
+
+    def assign(self):
+        """ Load, match and store; return the assignments made """
+
+        self.load()
+        self.match()
+        self.store()
+        return self.assignments
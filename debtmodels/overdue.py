@@ -24,6 +24,7 @@ overdue processing.
 """
 
 from datetime import date, timedelta, datetime
+from sqlalchemy import func
 from debtors import db
 from sqlalchemy.orm import (validates, load_only, aliased, mapped_column)
 from debtors import app
@@ -180,6 +181,7 @@ class OverdueActions(db.Model):
         :step: The action executed
 
     """
+    CHANGE_ENTITY = 'overdue-action'
     __tablename__ = "overdueactions"
 
     id = db.Column(db.Integer, db.Sequence("ovdaction-sequence"),
@@ -241,6 +243,48 @@ class OverdueActions(db.Model):
         q = q.filter(~sq.exists())
         return q.all()
 
+    @classmethod
+    def debt_by_last_step(cls):
+        """ Return the debt by the last step taken and currency
+
+        The last action for a bill is the one with the highest id. One
+        query adds up the bills by the processor of the step of their last
+        action and by currency. The result is a dictionary by processor of
+        dictionaries by currency, for all steps that have debt.
+        """
+
+        last_actions = (db.select(func.max(cls.id).label("id")).
+                        group_by(cls.bill_id).subquery())
+        debt = (db.select(OverdueSteps.processor, Bills.billing_ccy,
+                          func.sum(Bills.total_amount)).
+                select_from(cls).
+                join(last_actions, last_actions.c.id == cls.id).
+                join(OverdueSteps, OverdueSteps.id == cls.step_id).
+                join(Bills, Bills.bill_id == cls.bill_id).
+                group_by(OverdueSteps.processor, Bills.billing_ccy))
+        debt_by_step = dict()
+        for processor, ccy, total in db.session.execute(debt):
+            debt_by_step.setdefault(processor, dict())[ccy] = total
+        return debt_by_step
+
+
+class ArchivedActions(db.Model):
+    """ An overdue action for an archived bill, moved with the bill
+
+    It has the columns of the overdue action.
+    """
+
+    __tablename__ = "archoverdueactions"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bill_id = db.Column(db.Integer, db.ForeignKey("archbill.bill_id"),
+                        nullable=False, index=True)
+    step_id = db.Column(db.Integer, db.ForeignKey("overduesteps.id"),
+                        nullable=False)
+    date_action = db.Column(db.DateTime, nullable=False)
+    bill = db.relationship("ArchivedBills", backref="overdue_actions")
+    step = db.relationship("OverdueSteps", uselist=False, viewonly=True)
+
 
 class OverdueProcessor(object):
     """ Abstract ancestor for overdue processors
@@ -351,8 +395,10 @@ class OverdueProcessor(object):
         """ Try to pay the bill. """
 
         bill_amount = bill.billing_ccy, bill.total()
-        payments = [payment for payment in bill.client.payments
-                    if payment.assigned() < payment.payment_amount]
+        payments = (db.session.query(IncomingAmounts).
+                    filter(IncomingAmounts.client_id == bill.client.id).
+                    filter(IncomingAmounts.open_amount > 0).
+                    order_by(IncomingAmounts.id).all())
         total = 0
         for payment in payments:
             total += payment.payment_amount
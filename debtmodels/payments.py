@@ -28,10 +28,14 @@ of the amount retained for further processing.
 from datetime import datetime, date
 from typing import List
 from debtors import db
+from sqlalchemy import insert, delete, select, update, func, or_, event
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import validates
 from iso4217 import raw_table  # This is the currency table
 from debtors import InvalidDataError
 from debtmodels.debtbilling import Bills
+from debtmodels.changes import ChangeLog
+from debtmodels.allocation import allocation_strategy
 from clientmodels.clients import Clients
 
 
@@ -65,6 +69,18 @@ class CanNotAttachIfMoneyAssignedError(InvalidDataError):
     pass
 
 
+class StatementNotIdentifiedError(InvalidDataError):
+    """ A statement has no account or identification """
+
+    pass
+
+
+class StatementChangedError(InvalidDataError):
+    """ A statement imported before has other entries now """
+
+    pass
+
+
 class CanOnlyAssignBillAmount(ValueError):
     """ A bill can only be assigned the exact bill amount """
 
@@ -138,6 +154,10 @@ class AssignedAmountNotFound(ValueError):
     pass
 
 
+# The number of bank references looked up in one query for stored_before
+REFERENCES_PER_QUERY = 500
+
+
 def validate_currency(currency):
     """ Validate the currency on ISO 2417 """
 
@@ -167,11 +187,15 @@ class IncomingAmounts(db.Model):
         :client_name: The name on the statement or document that documents
             the payment
         :creditor_iban: The IBAN the payment was made from
+        :assigned_total: The amount assigned from this payment by
+            assignments that were not reversed
+        :open_amount: The amount not assigned yet; can be used in queries
         """
 
     CREDIT = "Cr"
     DEBIT = "Db"
     DEBCRED = {CREDIT: "Credit", DEBIT: "Debit"}
+    CHANGE_ENTITY = 'payment'
     __tablename__ = 'payments'
     id = db.Column(db.Integer, db.Sequence('payment_seq'),
                    db.ForeignKey('assignedamts.amount_id'),
@@ -187,11 +211,13 @@ class IncomingAmounts(db.Model):
     value_date = db.Column(db.Date, default=date.today,
                            nullable=True)
     our_ref = db.Column(db.String(35))
-    bank_ref = db.Column(db.String(35))
+    bank_ref = db.Column(db.String(35), index=True)
     client_ref = db.Column(db.String(35))
     client_name = db.Column(db.String(30))
     fully_assigned = db.Column(db.Boolean(), default=False)
     creditor_iban = db.Column(db.String(40), nullable=True, index=True)
+    assigned_total = db.Column(db.Integer, default=0, nullable=False,
+                               server_default='0')
     client = db.relationship("Clients", backref='payments')
     amount_queued = db.relationship('AmountQueued', uselist=False,
                                     backref='incoming_amount',
@@ -237,6 +263,41 @@ class IncomingAmounts(db.Model):
 
         db.session.add(self)
 
+    @staticmethod
+    def stored_before(amounts):
+        """ The fingerprints of the amounts stored before in another statement
+
+        The amounts are entries of one statement, they share its file
+        timestamp. The amounts with the same bank references are looked up
+        in one query per REFERENCES_PER_QUERY references, using the index
+        on the bank reference. Amounts from the same statement do not
+        count, a statement may contain the same reference for e.g. an entry
+        and its reversal.
+        """
+
+        references = sorted({amount.bank_ref for amount in amounts
+                             if amount.bank_ref})
+        if not references:
+            return set()
+        file_timestamp = amounts[0].file_timestamp
+        fingerprints = set()
+        with db.session.no_autoflush:
+            for start in range(0, len(references), REFERENCES_PER_QUERY):
+                same_reference = db.session.execute(
+                    select(IncomingAmounts.bank_ref,
+                           IncomingAmounts.payment_ccy,
+                           IncomingAmounts.payment_amount,
+                           IncomingAmounts.debcred,
+                           IncomingAmounts.rvslind).
+                    where(IncomingAmounts.bank_ref.in_(
+                        references[start:start + REFERENCES_PER_QUERY])).
+                    where(IncomingAmounts.file_timestamp.is_distinct_from(
+                        file_timestamp)))
+                fingerprints.update(
+                    (ref, ccy, amount, debcred, bool(rvslind))
+                    for ref, ccy, amount, debcred, rvslind in same_reference)
+        return fingerprints
+
     @staticmethod
     def get_payment_by_id(payment_id):
         """ Get an Incoming amount for id payment_id """
@@ -280,27 +341,27 @@ class IncomingAmounts(db.Model):
         usable_bills.sort(key=lambda bill: bill.total(), reverse=True)
         return usable_bills
 
-    def assign_amount(self):
+    def assign_amount(self, strategy=None):
         """ Assign this amount to an outstanding bill 
 
         This routine scripts finding assignment candidates, 
         attaching a client to the payment and executing as many
-        assignments as we can from this payment.
+        assignments as we can from this payment. Which bills are paid
+        is decided by the allocation strategy (see debtmodels.allocation).
         """
 
         client = self.find_client_to_attach()
         if client:
             self.client = client
         usable_bills = self.find_assignment_targets()
+        totals = [bill.total() for bill in usable_bills]
         assigned_until_now = 0
-        for bill in usable_bills:
-            to_assign = bill.total()
-            if to_assign <= self.payment_amount - assigned_until_now:
-                self.assign_to_bill(bill, amount=to_assign)
-                assigned_until_now += to_assign
-                if self.payment_amount == assigned_until_now:
-                    self.fully_assigned = True
-                    break
+        for index in allocation_strategy(strategy)(totals,
+                                                   self.payment_amount):
+            self.assign_to_bill(usable_bills[index], amount=totals[index])
+            assigned_until_now += totals[index]
+        if usable_bills and self.payment_amount == assigned_until_now:
+            self.fully_assigned = True
 
     def list_assignments(self):
         """ Return assignments that have not been reversed """
@@ -315,12 +376,25 @@ class IncomingAmounts(db.Model):
         return [assignment.from_amount for assignment in assignments_from]
 
     def assigned(self):
-        """ Total up the amount assigned to this payment """
+        """ The amount assigned from this payment """
+
+        return self.assigned_total or 0
+
+    def add_assigned(self, amount):
+        """ Add amount (negative for a reversal) to the assigned total """
 
-        assigned_total = 0
-        for assigned_amount in self.used_in:
-            assigned_total += assigned_amount.amount_assigned
-        return assigned_total
+        self.assigned_total = self.assigned() + amount
+
+    @hybrid_property
+    def open_amount(self):
+        """ The amount of this payment not assigned yet """
+
+        return (self.payment_amount or 0) - self.assigned()
+
+    @open_amount.expression
+    def open_amount(cls):
+
+        return cls.payment_amount - cls.assigned_total
 
     def change_client(self, new_client):
         """ Change the client the payment is assigned to
@@ -537,7 +611,7 @@ class IncomingAmounts(db.Model):
         """
 
         target_list = IncomingAmounts.find_reversible_payments(self)
-        target_list = [target for target in target_list 
+        target_list = [target for target in target_list
                        if not target.assigned()]
         if len(target_list) == 1:
             return self.assign_reversal_to_payment(target_list[0])
@@ -570,26 +644,277 @@ class IncomingAmounts(db.Model):
             :unassigned_amount: the amount not yet assigned
             """
 
-        payments = []
-        for payment in client.payments:
-            payment_data = (payment.id,
-                            payment.payment_ccy,
-                            payment.payment_amount,
-                            payment.payment_amount - payment.assigned())
-            if payment_data[3]:
-                payments.append(payment_data)
-        return payments
+        return [tuple(payment) for payment in db.session.execute(
+            select(IncomingAmounts.id, IncomingAmounts.payment_ccy,
+                   IncomingAmounts.payment_amount,
+                   IncomingAmounts.open_amount).
+            where(IncomingAmounts.client_id == client.id).
+            where(IncomingAmounts.open_amount != 0).
+            order_by(IncomingAmounts.id))]
+
+    @staticmethod
+    def computed_assigned_totals():
+        """ The assigned totals computed from the assignments, for a query
+
+        Assignments that were reversed do not count, assignments moved
+        to the archive with their bill do.
+        """
+
+        def assigned(assignments):
+            return (select(func.coalesce(func.sum(
+                        assignments.amount_assigned), 0)).
+                    where(assignments.amount_id == IncomingAmounts.id).
+                    where(or_(assignments.reversed.is_(None),
+                              assignments.reversed == False)).
+                    scalar_subquery())
+
+        return (assigned(AssignedAmounts)
+                + assigned(ArchivedAssignments))
+
+    @staticmethod
+    def backfill_assigned_totals():
+        """ Compute the assigned total of all payments from the assignments
+
+        Returns the number of payments updated.
+        """
+
+        computed = IncomingAmounts.computed_assigned_totals()
+        ChangeLog.log_select(IncomingAmounts.CHANGE_ENTITY,
+                             select(IncomingAmounts.id).
+                             where(IncomingAmounts.assigned_total != computed))
+        result = db.session.execute(
+            update(IncomingAmounts).
+            where(IncomingAmounts.assigned_total != computed).
+            values(assigned_total=computed).
+            execution_options(synchronize_session=False))
+        db.session.expire_all()
+        return result.rowcount
+
+    @staticmethod
+    def wrong_assigned_totals():
+        """ Return (id, assigned total, computed total) of the payments for
+        which the assigned total does not match the assignments
+        """
+
+        computed = IncomingAmounts.computed_assigned_totals()
+        return [tuple(row) for row in db.session.execute(
+            select(IncomingAmounts.id, IncomingAmounts.assigned_total,
+                   computed).
+            where(IncomingAmounts.assigned_total != computed).
+            order_by(IncomingAmounts.id))]
+
+
+class StatementEntry(object):
+    """ An entry of a statement, a plain record of an incoming amount
+
+    The statement import fills an entry per statement line. The entries are
+    not added to the session, they are inserted with set based inserts. The
+    attributes are the columns of IncomingAmounts that are on a statement.
+    """
+
+    __slots__ = ("file_timestamp", "payment_ccy", "payment_amount",
+                 "debcred", "rvslind", "value_date", "our_ref", "bank_ref",
+                 "client_ref", "client_name", "creditor_iban")
+
+    def __init__(self, file_timestamp=None):
+
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.file_timestamp = file_timestamp
+
+    def as_row(self):
+        """ Return the column values of this entry for a set based insert
+
+        Columns that were not filled get their column default, as the ORM
+        would do on a flush.
+        """
+
+        row = dict()
+        for column in IncomingAmounts.__table__.columns:
+            if column.primary_key:
+                continue
+            value = getattr(self, column.key, None)
+            if value is None and column.default is not None:
+                if column.default.is_callable:
+                    value = column.default.arg(None)
+                else:
+                    value = column.default.arg
+            row[column.key] = value
+        return row
+
+    def fingerprint(self):
+        """ The data that identify this entry on a statement """
+
+        return (self.bank_ref, self.payment_ccy, self.payment_amount,
+                self.debcred or "Cr", bool(self.rvslind))
+
+
+def skip_stored_before(entries):
+    """ Return the entries that were not stored before and the number skipped
+
+    The entries are of one statement, see IncomingAmounts.stored_before.
+    """
+
+    stored_before = IncomingAmounts.stored_before(entries)
+    new_entries = [entry for entry in entries
+                   if entry.fingerprint() not in stored_before]
+    return new_entries, len(entries) - len(new_entries)
+
+
+def insert_entries(entries):
+    """ Insert the entries as amounts and queue them for assignment
+
+    The amounts and their queue entries are inserted with one set based
+    insert each, in the transaction of the session. If the database
+    cannot return the ids of a set based insert (e.g. MySQL), the ids are
+    selected afterwards: the amounts of these statements with an id above
+    the highest id before the insert.
+    """
+
+    if not entries:
+        return
+    rows = [entry.as_row() for entry in entries]
+    payments = IncomingAmounts.__table__
+    dialect = db.session.get_bind().dialect
+    if dialect.insert_executemany_returning_sort_by_parameter_order:
+        amount_ids = db.session.execute(
+            insert(payments).returning(payments.c.id,
+                                       sort_by_parameter_order=True),
+            rows).scalars().all()
+    else:
+        highest_id = db.session.scalar(select(func.max(payments.c.id))) or 0
+        db.session.execute(insert(payments), rows)
+        file_timestamps = {row["file_timestamp"] for row in rows}
+        amount_ids = db.session.scalars(
+            select(payments.c.id).
+            where(payments.c.id > highest_id).
+            where(payments.c.file_timestamp.in_(file_timestamps)).
+            order_by(payments.c.id)).all()
+    db.session.execute(insert(AmountQueued.__table__),
+                       [{"amount_id": amount_id} for amount_id in amount_ids])
+    ChangeLog.log(IncomingAmounts.CHANGE_ENTITY, amount_ids,
+                  ChangeLog.INSERT)
 
 
 class IncomingAmountsList(list):
-    ''' A list of incoming amounts to be processed  '''
+    """ The entries of a statement, stored when the statement is complete
+
+    The entries are inserted all at once. Entries stored before from
+    another statement are then left out; they are counted in skipped.
+    """
+
+    skipped = 0
+
+    def store(self):
+        """ Insert the entries and queue them for assignment """
+
+        self[:], skipped = skip_stored_before(self)
+        self.skipped += skipped
+        insert_entries(self)
 
     def store_all(self):
         """ Store all entries on the database """
 
+        self.store()
+        db.session.commit()
+
+
+class IncomingAmountsBatch(object):
+    """ The entries of a statement, stored in batches.
+
+    Where the IncomingAmountsList keeps every entry until the statement is
+    complete, this class keeps at most batch_size entries. When the batch
+    is full, the entries are inserted and forgotten. Memory use therefore
+    does not grow with the size of the statement. Entries stored before
+    from another statement are left out of each batch.
+
+    The inserts are done in the transaction of the session, which is only
+    committed in store_all. So a statement is stored completely or not at
+    all, just like with the IncomingAmountsList.
+
+        :batch_size: The number of entries inserted in one go
+        :stored: The number of entries inserted until now
+        :skipped: The number of entries left out as stored before
+
+    """
+
+    def __init__(self, batch_size):
+
+        self.batch_size = batch_size
+        self.pending = []
+        self.stored = 0
+        self.skipped = 0
+
+    def __len__(self):
+
+        return self.stored + len(self.pending)
+
+    def append(self, entry):
+        """ Add an entry to the batch, insert the batch if it is full """
+
+        self.pending.append(entry)
+        if len(self.pending) >= self.batch_size:
+            self.insert_batch()
+
+    def insert_batch(self):
+        """ Insert the pending entries and queue them for assignment """
+
+        pending, skipped = skip_stored_before(self.pending)
+        self.skipped += skipped
+        self.pending = []
+        insert_entries(pending)
+        self.stored += len(pending)
+
+    def store_all(self):
+        """ Insert what is left and commit the statement """
+
+        self.insert_batch()
         db.session.commit()
 
 
+class ImportedStatements(db.Model):
+    """ The statements that have been imported
+
+    For each statement we store a fingerprint. When a file is processed
+    again, statements already imported are recognised and skipped.
+
+        :id: The generated sequence number
+        :account_iban: The account the statement is for
+        :statement_id: The identification of the statement by the bank
+        :creation_timestamp: When the bank created the statement
+        :content_hash: A hash of the entries on the statement
+        :imported_at: When the statement was imported
+
+    """
+
+    __tablename__ = 'importedstmts'
+    id = db.Column(db.Integer, db.Sequence('importedstmt_seq'),
+                   primary_key=True)
+    account_iban = db.Column(db.String(40), nullable=True)
+    statement_id = db.Column(db.String(35), nullable=True)
+    creation_timestamp = db.Column(db.DateTime, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    imported_at = db.Column(db.DateTime, default=datetime.now)
+    __table_args__ = (db.Index('bystatement', 'account_iban',
+                               'statement_id', 'creation_timestamp',
+                               unique=True),)
+
+    def add(self):
+        """ Add the statement to the session """
+
+        db.session.add(self)
+
+    @staticmethod
+    def get_imported(account_iban, statement_id, creation_timestamp):
+        """ The statement imported with this fingerprint, None if none was """
+
+        with db.session.no_autoflush:
+            return (db.session.query(ImportedStatements).
+                filter_by(account_iban=account_iban,
+                          statement_id=statement_id,
+                          creation_timestamp=creation_timestamp).first())
+
+
 class AmountQueued(db.Model):
     """ Amounts incoming waiting to be assigned
 
@@ -622,6 +947,38 @@ class AmountQueued(db.Model):
             filter_by(amount_id=amount_requested).first())
         return aq is not None
 
+    @staticmethod
+    def claim(number_of_amounts):
+        """ Take at most number_of_amounts amounts from the queue
+
+        The queue entries are deleted, the ids of the amounts they were for
+        are returned. Entries another transaction has claimed, but not yet
+        committed, are skipped, so more workers can take from the queue at
+        the same time. If the transaction is rolled back, the entries are
+        in the queue again.
+        """
+
+        # Selected first and deleted by id: MariaDB refuses a LIMIT in the
+        # subquery of a DELETE
+        claimed = db.session.execute(
+            select(AmountQueued.id, AmountQueued.amount_id).
+            order_by(AmountQueued.id).
+            limit(number_of_amounts).
+            with_for_update(skip_locked=True)).all()
+        if claimed:
+            db.session.execute(
+                delete(AmountQueued).
+                where(AmountQueued.id.in_([queue_id
+                                           for queue_id, _ in claimed])).
+                execution_options(synchronize_session=False))
+        return [amount_id for _, amount_id in claimed]
+
+    @staticmethod
+    def backlog():
+        """ The number of amounts waiting in the queue """
+
+        return db.session.query(func.count(AmountQueued.id)).scalar()
+
 
 class AssignedAmounts(db.Model):
     """ These are the amounts that are assigned to a bill or payment
@@ -649,6 +1006,7 @@ class AssignedAmounts(db.Model):
 
     """
 
+    CHANGE_ENTITY = 'assignment'
     __tablename__ = 'assignedamts'
     id = db.Column(db.Integer, db.Sequence('assgn_seq'),
                    primary_key=True)
@@ -688,6 +1046,8 @@ class AssignedAmounts(db.Model):
             self.bill.assignment_reversal()
         if self.to_amount:
             self.to_amount.reverse_assignment_for(self.amount_assigned)
+        if not self.reversed:
+            self.from_amount.add_assigned(-self.amount_assigned)
         self.from_amount.fully_assigned = False
         self.reversed = True
 
@@ -702,3 +1062,48 @@ class AssignedAmounts(db.Model):
             return assignment
 
         raise AssignedAmountNotFound("An assigned amount requested was not found")
+
+
+@event.listens_for(AssignedAmounts.from_amount, "set")
+def assignment_from_amount(assigned_amount, amount, old_amount, initiator):
+    """ Keep the assigned total of the payments assigned from up to date
+
+    All assignments (assign_to_bill, assign_to_amount,
+    assign_reversal_to_payment) attach the assignment to the payment it is
+    assigned from, so this is where the total is raised.
+    reverse_assignment lowers it.
+    """
+
+    if assigned_amount.reversed:
+        return
+    assigned = assigned_amount.amount_assigned or 0
+    if isinstance(old_amount, IncomingAmounts):
+        old_amount.add_assigned(-assigned)
+    if isinstance(amount, IncomingAmounts):
+        amount.add_assigned(assigned)
+
+
+class ArchivedAssignments(db.Model):
+    """ An assignment to an archived bill, moved with the bill
+
+    It has the columns of the assigned amount. The payment assigned from
+    is not archived.
+    """
+
+    __tablename__ = 'archassignedamts'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    amount_id = db.Column(db.Integer, db.ForeignKey('payments.id'),
+                          index=True)
+    ccy = db.Column(db.String(3), nullable=False)
+    amount_assigned = db.Column(db.Integer, default=0)
+    bill_id = db.Column(db.Integer, db.ForeignKey('archbill.bill_id'),
+                        nullable=True, index=True)
+    amount_id_to = db.Column(db.Integer, nullable=True)
+    amount_to = db.Column(db.Integer, default=0)
+    reversed = db.Column(db.Boolean, nullable=True, default=False)
+    bill = db.relationship('ArchivedBills', backref='assignments')
+    from_amount = db.relationship('IncomingAmounts', uselist=False,
+                                  viewonly=True,
+                                  primaryjoin=
+                                  "archassignedamts.c.amount_id==payments.c.id",
+                                  foreign_keys=[amount_id])
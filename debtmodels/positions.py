@@ -0,0 +1,356 @@
+#    Copyright 2022 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the daily snapshots of the debt position.
+
+A snapshot holds for one day the number and total of the open bills by
+status, currency and age bucket. The age of a bill counts from the date
+it was billed, or if it was not billed yet, the date of sale. The bucket
+edges are the ages in days in AGE_BUCKETS in the configuration, by default
+30, 60, 90 and 360 days: bucket 0 holds the bills up to 30 days old,
+bucket 1 those from 31 to 60 days, and so on; the last bucket holds the
+bills older than the last edge.
+
+The snapshot is built incrementally from the previous one. For each
+open bill the status, currency, bucket and total it was counted with are
+kept (BillPositions). Only the bills changed since the previous run, and
+the bills that moved to another bucket because they aged, are counted
+again. If the bucket edges change, the snapshot is built from scratch.
+"""
+
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert, delete, select, func, case, and_, or_, literal
+from debtors import db, config, InvalidDataError
+from debtmodels.debtbilling import Bills
+
+DEFAULT_AGE_BUCKETS = (30, 60, 90, 360)
+OPEN_STATUSES = (Bills.NEW, Bills.ISSUED, Bills.DUBIOUS)
+
+
+class PositionNotFoundError(ValueError):
+    """ There is no snapshot of the position for the date requested """
+
+    pass
+
+
+class SnapshotOutOfOrderError(InvalidDataError):
+    """ A snapshot cannot be built before the last one built """
+
+    pass
+
+
+def age_limits():
+    """ The edges of the age buckets from the configuration """
+
+    return [int(limit) for limit in
+            (config.get("AGE_BUCKETS") or DEFAULT_AGE_BUCKETS)]
+
+
+def age_bucket_of(limits, as_of):
+    """ A SQL expression for the age bucket of a bill on date as_of """
+
+    age_date = func.coalesce(Bills.date_bill, Bills.date_sale)
+    return case(*[(age_date >= as_of - timedelta(days=limit), index)
+                  for index, limit in enumerate(limits)],
+                else_=len(limits))
+
+
+class PositionRuns(db.Model):
+    """ A run that built the snapshot of a day
+
+        :position_date: The date of the snapshot
+        :run_at: The time the run started; bills changed after it are
+            counted again by the next run
+        :age_limits: The edges of the age buckets used, comma separated
+
+    """
+
+    __tablename__ = 'positionruns'
+    position_date = db.Column(db.Date, primary_key=True)
+    run_at = db.Column(db.DateTime, nullable=False)
+    age_limits = db.Column(db.String(100), nullable=False)
+
+    def add(self):
+        """ Add this run to the session """
+
+        db.session.add(self)
+
+    @staticmethod
+    def last_run():
+        """ Return the run of the latest snapshot, None if there is none """
+
+        return (db.session.query(PositionRuns).
+                order_by(PositionRuns.position_date.desc()).first())
+
+
+class DebtPositions(db.Model):
+    """ The debt position of one day for a status, currency and age bucket
+
+        :position_date: The date of the position
+        :status: The status of the bills
+        :billing_ccy: The currency of the bills
+        :age_bucket: The number of the age bucket, 0 is the youngest
+        :number_of_bills: The number of bills
+        :total: The total of the bills
+
+    """
+
+    __tablename__ = 'debtpositions'
+    position_date = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(8), primary_key=True)
+    billing_ccy = db.Column(db.String(3), primary_key=True)
+    age_bucket = db.Column(db.Integer, primary_key=True)
+    number_of_bills = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def check_position_date(position_date):
+        """ Raise an error if there is no snapshot for position_date """
+
+        if not db.session.get(PositionRuns, position_date):
+            raise PositionNotFoundError(
+                'No position for {}'.format(position_date))
+
+    @staticmethod
+    def by_age(position_date, status=Bills.ISSUED):
+        """ Return the debt of a status on a day by age bucket and currency
+
+        The result is shaped as that of Bills.debt_by_age.
+        """
+
+        DebtPositions.check_position_date(position_date)
+        positions = (select(DebtPositions.age_bucket,
+                            DebtPositions.billing_ccy, DebtPositions.total).
+                     where(DebtPositions.position_date == position_date).
+                     where(DebtPositions.status == status))
+        debt_by_age = dict()
+        for age_bucket, ccy, total in db.session.execute(positions):
+            debt_by_age.setdefault(age_bucket, dict())[ccy] = total
+        return debt_by_age
+
+    @staticmethod
+    def by_status(position_date):
+        """ Return the debt on a day by status and currency """
+
+        DebtPositions.check_position_date(position_date)
+        positions = (select(DebtPositions.status, DebtPositions.billing_ccy,
+                            func.sum(DebtPositions.total)).
+                     where(DebtPositions.position_date == position_date).
+                     group_by(DebtPositions.status,
+                              DebtPositions.billing_ccy))
+        debt_by_status = dict()
+        for status, ccy, total in db.session.execute(positions):
+            debt_by_status.setdefault(status, dict())[ccy] = total
+        return debt_by_status
+
+    @staticmethod
+    def trend(start_date, end_date, status=Bills.ISSUED):
+        """ Return the debt of a status by day and currency
+
+        The days from start_date up to and including end_date that have a
+        snapshot are returned, as a list of (date, totals by currency).
+        """
+
+        positions = (select(DebtPositions.position_date,
+                            DebtPositions.billing_ccy,
+                            func.sum(DebtPositions.total)).
+                     where(DebtPositions.position_date >= start_date).
+                     where(DebtPositions.position_date <= end_date).
+                     where(DebtPositions.status == status).
+                     group_by(DebtPositions.position_date,
+                              DebtPositions.billing_ccy).
+                     order_by(DebtPositions.position_date))
+        trend = dict()
+        for position_date, ccy, total in db.session.execute(positions):
+            trend.setdefault(position_date, dict())[ccy] = total
+        return list(trend.items())
+
+
+class BillPositions(db.Model):
+    """ How an open bill was counted in the latest snapshot
+
+    There is no foreign key to the bill, a bill that is deleted must be
+    taken out of the snapshot by the next run.
+    """
+
+    __tablename__ = 'billpositions'
+    bill_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    status = db.Column(db.String(8), nullable=False)
+    billing_ccy = db.Column(db.String(3), nullable=False)
+    age_bucket = db.Column(db.Integer, nullable=False)
+    total_amount = db.Column(db.Integer, nullable=False)
+
+
+class PositionSnapshot(object):
+    """ Builds the snapshot of the debt position for a day
+
+        :as_of: The date of the snapshot, default today
+        :limits: The edges of the age buckets
+        :chunk_size: The number of bills read in one query
+        :changed: The number of bills counted again, after build
+
+    """
+
+    def __init__(self, as_of=None, chunk_size=1000):
+
+        self.as_of = as_of or date.today()
+        self.limits = age_limits()
+        self.chunk_size = chunk_size
+        self.changed = 0
+
+    def open_bills(self):
+        """ Select the open bills with the data to count them """
+
+        return (select(Bills.bill_id, Bills.status, Bills.billing_ccy,
+                       age_bucket_of(self.limits, self.as_of),
+                       Bills.total_amount).
+                where(Bills.status.in_(OPEN_STATUSES)))
+
+    def build(self):
+        """ Build the snapshot, incrementally if possible """
+
+        run_at = datetime.now()
+        last_run = PositionRuns.last_run()
+        edges = ",".join(str(limit) for limit in self.limits)
+        if last_run and last_run.position_date > self.as_of:
+            raise SnapshotOutOfOrderError(
+                'Position of {} exists'.format(last_run.position_date))
+        if last_run and last_run.age_limits == edges:
+            self.build_incremental(last_run)
+        else:
+            self.build_all()
+        if last_run and last_run.position_date == self.as_of:
+            last_run.run_at = run_at
+            last_run.age_limits = edges
+        else:
+            PositionRuns(position_date=self.as_of, run_at=run_at,
+                         age_limits=edges).add()
+        db.session.flush()
+        return self
+
+    def build_all(self):
+        """ Count all open bills """
+
+        db.session.execute(delete(BillPositions))
+        db.session.execute(delete(DebtPositions).
+                           where(DebtPositions.position_date == self.as_of))
+        db.session.execute(insert(BillPositions).from_select(
+            ["bill_id", "status", "billing_ccy", "age_bucket",
+             "total_amount"], self.open_bills()))
+        db.session.execute(insert(DebtPositions).from_select(
+            ["position_date", "status", "billing_ccy", "age_bucket",
+             "number_of_bills", "total"],
+            select(literal(self.as_of, db.Date), BillPositions.status,
+                   BillPositions.billing_ccy, BillPositions.age_bucket,
+                   func.count(), func.sum(BillPositions.total_amount)).
+            group_by(BillPositions.status, BillPositions.billing_ccy,
+                     BillPositions.age_bucket)))
+        self.changed = db.session.execute(
+            select(func.count()).select_from(BillPositions)).scalar()
+
+    def changed_bills(self, last_run):
+        """ The ids of the bills to count again
+
+        These are the bills changed since the last run, the open bills
+        that moved to an older bucket since the last snapshot date and
+        the bills counted that no longer exist.
+        """
+
+        age_date = func.coalesce(Bills.date_bill, Bills.date_sale)
+        last_date = last_run.position_date
+        aged = or_(*[and_(age_date >= last_date - timedelta(days=limit),
+                          age_date < self.as_of - timedelta(days=limit))
+                     for limit in self.limits])
+        changed = set(db.session.execute(
+            select(Bills.bill_id).
+            where(or_(Bills.updated_at >= last_run.run_at,
+                      Bills.updated_at.is_(None),
+                      and_(Bills.status.in_(OPEN_STATUSES), aged)))).
+            scalars())
+        changed.update(db.session.execute(
+            select(BillPositions.bill_id).
+            outerjoin(Bills, Bills.bill_id == BillPositions.bill_id).
+            where(Bills.bill_id.is_(None))).scalars())
+        return sorted(changed)
+
+    def build_incremental(self, last_run):
+        """ Count the changed bills again, starting from the last snapshot """
+
+        if last_run.position_date != self.as_of:
+            db.session.execute(delete(DebtPositions).
+                where(DebtPositions.position_date == self.as_of))
+            db.session.execute(insert(DebtPositions).from_select(
+                ["position_date", "status", "billing_ccy", "age_bucket",
+                 "number_of_bills", "total"],
+                select(literal(self.as_of, db.Date), DebtPositions.status,
+                       DebtPositions.billing_ccy, DebtPositions.age_bucket,
+                       DebtPositions.number_of_bills, DebtPositions.total).
+                where(DebtPositions.position_date
+                      == last_run.position_date)))
+        changed = self.changed_bills(last_run)
+        self.changed = len(changed)
+        deltas = dict()
+        for start in range(0, len(changed), self.chunk_size):
+            self.count_again(changed[start:start + self.chunk_size], deltas)
+        self.apply(deltas)
+
+    def count_again(self, bill_ids, deltas):
+        """ Add the differences in counting the bills to deltas """
+
+        counted = db.session.execute(
+            select(BillPositions.status, BillPositions.billing_ccy,
+                   BillPositions.age_bucket, BillPositions.total_amount).
+            where(BillPositions.bill_id.in_(bill_ids))).all()
+        for status, ccy, age_bucket, total in counted:
+            delta = deltas.setdefault((status, ccy, age_bucket), [0, 0])
+            delta[0] -= 1
+            delta[1] -= total
+        now_open = db.session.execute(
+            self.open_bills().where(Bills.bill_id.in_(bill_ids))).all()
+        for _, status, ccy, age_bucket, total in now_open:
+            delta = deltas.setdefault((status, ccy, age_bucket), [0, 0])
+            delta[0] += 1
+            delta[1] += total
+        db.session.execute(delete(BillPositions).
+                           where(BillPositions.bill_id.in_(bill_ids)))
+        if now_open:
+            db.session.execute(insert(BillPositions), [
+                {"bill_id": bill_id, "status": status, "billing_ccy": ccy,
+                 "age_bucket": age_bucket, "total_amount": total}
+                for bill_id, status, ccy, age_bucket, total in now_open])
+
+    def apply(self, deltas):
+        """ Change the positions of the day by the deltas """
+
+        for (status, ccy, age_bucket), (count, total) in deltas.items():
+            if not count and not total:
+                continue
+            key = (self.as_of, status, ccy, age_bucket)
+            position = db.session.get(DebtPositions, key)
+            if position is None:
+                position = DebtPositions(position_date=self.as_of,
+                                         status=status, billing_ccy=ccy,
+                                         age_bucket=age_bucket,
+                                         number_of_bills=0, total=0)
+                db.session.add(position)
+            position.number_of_bills += count
+            position.total += total
+            if position.number_of_bills == 0:
+                if position in db.session.new:
+                    db.session.expunge(position)
+                else:
+                    db.session.delete(position)
@@ -22,6 +22,7 @@ from flask import Flask
 from sqlalchemy.orm import declarative_base
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
+from debtviews.outputenvironments import configure_environments
 
 
 Base = declarative_base()
@@ -29,6 +30,7 @@ Base = declarative_base()
 app = Flask('debtors')
 app.config.from_pyfile('localdebtors.cfg')
 config = app.config
+configure_environments(app)
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 CSRFProtect(app)
@@ -52,7 +54,11 @@ app.register_blueprint(client_pages)
 from debtors.debtapibp import debtapi
 app.register_blueprint(debtapi)
 import clientmodels.clients
+import debtmodels.changes
 import debtmodels.debtbilling
 import debtmodels.payments
 import debtmodels.overdue
+import debtmodels.positions
+import debtmodels.delivery
 from . import views
+from . import commands
@@ -0,0 +1,172 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The commands for the batch processing of debtors
+
+The commands are started with flask, e.g.
+
+    FLASK_APP=debtors flask assign-amounts --wait 10
+
+"""
+
+import click
+from debtors import app, db
+from debtors.processqueue import AssignmentWorker
+from debtors.maildelivery import MailDeliveryWorker
+from debtmodels.payments import IncomingAmounts
+from debtmodels.debtbilling import Bills
+from debtmodels.positions import PositionSnapshot
+from debtmodels.archive import BillArchiver
+from debtviews.physicalbill import BillProductionRun
+from debtviews.outputenvironments import warm_up_templates
+from debtmodels.allocation import STRATEGIES
+
+
+@app.cli.command("assign-amounts")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of amounts to claim from the queue at a time")
+@click.option("--wait", type=float, default=None,
+              help="Seconds to wait for new amounts if the queue is empty; "
+                   "without it the worker stops when the queue is empty")
+@click.option("--max-batches", type=int, default=None,
+              help="Stop after this number of batches")
+@click.option("--strategy", type=click.Choice(sorted(STRATEGIES)),
+              default=None, help="How to choose the bills to pay")
+def assign_amounts(batch_size, wait, max_batches, strategy):
+    """ Assign the amounts waiting in the queue """
+
+    worker = AssignmentWorker(batch_size, strategy)
+    try:
+        worker.run(wait=wait, max_batches=max_batches,
+                   progress=lambda report: click.echo(str(report)))
+    except KeyboardInterrupt:
+        pass
+    click.echo(str(worker.report))
+
+
+@app.cli.command("assigned-totals")
+@click.option("--verify", is_flag=True,
+              help="Only report the payments with a wrong assigned total")
+def assigned_totals(verify):
+    """ Compute the assigned total of the payments from the assignments """
+
+    if verify:
+        wrong = IncomingAmounts.wrong_assigned_totals()
+        for payment_id, stored, computed in wrong:
+            click.echo(f"Payment {payment_id}: assigned total {stored}, "
+                       f"assignments {computed}")
+        click.echo(f"{len(wrong)} payments with a wrong assigned total")
+        if wrong:
+            raise SystemExit(1)
+        return
+    updated = IncomingAmounts.backfill_assigned_totals()
+    db.session.commit()
+    click.echo(f"{updated} payments updated")
+
+
+@app.cli.command("bill-totals")
+@click.option("--verify", is_flag=True,
+              help="Only report the bills with a wrong total")
+def bill_totals(verify):
+    """ Compute the total of the bills from their lines """
+
+    if verify:
+        wrong = Bills.wrong_totals()
+        for bill_id, stored, computed in wrong:
+            click.echo(f"Bill {bill_id}: total {stored}, lines {computed}")
+        click.echo(f"{len(wrong)} bills with a wrong total")
+        if wrong:
+            raise SystemExit(1)
+        return
+    updated = Bills.backfill_totals()
+    db.session.commit()
+    click.echo(f"{updated} bills updated")
+
+
+@app.cli.command("snapshot-positions")
+@click.option("--date", "as_of", type=click.DateTime(formats=["%Y-%m-%d"]),
+              default=None, help="The date of the snapshot, default today")
+def snapshot_positions(as_of):
+    """ Build the snapshot of the debt position of the day """
+
+    snapshot = PositionSnapshot(as_of.date() if as_of else None).build()
+    db.session.commit()
+    click.echo(f"Position of {snapshot.as_of}: {snapshot.changed} bills "
+               "counted")
+
+
+@app.cli.command("archive-bills")
+@click.option("--days", type=int, default=None,
+              help="Archive bills settled longer than this number of days "
+                   "ago, default ARCHIVE_AFTER_DAYS")
+def archive_bills(days):
+    """ Move the settled bills to the archive """
+
+    report = BillArchiver(days).archive()
+    click.echo(f"{report['bills']} bills archived, with {report['lines']} "
+               f"lines, {report['assignments']} assignments and "
+               f"{report['actions']} overdue actions")
+
+
+@app.cli.command("produce-bills")
+@click.option("--chunk-size", type=int, default=None,
+              help="Number of bills produced in one transaction")
+@click.option("--client", "client_ids", type=int, multiple=True,
+              help="Only produce the bills of this client; may be repeated")
+@click.option("--sold-until", type=click.DateTime(formats=["%Y-%m-%d"]),
+              default=None, help="Only produce the bills sold on or before "
+                                 "this date")
+@click.option("--workers", type=int, default=None,
+              help="Number of processes rendering the bills, default "
+                   "RENDER_WORKERS")
+def produce_bills(chunk_size, client_ids, sold_until, workers):
+    """ Produce the new bills and their accounting """
+
+    run = BillProductionRun(chunk_size, list(client_ids),
+                            sold_until and sold_until.date(),
+                            workers=workers)
+    run.run(progress=lambda report: click.echo(str(report)))
+    click.echo(str(run.report))
+    for bill_id in run.report["failed"]:
+        click.echo(f"Bill {bill_id} could not be produced")
+
+
+@app.cli.command("warm-templates")
+def warm_templates():
+    """ Compile all templates into the bytecode cache """
+
+    click.echo(f"{warm_up_templates(app)} templates compiled")
+
+
+@app.cli.command("deliver-mail")
+@click.option("--batch-size", type=int, default=None,
+              help="Number of messages sent over a connection in one go")
+@click.option("--wait", type=float, default=None,
+              help="Seconds to wait for new messages if none are due; "
+                   "without it the worker stops when none are due")
+@click.option("--max-claims", type=int, default=None,
+              help="Stop after taking messages from the table this often")
+def deliver_mail(batch_size, wait, max_claims):
+    """ Send the queued mail messages to the SMTP server """
+
+    worker = MailDeliveryWorker(batch_size)
+    try:
+        worker.run(wait=wait, max_claims=max_claims,
+                   progress=lambda report: click.echo(str(report)))
+    except KeyboardInterrupt:
+        pass
+    click.echo(str(worker.report))
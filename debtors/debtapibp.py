@@ -28,6 +28,7 @@ messages can be dispatched.
 from flask import Blueprint, jsonify
 #from debtviews.billsapi import ClientBillsView, BillCreateView, BillView
 import debtviews.billsapi as view_bill
+import debtviews.changesapi as view_changes
 from debtmodels.debtbilling import InvalidDataError
 
 debtapi = Blueprint('debtapi', __name__, url_prefix='/api/10')
@@ -38,6 +39,10 @@ debtapi.add_url_rule('/bill/<bill_id>',
                      view_func=view_bill.BillView.as_view('api_bill'))
 debtapi.add_url_rule('/bill/new',
                      view_func=view_bill.BillCreateView.as_view('api_new_bill'))
+debtapi.add_url_rule('/bills/new',
+                     view_func=view_bill.BillsBulkCreateView.as_view('api_new_bills'))
+debtapi.add_url_rule('/changes',
+                     view_func=view_changes.ChangesView.as_view('api_changes'))
 
 @debtapi.errorhandler(InvalidDataError)
 def handle_invalid_data(ide):
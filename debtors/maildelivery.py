@@ -0,0 +1,399 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Module to hold the worker that delivers the queued mail messages
+
+Mail bills and overdue mails are queued in the delivery table (see
+debtmodels.delivery) when they are produced. The worker takes them from
+the table and sends them to the SMTP server over a pool of connections
+that are kept open, a batch of messages per connection. The SMTP server
+is set in the configuration:
+
+    :SMTP_HOST: The host of the server, default "localhost"
+    :SMTP_PORT: The port of the server, default 25
+    :SMTP_USER, SMTP_PASSWORD: If set, used to log in
+    :SMTP_STARTTLS: If set, the connection is encrypted with STARTTLS
+    :SMTP_TIMEOUT: Seconds to wait for the server, default 60
+    :SMTP_CONNECTIONS: The number of connections used, default 4
+    :SMTP_DOMAIN_CONNECTIONS: The number of connections sending to the
+        same domain at the same time, default 2
+    :SMTP_BATCH_SIZE: The number of messages sent over a connection in one
+        go, default 50
+    :SMTP_MAX_ATTEMPTS: The number of times a message is tried before it
+        fails, default 5
+    :SMTP_RETRY_SECONDS: The wait before the first retry, doubled for each
+        next retry, default 60
+    :SMTP_RETRY_MAX_SECONDS: The longest wait before a retry, default 6
+        hours
+    :DELIVERY_CLAIM_SIZE: The number of messages taken from the table in
+        one transaction, default 1000
+    :DELIVERY_CLAIM_SECONDS: How long messages claimed are kept from other
+        workers, default 15 minutes
+
+The messages are claimed and the claim is committed before they are sent,
+so no rows are locked while the server is talked to. The threads sending
+the messages do not use the database; the outcomes are stored by the
+worker, for all messages claimed together, in a transaction of their own.
+If the worker stops before that, the messages are sent again when the
+claim has ended.
+"""
+
+import smtplib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain, zip_longest
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore, Lock
+from time import perf_counter, sleep, monotonic
+from debtors import db, config
+from debtmodels.delivery import MailDelivery
+
+
+class SMTPConnectionPool(object):
+    """ A pool of open connections to the SMTP server
+
+    A connection is taken from the pool with the connection context
+    manager and returned to it at the end, so the next batch does not
+    have to connect and log in again. At most size connections are open;
+    a connection on which something failed is closed and not returned.
+    """
+
+    IDLE_CHECK_SECONDS = 30
+
+    def __init__(self, host=None, port=None, size=None):
+
+        self.host = host or config.get("SMTP_HOST") or "localhost"
+        self.port = port or config.get("SMTP_PORT") or 25
+        self.size = size or config.get("SMTP_CONNECTIONS") or 4
+        self.timeout = config.get("SMTP_TIMEOUT") or 60
+        self.user = config.get("SMTP_USER")
+        self.password = config.get("SMTP_PASSWORD")
+        self.starttls = config.get("SMTP_STARTTLS")
+        self.available = BoundedSemaphore(self.size)
+        self.idle = LifoQueue()
+        self.opened = 0
+
+    def connect(self):
+        """ Open and return a new connection to the server """
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo_or_helo_if_needed()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.user:
+            smtp.login(self.user, self.password)
+        self.opened += 1
+        return smtp
+
+    def idle_connection(self):
+        """ Return an idle connection that is still open, or None """
+
+        while True:
+            try:
+                smtp, idle_since = self.idle.get_nowait()
+            except Empty:
+                return None
+            if monotonic() - idle_since < self.IDLE_CHECK_SECONDS:
+                return smtp
+            try:
+                if smtp.noop()[0] == 250:
+                    return smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.discard(smtp)
+
+    @staticmethod
+    def discard(smtp):
+        """ Close a connection without waiting for the server """
+
+        try:
+            smtp.close()
+        except OSError:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """ A connection to the server, for the duration of the with """
+
+        with self.available:
+            smtp = self.idle_connection() or self.connect()
+            try:
+                yield smtp
+            except Exception:
+                self.discard(smtp)
+                raise
+            self.idle.put((smtp, monotonic()))
+
+    def close(self):
+        """ Close the idle connections """
+
+        while True:
+            try:
+                smtp, _ = self.idle.get_nowait()
+            except Empty:
+                return
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.discard(smtp)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+class DomainLimits(object):
+    """ Limits the number of connections sending to a domain at once
+
+    Mail servers of large providers slow down or refuse senders with too
+    many connections, so the batches for a domain wait for each other.
+    """
+
+    def __init__(self, limit=None):
+
+        self.limit = limit or config.get("SMTP_DOMAIN_CONNECTIONS") or 2
+        self.semaphores = defaultdict(lambda: BoundedSemaphore(self.limit))
+        self.lock = Lock()
+
+    def __getitem__(self, domain):
+
+        with self.lock:
+            return self.semaphores[domain]
+
+
+def send_batch(pool, domain_limits, domain, batch):
+    """ Send a batch of messages for one domain over one connection
+
+    The batch is a list of (id, sender, recipient, message). Returns a
+    list of (id, error, permanent); error is None for a message the
+    server accepted. If the connection fails, the messages not yet sent
+    get the error of the connection and can be tried again.
+    """
+
+    outcomes = []
+    try:
+        with domain_limits[domain], pool.connection() as smtp:
+            for delivery_id, sender, recipient, message in batch:
+                try:
+                    smtp.sendmail(sender, [recipient],
+                                  message.encode("utf-8"))
+                except smtplib.SMTPRecipientsRefused as exc:
+                    code, answer = exc.recipients[recipient]
+                    outcomes.append((delivery_id, smtp_error(code, answer),
+                                     code >= 500))
+                except smtplib.SMTPResponseException as exc:
+                    outcomes.append((delivery_id,
+                                     smtp_error(exc.smtp_code, exc.smtp_error),
+                                     exc.smtp_code >= 500))
+                else:
+                    outcomes.append((delivery_id, None, False))
+    except (smtplib.SMTPException, OSError) as exc:
+        error = f"{type(exc).__name__}: {exc}"[:400]
+        outcomes.extend((delivery_id, error, False)
+                        for delivery_id, *_ in batch[len(outcomes):])
+    return outcomes
+
+
+def smtp_error(code, answer):
+    """ The error as stored, from the code and answer of the server """
+
+    if isinstance(answer, bytes):
+        answer = answer.decode("utf-8", "replace")
+    return f"{code} {answer}"[:400]
+
+
+class MailDeliveryReport(dict):
+    """ The result of a run of the delivery worker
+
+        :claims: The number of times messages were taken from the table
+        :batches: The number of batches sent to the server
+        :sent: The number of messages accepted by the server
+        :retried: The number of messages to be tried again later
+        :failed: The ids of the messages that will not be sent
+        :elapsed: The seconds spent delivering
+        :backlog: The number of messages still waiting to be sent
+
+    """
+
+    def __init__(self):
+
+        super().__init__(claims=0, batches=0, sent=0, retried=0, failed=[],
+                         elapsed=0.0, backlog=0)
+
+    def throughput(self):
+        """ The number of messages sent per second """
+
+        if not self["elapsed"]:
+            return 0.0
+        return self["sent"] / self["elapsed"]
+
+    def __str__(self):
+
+        return (f"{self['sent']} messages sent in {self['batches']} batches, "
+                f"{self['retried']} to retry, "
+                f"{len(self['failed'])} failed, "
+                f"{self.throughput():.1f} messages/second, "
+                f"{self['backlog']} waiting")
+
+
+class MailDeliveryWorker(object):
+    """ Takes the messages due from the delivery table and sends them
+
+    The messages claimed are grouped by the domain of the recipient and
+    split into batches. The batches are sent by a thread per connection
+    of the pool; the batches of different domains are interleaved, so a
+    large domain waiting for its limit does not hold up the others.
+
+    A message that fails with a temporary error (a 4xx answer or a broken
+    connection) is tried again later, after a wait that doubles with each
+    attempt. A message refused permanently (a 5xx answer) or tried
+    max_attempts times fails.
+
+        :batch_size: The number of messages per batch, by default
+            SMTP_BATCH_SIZE from the configuration, else 50
+        :claim_size: The number of messages claimed at once, by default
+            DELIVERY_CLAIM_SIZE from the configuration, else 1000
+        :claim_seconds: How long a claim lasts, by default
+            DELIVERY_CLAIM_SECONDS from the configuration, else 900
+        :report: The MailDeliveryReport for this worker
+
+    """
+
+    def __init__(self, batch_size=None, claim_size=None):
+
+        self.batch_size = (batch_size or config.get("SMTP_BATCH_SIZE")
+                           or 50)
+        self.claim_size = (claim_size or config.get("DELIVERY_CLAIM_SIZE")
+                           or 1000)
+        self.claim_seconds = config.get("DELIVERY_CLAIM_SECONDS") or 900
+        self.max_attempts = config.get("SMTP_MAX_ATTEMPTS") or 5
+        self.retry_seconds = config.get("SMTP_RETRY_SECONDS") or 60
+        self.retry_max_seconds = (config.get("SMTP_RETRY_MAX_SECONDS")
+                                  or 6 * 3600)
+        self.report = MailDeliveryReport()
+
+    def batches(self, deliveries):
+        """ Split the deliveries into batches of one domain, interleaved
+
+        Returns a list of (domain, batch), see send_batch for a batch.
+        """
+
+        by_domain = defaultdict(list)
+        for delivery in deliveries:
+            by_domain[delivery.domain].append(
+                (delivery.id, delivery.sender, delivery.recipient,
+                 delivery.message))
+        per_domain = [[(domain, messages[start:start + self.batch_size])
+                       for start in range(0, len(messages), self.batch_size)]
+                      for domain, messages in by_domain.items()]
+        return [batch for batch in chain.from_iterable(
+            zip_longest(*per_domain)) if batch is not None]
+
+    def retry_at(self, attempts, now):
+        """ When a message tried attempts times is tried again """
+
+        wait = min(self.retry_seconds * 2 ** (attempts - 1),
+                   self.retry_max_seconds)
+        return now + timedelta(seconds=wait)
+
+    def outcome(self, delivery_id, attempts, error, permanent, now):
+        """ The changes to store for a message sent, see MailDelivery.record
+
+        attempts includes the attempt just made.
+        """
+
+        if error is None:
+            self.report["sent"] += 1
+            return {"id": delivery_id, "status": MailDelivery.SENT,
+                    "attempts": attempts, "sent_at": now, "last_error": None}
+        if permanent or attempts >= self.max_attempts:
+            self.report["failed"].append(delivery_id)
+            return {"id": delivery_id, "status": MailDelivery.FAILED,
+                    "attempts": attempts, "last_error": error}
+        self.report["retried"] += 1
+        return {"id": delivery_id, "attempts": attempts, "last_error": error,
+                "next_attempt": self.retry_at(attempts, now)}
+
+    def deliver_claim(self, pool, domain_limits, executor):
+        """ Claim the messages due, send them and store the outcomes
+
+        The claim is committed before the messages are sent. Returns the
+        number of messages claimed, 0 if none are due.
+        """
+
+        start = perf_counter()
+        deliveries = MailDelivery.claim_due(
+            self.claim_size,
+            datetime.now() + timedelta(seconds=self.claim_seconds))
+        db.session.commit()
+        if not deliveries:
+            return 0
+        attempts = {delivery.id: delivery.attempts + 1
+                    for delivery in deliveries}
+        batches = self.batches(deliveries)
+        sent = executor.map(lambda batch: send_batch(pool, domain_limits,
+                                                     *batch), batches)
+        now = datetime.now()
+        MailDelivery.record(
+            [self.outcome(delivery_id, attempts[delivery_id], error,
+                          permanent, now)
+             for delivery_id, error, permanent in chain.from_iterable(sent)])
+        db.session.commit()
+        self.report["claims"] += 1
+        self.report["batches"] += len(batches)
+        self.report["elapsed"] += perf_counter() - start
+        return len(deliveries)
+
+    def run(self, *, wait=None, max_claims=None, progress=None, pool=None):
+        """ Deliver messages until none are due
+
+        If wait (seconds) is given, the worker waits for new messages when
+        none are due instead of stopping; it then runs until max_claims
+        claims are processed or it is interrupted. If passed, progress is
+        called with the report after each claim. A pool may be passed,
+        e.g. to use another server; by default one is opened from the
+        configuration and closed at the end.
+        """
+
+        own_pool = pool is None
+        pool = pool or SMTPConnectionPool()
+        domain_limits = DomainLimits()
+        try:
+            with ThreadPoolExecutor(max_workers=pool.size) as executor:
+                while (max_claims is None
+                       or self.report["claims"] < max_claims):
+                    if not self.deliver_claim(pool, domain_limits, executor):
+                        if wait is None:
+                            break
+                        sleep(wait)
+                        continue
+                    if progress:
+                        self.report["backlog"] = MailDelivery.backlog()
+                        progress(self.report)
+        finally:
+            if own_pool:
+                pool.close()
+        self.report["backlog"] = MailDelivery.backlog()
+        db.session.commit()
+        return self.report
@@ -17,11 +17,70 @@
 
 """ Module to hold the contenthandler to process a camt message """
 
-from xml.sax import ContentHandler, parse
+import os
+import gzip
+import hashlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from xml.sax import ContentHandler, make_parser
 from dateutil.parser import parse as dt_parse
+from debtors import app, db, config
 from debtviews.monetary import internal_amount
-from debtmodels.payments import (IncomingAmounts, IncomingAmountsList,
-    AmountQueued)
+from debtmodels.payments import (StatementEntry, IncomingAmountsList,
+    IncomingAmountsBatch, ImportedStatements, IncomingAmountInvalidCcyError,
+    StatementNotIdentifiedError, StatementChangedError, validate_currency)
+
+
+def camt_datetime(content):
+    """ Convert a date or date time from the message to a datetime
+
+    Dates in a CAMT053 message are in ISO format, so the fast standard
+    library conversion nearly always works. Anything else is left to
+    dateutil.
+    """
+
+    try:
+        return datetime.fromisoformat(content)
+    except ValueError:
+        return dt_parse(timestr=content)
+
+
+class CAMTElement(object):
+    """ An element of the message the handler acts upon.
+
+    The elements form a tree, the children are the elements within this
+    element we act upon. For an element the names of the handler methods
+    are kept, for its start, for its text and for its end. The start method
+    receives the attributes, the text method the complete text of the
+    element. Each may be None if there is nothing to do.
+    """
+
+    __slots__ = ("children", "start", "text", "end")
+
+    def __init__(self):
+
+        self.children = {}
+        self.start = self.text = self.end = None
+
+    @classmethod
+    def tree(cls, actions, children=None):
+        """ Create the tree of elements from a table of actions
+
+        The table has the path to the element as a key and a tuple of
+        start, text and end methods names as value. The path is relative to
+        the root of the tree created. The children are added to the root
+        of the new tree.
+        """
+
+        root = cls()
+        root.children.update(children or {})
+        for path, (start, text, end) in actions.items():
+            element = root
+            for name in path:
+                element = element.children.setdefault(name, cls())
+            element.start, element.text, element.end = start, text, end
+        return root
 
 
 class CAMT53Handler(ContentHandler):
@@ -31,6 +90,26 @@ class CAMT53Handler(ContentHandler):
     of the NVB (Dutch banking association), supported by some ING documents.
     It may be that to take advantage of country specific services, you will 
     need to adjust the code.
+
+    The handler is driven by two tables, ENTRY_ACTIONS and
+    STATEMENT_ACTIONS, that tell which method to call for which element.
+    To process more elements, add their path and methods to these tables.
+    The report of a CAMT052 message is handled as a statement, an entry
+    may also be the root of the message.
+
+    The entries are kept as plain records (StatementEntry), not as model
+    instances, and inserted with set based inserts at the end of the
+    statement. Large statements can be stored in batches, by passing a
+    batch_size or setting CAMT_BATCH_SIZE in the configuration. The
+    entries are then inserted batch_size at a time instead of all at the
+    end of the statement.
+
+    A statement that has been imported before is skipped, as is an entry
+    that was stored before from another statement. So processing a file
+    again is harmless. If the entries of a statement imported before have
+    changed, StatementChangedError is raised. A statement without an
+    account or identification is refused, it could not be recognised when
+    imported again.
     """
     
     PROCESS_FAMILIES = (("RCDT", "DMCT"), ("RCDT", "ESCT"),
@@ -40,192 +119,460 @@ class CAMT53Handler(ContentHandler):
                         ("IDDT", "PMDD"), ("IDDT", "PRDD"),
                         ("IDDT", "UPDD"))
 
-    def start_within_entry(self, name, attrs):
-        """ Process startelement for elements that are within an entry
+    ENTRY_ACTIONS = {
+        ("NtryRef",): (None, "entry_reference", None),
+        ("Amt",): ("entry_currency", "entry_amount", None),
+        ("CdtDbtInd",): (None, "entry_debit_credit", None),
+        ("RvslInd",): (None, "entry_reversal", None),
+        ("BookgDt", "Dt"): (None, "entry_value_date", None),
+        ("ValDt", "Dt"): (None, "entry_value_date", None),
+        ("ValDt", "DtTm"): (None, "entry_value_date", None),
+        ("BkTxCd", "Domn", "Fmly", "Cd"): (None, "entry_family", None),
+        ("BkTxCd", "Domn", "Fmly", "SubFmlyCd"):
+            (None, "entry_sub_family", None),
+        ("NtryDtls", "TxDtls", "RmtInf", "Strd", "CdtrRefInf", "Ref"):
+            (None, "entry_client_ref", None),
+        ("NtryDtls", "TxDtls", "RltdPties", "Dbtr", "Nm"):
+            (None, "entry_client_name", None),
+        ("NtryDtls", "TxDtls", "RltdPties", "Cdtr", "Nm"):
+            (None, "entry_client_name", None),
+        ("NtryDtls", "TxDtls", "RltdPties", "DbtrAcct", "Id", "IBAN"):
+            (None, "entry_creditor_iban", None),
+        ("NtryDtls", "TxDtls", "RltdPties", "CdtrAcct", "Id", "IBAN"):
+            (None, "entry_creditor_iban", None),
+        }
 
-        An entry is to be read as one statement line, with an amount, 
-        a description and a value date.
-        """
+    STATEMENT_ACTIONS = {
+        ("Id",): (None, "statement_id", None),
+        ("CreDtTm",): (None, "statement_timestamp", None),
+        ("Acct", "Id", "IBAN"): (None, "statement_account", None),
+        }
 
-        if name == 'Amt':
-            self.unassigned_amount.payment_ccy = attrs['Ccy']
-            self.in_amount = True
-        elif name == 'ValDt':
-            self.in_valuedate = True
-        elif name == 'CdtDbtInd':
-            self.in_credit_debit = True
-        elif name == "RvslInd":
-            self.in_reversal_ind = True
-        elif (name == 'Dt' or name == 'DtTm'
-            and hasattr(self, ".in_valuedate")):
-            self.in_date = True
-        elif name == 'NtryRef':
-            self.in_entry_ref = True
-        elif name == 'Ref':
-            self.in_ref = True
-        elif name == 'RltdPties':
-            self.in_creditor = True
-        elif name == 'Nm' and hasattr(self, "in_creditor"):
-            self.in_client_name = True
-        elif name == 'IBAN' and hasattr(self, "in_creditor"):
-            self.in_creditor_iban = True
-        elif name == "Fmly":
-            self.in_family = True
-        elif name == "Cd" and hasattr(self, "in_family"):
-            self.in_family_code = True
-        elif name == "SubFmlyCd" and hasattr(self, "in_family"):
-            self.in_sub_family_code = True
-        else:
-            super().startElement(name, attrs)
+    def __init__(self, batch_size=None, accounts=None):
 
-    def end_within_entry(self, name):
-        """ Process end element for elements that are within an entry 
+        super().__init__()
+        self.batch_size = batch_size or config.get("CAMT_BATCH_SIZE")
+        if accounts is not None:
+            self.accounts = accounts
+        self.elements = []
+        self.text = None
+        self.creation_timestamp = None
+        self.statement_hash = hashlib.sha256()
+        self.entries = IncomingAmountsList()
+        self.ignore_statement = False
+        self.ignore_entry = False
+        self.imported = None
+        self.statements_stored = 0
+        self.entries_stored = 0
+        self.statements_skipped = 0
+        self.entries_skipped = 0
 
-        An entry is to be read as one statement line, with an amount, 
-        a description and a value date.
+    def __init_subclass__(cls, **kwargs):
+
+        super().__init_subclass__(**kwargs)
+        cls.build_tree()
+
+    @classmethod
+    def build_tree(cls):
+        """ Create the elements tree from the actions tables
+
+        The tree has the statement and the entry at the top, the entry
+        also is one of the statement elements.
         """
 
-        if name == 'Amt':
-            del(self.in_amount)
-        elif name == 'CdtDbtInd':
-            del(self.in_credit_debit)
-        elif name == "RvslInd":
-            del(self.in_reversal_ind)
-        elif name == 'ValDt':
-            del(self.in_valuedate)
-        elif name == 'Dt' and hasattr(self, "in_date"):
-            del(self.in_date)
-        elif name == 'NtryRef':
-            del(self.in_entry_ref)
-        elif name == 'Ref':
-            del(self.in_ref)
-        elif name == 'RltdPties':
-            del(self.in_creditor)
-        elif name == 'Nm' and hasattr(self, "in_creditor"):
-            del(self.in_client_name)
-        elif name == 'IBAN' and hasattr(self, "in_creditor"):
-            del(self.in_creditor_iban)
-        elif name == "Cd" and hasattr(self, "in_family_code"):
-            del(self.in_family_code)
-        elif name == "Fmly" and hasattr(self, "in_family"):
-            del(self.in_family)
-            del(self.family)
-            del(self.process)
-        elif name == "SubFmlyCd" and hasattr(self, "in_sub_family_code"):
-            del(self.in_sub_family_code)
-        else:
-            super().endElement(name)
+        entry = CAMTElement.tree(cls.ENTRY_ACTIONS)
+        entry.start, entry.end = "start_entry", "end_entry"
+        statement = CAMTElement.tree(cls.STATEMENT_ACTIONS, {"Ntry": entry})
+        statement.start, statement.end = "start_statement", "end_statement"
+        cls.ROOTS = {"Stmt": statement, "Rpt": statement, "Ntry": entry}
 
     def startElement(self, name, attrs):
         """ The parser calls this routine for each new element.
 
-        If the element is known to the CAMT53Handler, it handles the
-        element. The element is recognised by its name.
+        The element is looked up among the children of the element it is
+        in. Outside of a known element only the roots are recognised.
+        Elements we do not act upon are kept on the stack as None.
         """
 
-        if hasattr(self, "ignore_statement"):
-            return
-        elif name == "Ntry":
-            self.in_entry = True
-            self.unassigned_amount = IncomingAmounts()
-            self.unassigned_amount.file_timestamp = self.creation_timestamp
-        elif name == 'Stmt':
-            self.in_statement = True
-            self.entries = IncomingAmountsList()
-        elif name == 'CreDtTm' and hasattr(self, 'in_statement'):
-            self.in_create_timestamp = True
-        elif name == 'Acct':
-            self.in_account = True
-        elif name == 'IBAN' and hasattr(self, 'in_account'):
-            self.in_our_IBAN = True
-        elif hasattr(self, "in_entry"):
-            self.start_within_entry(name, attrs)
+        if self.ignore_statement:
+            element = None
+        elif self.elements and self.elements[-1]:
+            element = self.elements[-1].children.get(name)
         else:
-            super().startElement(name, attrs)
+            element = self.ROOTS.get(name)
+        self.elements.append(element)
+        if element is None:
+            return
+        if element.start:
+            getattr(self, element.start)(attrs)
+        if element.text:
+            self.text = []
 
     def endElement(self, name):
         """ The parser calls this routine each time an element is done parsing
 
-        If there is closing logic for the element, it is done.
+        The text collected is passed to the text method and the closing
+        logic for the element is done.
         """
 
-        if name== 'Ntry' and hasattr(self, "in_entry"):
-            if hasattr(self, "ignore_entry"):
-                del(self.ignore_entry)
-            else:
-                self.unassigned_amount.add()
-                self.entries.append(self.unassigned_amount)
-                # queue this for assignment
-                amount_queued = (AmountQueued(incoming_amount =
-                    self.unassigned_amount))
-                amount_queued.add()
-            del(self.in_entry) 
-        elif name == 'Stmt':
-            if hasattr(self, "ignore_statement"):
-                del(self.ignore_statement)
-            else:
-                self.entries.store_all()
-            del(self.in_statement)
-        elif name == 'CreDtTm' and hasattr(self, 'in_statement'):
-            del(self.in_create_timestamp)
-        elif name == 'Acct' and hasattr(self, 'in_account'):
-            del(self.in_account)
-        elif name == 'IBAN' and hasattr(self, 'in_our_IBAN'):
-            del(self.in_our_IBAN)
-        elif hasattr(self, "in_entry"):
-            self.end_within_entry(name)
-        else:
-            super().endElement(name)
+        element = self.elements.pop()
+        if element is None:
+            return
+        if element.text:
+            getattr(self, element.text)("".join(self.text).strip())
+            self.text = None
+        if element.end:
+            getattr(self, element.end)()
 
     def characters(self, content):
         """ Called for each CDATA text in an element
 
         The characters are the value in the xml entry (not to be confused
-        with the statement entry ;=)
+        with the statement entry ;=). The parser may deliver the text of
+        an element in parts, so it is collected until the element ends.
         """
 
-        if hasattr(self, "ignore_statement"):
-            return
-        elif (hasattr(self, "in_our_IBAN")
-            and hasattr(self, "accounts")):
-                if content not in self.accounts:
-                    self.ignore_statement = True
-        elif hasattr(self, 'in_credit_debit') and self.in_credit_debit:
-            if content == 'DBIT':
-                self.unassigned_amount.debcred = 'Db'
-            else:
-                self.unassigned_amount.debcred = 'Cr'
-        elif hasattr(self, "in_reversal_ind") and self.in_reversal_ind:
-            if content.lower() == "true":
-                self.unassigned_amount.rvslind = True
-            else:
-                self.unassigned_amount.rvslind = False
-        elif (hasattr(self, 'in_amount')
-            and self.in_amount):
-            self.unassigned_amount.payment_amount = internal_amount(content)
-        elif (hasattr(self, 'in_date')
-            and self.in_date):
-            self.unassigned_amount.value_date = dt_parse(timestr=content)
-        elif (hasattr(self, 'in_entry_ref')
-            and self.in_entry_ref):
-            self.unassigned_amount.bank_ref = content
-        elif (hasattr(self, 'in_ref')
-            and self.in_ref):
-            self.unassigned_amount.client_ref = content
-        elif (hasattr(self, 'in_client_name')
-            and self.in_client_name):
-            self.unassigned_amount.client_name = content
-        elif (hasattr(self, 'in_creditor_iban')
-            and self.in_creditor_iban):
-            self.unassigned_amount.creditor_iban = content
-        elif (hasattr(self, 'in_create_timestamp')
-            and hasattr(self, 'in_statement')):
-            self.creation_timestamp = dt_parse(timestr=content)
-        elif hasattr(self, "in_family_code"):
-            self.family = content
-        elif hasattr(self, "in_sub_family_code"):
-            self.process = (self.family, content)
-            if self.process not in self.PROCESS_FAMILIES:
-                self.ignore_entry = True
+        if self.text is not None:
+            self.text.append(content)
+
+    def start_statement(self, attrs):
+        """ Start a new statement, with its own list of entries """
+
+        self.ignore_statement = False
+        self.stmt_id = self.account_iban = self.imported = None
+        self.statement_hash = hashlib.sha256()
+        if self.batch_size:
+            self.entries = IncomingAmountsBatch(self.batch_size)
+        else:
+            self.entries = IncomingAmountsList()
+
+    def statement_id(self, content):
+        """ The identification of the statement by the bank """
+
+        self.stmt_id = content
+
+    def statement_timestamp(self, content):
+        """ Keep the creation timestamp for the entries """
+
+        self.creation_timestamp = camt_datetime(content)
+
+    def statement_account(self, content):
+        """ Ignore the statement if it is not for one of our accounts
+
+        If it has been imported before, its entries are not stored. They
+        are only read to compare them with those imported.
+        """
+
+        self.account_iban = content
+        if hasattr(self, "accounts") and content not in self.accounts:
+            self.ignore_statement = True
+        else:
+            self.imported = ImportedStatements.get_imported(
+                content, self.stmt_id, self.creation_timestamp)
+
+    def end_statement(self):
+        """ Store the entries of the statement and its fingerprint
+
+        A statement imported before is skipped, if its entries are the
+        same as those imported.
+        """
+
+        content_hash = self.statement_hash.hexdigest()
+        if self.ignore_statement:
+            self.ignore_statement = False
+        elif self.account_iban is None or self.stmt_id is None:
+            raise StatementNotIdentifiedError(
+                'Statement {} for account {} cannot be identified'
+                .format(self.stmt_id, self.account_iban))
+        elif self.imported:
+            if self.imported.content_hash not in (None, content_hash):
+                raise StatementChangedError(
+                    'Statement {} for account {} changed since its import'
+                    .format(self.stmt_id, self.account_iban))
+            self.statements_skipped += 1
         else:
-            super().characters(content)
+            imported = ImportedStatements(
+                account_iban=self.account_iban, statement_id=self.stmt_id,
+                creation_timestamp=self.creation_timestamp,
+                content_hash=content_hash)
+            imported.add()
+            self.entries.store_all()
+            self.statements_stored += 1
+            self.entries_stored += len(self.entries)
+            self.entries_skipped += self.entries.skipped
+
+    def start_entry(self, attrs):
+        """ Start a new entry.
+
+        An entry is to be read as one statement line, with an amount, 
+        a description and a value date.
+        """
+
+        self.ignore_entry = False
+        self.family = None
+        self.unassigned_amount = StatementEntry(self.creation_timestamp)
+
+    def entry_reference(self, content):
+        """ The reference of the bank for the entry """
+
+        self.unassigned_amount.bank_ref = content
+
+    def entry_currency(self, attrs):
+        """ The currency is an attribute of the amount """
+
+        currency = validate_currency(attrs["Ccy"])
+        if not currency:
+            raise IncomingAmountInvalidCcyError(
+                'The currency {} is invalid'.format(attrs["Ccy"]))
+        self.unassigned_amount.payment_ccy = currency
+
+    def entry_amount(self, content):
+        """ The amount, converted to the internal amount """
+
+        self.unassigned_amount.payment_amount = internal_amount(content)
+
+    def entry_debit_credit(self, content):
+        """ Debit or credit, as is our custom """
+
+        if content == "DBIT":
+            self.unassigned_amount.debcred = "Db"
+        else:
+            self.unassigned_amount.debcred = "Cr"
+
+    def entry_reversal(self, content):
+        """ Is this entry the reversal of an earlier one? """
+
+        self.unassigned_amount.rvslind = content.lower() == "true"
+
+    def entry_value_date(self, content):
+        """ The value date; the booking date if there is none """
+
+        self.unassigned_amount.value_date = camt_datetime(content)
+
+    def entry_family(self, content):
+        """ Keep the family until we know the sub family """
+
+        self.family = content
+
+    def entry_sub_family(self, content):
+        """ Ignore the entry if it is not a process we handle """
+
+        if (self.family, content) not in self.PROCESS_FAMILIES:
+            self.ignore_entry = True
+
+    def entry_client_ref(self, content):
+        """ The reference the client added to the payment """
+
+        self.unassigned_amount.client_ref = content
+
+    def entry_client_name(self, content):
+        """ The name of the other party """
+
+        self.unassigned_amount.client_name = content
+
+    def entry_creditor_iban(self, content):
+        """ The account of the other party """
+
+        self.unassigned_amount.creditor_iban = content
+
+    def end_entry(self):
+        """ Store the entry, unless it is to be ignored """
+
+        self.statement_hash.update(
+            repr(self.unassigned_amount.fingerprint()).encode())
+        if self.ignore_entry:
+            self.ignore_entry = False
+        elif not self.imported:
+            self.store_entry(self.unassigned_amount)
+
+    def store_entry(self, incoming_amount):
+        """ Add the amount to the entries of the statement
+
+        The entries are stored when the statement is complete (or a batch
+        is full). Then the entries that were stored before from another
+        statement are left out. An entry that is the root of the message
+        has no statement, it is stored at once.
+        """
+
+        if self.elements:
+            self.entries.append(incoming_amount)
+        else:
+            entry = IncomingAmountsList([incoming_amount])
+            entry.store()
+            self.entries_stored += len(entry)
+            self.entries_skipped += entry.skipped
+
+
+CAMT53Handler.build_tree()
+
+
+class StatementFilesReport(dict):
+    """ The result of processing a number of statement files.
+
+    For each file processed there is an entry with the file name as key and
+    a dictionary with the number of statements and entries stored and
+    skipped (because they were imported before), and the error, if the
+    processing of the file failed. The totals are kept in the attributes.
+
+        :files: The number of files processed
+        :statements: The number of statements stored
+        :entries: The number of entries stored
+        :skipped: The number of statements and entries skipped
+        :failed: The names of the files that failed
+
+    """
+
+    def __init__(self):
+
+        super().__init__()
+        self.files = 0
+        self.statements = 0
+        self.entries = 0
+        self.skipped = 0
+        self.failed = []
+
+    def add(self, file_result):
+        """ Add the result of one file to the report """
+
+        self[file_result["file"]] = file_result
+        self.files += 1
+        self.statements += file_result["statements"]
+        self.entries += file_result["entries"]
+        self.skipped += (file_result["statements_skipped"]
+                         + file_result["entries_skipped"])
+        if file_result["error"]:
+            self.failed.append(file_result["file"])
+
+
+def statement_files(files):
+    """ The statement files to process, in order of their names
+
+    Files is either the name of a directory, of which all files are
+    taken, or a list of file names.
+    """
+
+    if isinstance(files, (str, os.PathLike)):
+        return sorted(entry.path for entry in os.scandir(files)
+                      if entry.is_file())
+    return [os.fspath(file) for file in files]
+
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def open_document(name, document):
+    """ Return the document, decompressed if it is gzipped """
+
+    if name.endswith(".gz") or document.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=document, mode="rb")
+    return document
+
+
+def statement_documents(file_name):
+    """ The statement documents in a file
+
+    Yields the name and a binary file object for each document. A zip
+    archive yields its members, a gzip file its decompressed content, any
+    other file itself. The documents are read as a stream, they are never
+    decompressed to disk or read into memory as a whole.
+    """
+
+    if zipfile.is_zipfile(file_name):
+        with zipfile.ZipFile(file_name) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                with archive.open(member) as document:
+                    yield (f"{file_name}:{member.filename}",
+                           open_document(member.filename, document))
+    else:
+        with open(file_name, "rb", buffering=READ_BUFFER_SIZE) as document:
+            yield file_name, open_document(file_name, document)
+
+
+def parse_document(document, handler):
+    """ Feed the document to the parser in large chunks """
+
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    for chunk in iter(lambda: document.read(READ_BUFFER_SIZE), b""):
+        parser.feed(chunk)
+    parser.close()
+
+
+def import_statement_file(file_name, handler):
+    """ Process all statement documents in the file with the handler """
+
+    for _name, document in statement_documents(file_name):
+        parse_document(document, handler)
+
+
+def start_statement_worker():
+    """ Prepare a worker process for processing statements
+
+    The worker inherits the connections of the process that started it.
+    These must not be used by the worker, so the pool is replaced by one of
+    its own.
+    """
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def process_statement_file(file_name, accounts=None, batch_size=None,
+                           handler_class=CAMT53Handler):
+    """ Process one statement file, return the result for the report
+
+    Each statement is committed when it is complete. A failure stops the
+    processing of the file, the statement in progress is rolled back.
+    """
+
+    file_result = {"file": file_name, "statements": 0, "entries": 0,
+                   "statements_skipped": 0, "entries_skipped": 0,
+                   "error": None}
+    with app.app_context():
+        handler = handler_class(batch_size=batch_size, accounts=accounts)
+        try:
+            import_statement_file(file_name, handler)
+        except Exception as exc:
+            db.session.rollback()
+            file_result["error"] = f"{type(exc).__name__}: {exc}"
+        file_result["statements"] = handler.statements_stored
+        file_result["entries"] = handler.entries_stored
+        file_result["statements_skipped"] = handler.statements_skipped
+        file_result["entries_skipped"] = handler.entries_skipped
+    return file_result
+
+
+def process_statement_files(files, accounts=None, workers=None,
+                            batch_size=None, handler_class=CAMT53Handler,
+                            progress=None):
+    """ Process a number of statement files in parallel
+
+    The files (a directory or a list of file names, plain, gzipped or zip
+    archives) are divided over a pool of worker processes, each with its
+    own database session. A file that fails does not influence the
+    others. The number of workers is taken from CAMT_WORKERS in the
+    configuration, else the number of processors. If passed, progress is
+    called with the result of each file as it is done. Returns a
+    StatementFilesReport.
+    """
+
+    report = StatementFilesReport()
+    file_names = statement_files(files)
+    if not file_names:
+        return report
+    workers = workers or config.get("CAMT_WORKERS") or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_names)),
+                             initializer=start_statement_worker) as pool:
+        processing = [pool.submit(process_statement_file, file_name,
+                                  accounts, batch_size, handler_class)
+                      for file_name in file_names]
+        for done in as_completed(processing):
+            file_result = done.result()
+            report.add(file_result)
+            if progress:
+                progress(file_result)
+    return report
@@ -0,0 +1,173 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Module to hold the worker that assigns the queued amounts
+
+Incoming amounts are queued for assignment when the statement is
+processed. The worker takes them from the queue in batches and tries to
+assign each to the bills of the client.
+"""
+
+from time import perf_counter, sleep
+from debtors import db, config
+from debtmodels.payments import IncomingAmounts, AmountQueued
+from debtmodels.matching import BatchMatcher
+
+
+class AssignmentReport(dict):
+    """ The result of a run of the assignment worker
+
+    The counts are kept as keys, so the report can be shown or returned
+    as JSON as it is.
+
+        :batches: The number of batches processed
+        :processed: The number of amounts taken from the queue
+        :assigned: The number of amounts (partly) assigned
+        :skipped: Amounts not assigned automatically, e.g. debits
+        :failed: The ids of the amounts for which assignment failed
+        :elapsed: The seconds spent processing
+        :backlog: The number of amounts still in the queue
+
+    """
+
+    def __init__(self):
+
+        super().__init__(batches=0, processed=0, assigned=0, skipped=0,
+                         failed=[], elapsed=0.0, backlog=0)
+
+    def throughput(self):
+        """ The number of amounts processed per second """
+
+        if not self["elapsed"]:
+            return 0.0
+        return self["processed"] / self["elapsed"]
+
+    def __str__(self):
+
+        return (f"{self['processed']} amounts in {self['batches']} batches, "
+                f"{self['assigned']} assigned, {self['skipped']} skipped, "
+                f"{len(self['failed'])} failed, "
+                f"{self.throughput():.1f} amounts/second, "
+                f"{self['backlog']} in queue")
+
+
+class AssignmentWorker(object):
+    """ Takes amounts from the queue and assigns them
+
+    Each batch is claimed from the queue and processed in one transaction.
+    The queue entries of the batch are removed in that transaction, so
+    several workers can run at the same time without processing an amount
+    twice. If the transaction fails, the whole batch is back in the queue.
+
+    Only credit amounts are assigned automatically. The amounts of a batch
+    are matched to the bills together by the BatchMatcher. If that fails,
+    the amounts are assigned one at a time, each in a savepoint; an amount
+    that fails then is reported as failed and remains to be assigned by
+    hand.
+
+        :batch_size: The number of amounts claimed in one go, by default
+            ASSIGN_BATCH_SIZE from the configuration, else 100
+        :strategy: The name of the allocation strategy, by default
+            ASSIGNMENT_STRATEGY from the configuration
+        :report: The AssignmentReport for this worker
+
+    """
+
+    def __init__(self, batch_size=None, strategy=None):
+
+        self.batch_size = (batch_size or config.get("ASSIGN_BATCH_SIZE")
+                           or 100)
+        self.strategy = strategy
+        self.report = AssignmentReport()
+
+    def assign(self, incoming_amount):
+        """ Assign one amount; return if anything was assigned """
+
+        if (incoming_amount.debcred != IncomingAmounts.CREDIT
+                or incoming_amount.rvslind
+                or incoming_amount.fully_assigned
+                or incoming_amount.assigned()):
+            self.report["skipped"] += 1
+            return False
+        try:
+            with db.session.begin_nested():
+                incoming_amount.assign_amount(self.strategy)
+        except Exception:
+            self.report["failed"].append(incoming_amount.id)
+            return False
+        if incoming_amount.used_in:
+            self.report["assigned"] += 1
+            return True
+        return False
+
+    def assign_batch(self, amounts):
+        """ Assign the amounts of a batch together """
+
+        matcher = BatchMatcher(amounts, self.strategy)
+        try:
+            with db.session.begin_nested():
+                matcher.assign()
+        except Exception:
+            for incoming_amount in amounts:
+                self.assign(incoming_amount)
+            return
+        self.report["skipped"] += len(amounts) - len(matcher.amounts)
+        self.report["assigned"] += len({amount_id for amount_id, *_
+                                        in matcher.assignments})
+
+    def process_batch(self):
+        """ Claim a batch from the queue and assign it
+
+        Returns the number of amounts claimed, 0 if the queue is empty.
+        """
+
+        start = perf_counter()
+        amount_ids = AmountQueued.claim(self.batch_size)
+        if not amount_ids:
+            db.session.rollback()
+            return 0
+        amounts = (db.session.query(IncomingAmounts).
+                   filter(IncomingAmounts.id.in_(amount_ids)).
+                   order_by(IncomingAmounts.id).all())
+        self.assign_batch(amounts)
+        db.session.commit()
+        self.report["batches"] += 1
+        self.report["processed"] += len(amount_ids)
+        self.report["elapsed"] += perf_counter() - start
+        return len(amount_ids)
+
+    def run(self, *, wait=None, max_batches=None, progress=None):
+        """ Process batches until the queue is empty
+
+        If wait (seconds) is given, the worker waits for new amounts when
+        the queue is empty instead of stopping; it then runs until
+        max_batches batches are processed or it is interrupted. If passed,
+        progress is called with the report after each batch.
+        """
+
+        while max_batches is None or self.report["batches"] < max_batches:
+            if not self.process_batch():
+                if wait is None:
+                    break
+                sleep(wait)
+                continue
+            if progress:
+                self.report["backlog"] = AmountQueued.backlog()
+                progress(self.report)
+        self.report["backlog"] = AmountQueued.backlog()
+        db.session.commit()
+        return self.report
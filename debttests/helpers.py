@@ -27,11 +27,14 @@ from clientmodels.clients import Clients, Addresses, NoPostalAddressError,\
     POSTAL_ADDRESS, RESIDENTIAL_ADDRESS, GENERAL_ADDRESS, EMail,\
         DuplicateMailError, TooManyPreferredMailsError, BankAccounts,\
         NoResidentialAddressError, NoClientFoundError
-from debtmodels.overdue import (OverdueSteps, OverdueActions)
+from debtmodels.overdue import (OverdueSteps, OverdueActions,
+                                ArchivedActions)
 from debtmodels.debtbilling import (Bills, BillLines, DebtorPreferences,
-                                    DebtorSignal)
+                                    DebtorSignal, ArchivedBills,
+                                    ArchivedBillLines)
 from debtmodels.payments import (AmountQueued, IncomingAmounts,
-                                 AssignedAmounts)
+                                 AssignedAmounts, ImportedStatements,
+                                 ArchivedAssignments)
 from debtviews.overdue_processors import (FirstLetterProcessor,
                                           SecondLetterProcessor,
                                           DebtTransferProcessor,
@@ -502,6 +505,11 @@ def delete_amountq(instance):
     for amount in amounts:
         db.session.delete(amount)
 
+def delete_imported_statements(instance):
+    """ Forget the statements imported in a test """
+
+    db.session.query(ImportedStatements).delete()
+
 def delete_test_bills(instance, debug=None):
     """ Delete all the bills created for a test """
 
@@ -522,6 +530,13 @@ def delete_test_bills(instance, debug=None):
             print("bill", bill)
         db.session.delete(bill)
 
+def delete_archived_bills(instance):
+    """ Delete all archived bills and what was archived with them """
+
+    for archived in (ArchivedActions, ArchivedAssignments, ArchivedBillLines,
+                     ArchivedBills):
+        db.session.execute(db.delete(archived))
+
 def delete_test_payments(instance):
     """ Delete all payments created for a test """
 
@@ -0,0 +1,155 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from datetime import datetime, date, timedelta
+from sqlalchemy import update
+from debtors import app, db
+from debtmodels.archive import BillArchiver
+from debtmodels.debtbilling import Bills, BillNotFoundError, ArchivedBills
+from debtmodels.payments import IncomingAmounts, AssignedAmounts
+from debtmodels.overdue import OverdueActions, OverdueProcessor
+from debtviews.history import History
+from debttests.helpers import (delete_test_clients, add_addresses,
+    create_clients, create_bills, add_lines_to_bills, delete_test_bills,
+    delete_test_prefs, delete_test_payments, create_overdue_steps,
+    delete_overdue_steps, delete_overdue_actions, delete_archived_bills)
+
+
+class TestBillArchiver(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        create_overdue_steps(self)
+        self.ia01 = IncomingAmounts(payment_ccy='EUR', payment_amount=10000,
+                                    value_date=date.today())
+        self.ia01.client = self.clt1
+        self.ia01.add()
+        assignment = AssignedAmounts(ccy='EUR', amount_assigned=2500)
+        assignment.bill = self.bll2
+        assignment.from_amount = self.ia01
+        assignment.add()
+        action = OverdueActions(date_action=datetime.now())
+        action.bill = self.bll2
+        action.step = self.st15
+        db.session.add(action)
+        db.session.flush()
+        self.settle_long_ago(self.bll2)
+        self.app = app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+
+        db.session.rollback()
+        delete_archived_bills(self)
+        delete_overdue_actions(self)
+        delete_test_payments(self)
+        delete_test_bills(self)
+        OverdueProcessor.all_processors.clear()
+        delete_overdue_steps(self)
+        delete_test_prefs(self)
+        delete_test_clients(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def settle_long_ago(self, bill):
+        """ Make the bill last changed two years ago """
+
+        db.session.execute(update(Bills).
+                           where(Bills.bill_id == bill.bill_id).
+                           values(updated_at=datetime.now()
+                                  - timedelta(days=730)))
+
+    def test_settled_bill_archived(self):
+        """ A bill settled long ago is moved, with what belongs to it """
+
+        bill_id = self.bll2.bill_id
+        report = BillArchiver(retention_days=365).archive()
+        self.assertEqual(report["bills"], 1, 'Not one bill archived')
+        with self.assertRaises(BillNotFoundError):
+            Bills.get_bill_by_id(bill_id)
+        archived = ArchivedBills.get_bill_by_id(bill_id)
+        self.assertEqual(len(archived.lines), report["lines"],
+                         'Lines not archived')
+        self.assertTrue(archived.lines, 'Bill archived without lines')
+        self.assertEqual(archived.assignments[0].from_amount.id,
+                         self.ia01.id, 'Assignment not archived')
+        self.assertEqual(len(archived.overdue_actions), 1,
+                         'Action not archived')
+        self.assertEqual(IncomingAmounts.wrong_assigned_totals(), [],
+                         'Archived assignments not counted')
+
+    def test_bill_without_last_change_archived(self):
+        """ A bill settled long ago without updated_at is archived """
+
+        bill_id = self.bll2.bill_id
+        long_ago = date.today() - timedelta(days=730)
+        db.session.execute(update(Bills).
+                           where(Bills.bill_id == bill_id).
+                           values(updated_at=None, date_bill=long_ago,
+                                  date_sale=long_ago))
+        report = BillArchiver(retention_days=365).archive()
+        self.assertEqual(report["bills"], 1, 'Bill not archived')
+        self.assertEqual(ArchivedBills.get_bill_by_id(bill_id).bill_id,
+                         bill_id, 'Bill not in archive')
+
+    def test_open_bills_stay(self):
+        """ Open bills and bills settled recently are not archived """
+
+        bill_ids = [self.bll1.bill_id, self.bll4.bill_id]
+        BillArchiver(retention_days=365).archive()
+        for bill_id in bill_ids:
+            self.assertEqual(Bills.get_bill_by_id(bill_id).bill_id, bill_id,
+                             'Bill archived')
+        self.assertEqual(BillArchiver(retention_days=1000).archive()["bills"],
+                         0, 'Bill archived before retention period')
+
+    def test_replaced_bill_referred_stays(self):
+        """ A replaced bill stays while the bill replacing it stays """
+
+        db.session.execute(update(Bills).
+                           where(Bills.bill_id == self.bll1.bill_id).
+                           values(prev_bill=self.bll2.bill_id))
+        bill_id = self.bll2.bill_id
+        BillArchiver(retention_days=365).archive()
+        self.assertEqual(Bills.get_bill_by_id(bill_id).bill_id, bill_id,
+                         'Referred bill archived')
+
+    def test_history_and_api_read_archive(self):
+        """ The history and the API show archived bills """
+
+        bill_id = self.bll2.bill_id
+        client = self.clt1
+        BillArchiver(retention_days=365).archive()
+        history = History(client)
+        self.assertIn(bill_id, [item.get("bill_id")
+                                for item in history["bills_payments"]],
+                      'Archived bill not in history')
+        rv = self.app.get('/api/10/bill/' + str(bill_id))
+        self.assertEqual(rv.get_json()["bill-id"], bill_id,
+                         'Archived bill not returned')
+        rv = self.app.get('/api/10/client/' + str(client.id)
+                          + '/bills?status=paid')
+        self.assertIn(bill_id, [bill["bill-id"]
+                                for bill in rv.get_json()["bills"]],
+                      'Archived bill not listed')
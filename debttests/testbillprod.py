@@ -19,13 +19,20 @@ import os
 from os.path import exists
 from datetime import datetime, date
 import unittest
+from sqlalchemy import event
 from debtors import db, app
 from debttests.helpers import (delete_test_clients, add_addresses,
     create_clients, spread_created_at, create_bills, add_lines_to_bills,
     delete_test_bills)
 from debtmodels.debtbilling import Bills, BillLines
+from tempfile import TemporaryDirectory
+from jinja2 import FileSystemBytecodeCache
+from debtviews.outputenvironments import (rtf, rtf_cached, htmlenvironment,
+                                          warm_up_templates)
 from debtviews.physicalbill import rtfenvironment, BillDictView, PaperBill,\
-    HTMLMailBill, BillAccounting, BillReplaceAccounting, create_physical_bill
+    HTMLMailBill, BillAccounting, BillReplaceAccounting, create_physical_bill,\
+    BillProductionRun
+from debtviews.outputsinks import DirectorySink
 
 class TestPaperBillCreate(unittest.TestCase):
 
@@ -401,5 +408,182 @@ class TestCreateAnyBill(unittest.TestCase):
         self.assertEqual(Bills.ISSUED, self.bll1.status, 'Status not correct')
 
 
+class TestBillProductionRun(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        db.session.flush()
+        self.client_ids = [self.clt1.id, self.clt3.id, self.clt5.id]
+
+    def tearDown(self):
+
+        db.session.rollback()
+        delete_test_bills(self)
+        delete_test_clients(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_new_bills_produced(self):
+        """ The new bills are produced and issued, chunk by chunk """
+
+        bill_ids = [self.bll1.bill_id, self.bll3.bill_id]
+        run = BillProductionRun(chunk_size=1, client_ids=self.client_ids)
+        report = run.run()
+        self.assertEqual(report["produced"], 2, 'Not all bills produced')
+        self.assertEqual(report["chunks"], 3, 'Not a chunk per bill')
+        for bill_id in bill_ids:
+            self.assertEqual(Bills.get_bill_by_id(bill_id).status,
+                             Bills.ISSUED, 'Bill not issued')
+        self.assertTrue(exists('output/bill' + str(self.bll3.bill_id)),
+                        'Bill not written')
+        self.assertGreater(report.throughput(), 0, 'No bills per second')
+
+    def test_failing_bill_reported(self):
+        """ A bill that fails stays new, the others are produced """
+
+        bill_id = self.bll5.bill_id
+        report = BillProductionRun(client_ids=self.client_ids).run()
+        self.assertEqual(report["failed"], [bill_id], 'Failure not reported')
+        self.assertEqual(report["produced"], 2, 'Chunk not produced')
+        self.assertEqual(Bills.get_bill_by_id(bill_id).status, Bills.NEW,
+                         'Failing bill changed')
+
+    def test_failing_accounting_not_written(self):
+        """ A bill whose accounting fails leaves no document behind """
+
+        bill_id = self.bll3.bill_id
+        bill_path = 'output/bill' + str(bill_id)
+        if exists(bill_path):
+            os.remove(bill_path)
+        db.session.execute(db.update(Bills).
+                           where(Bills.bill_id == bill_id).
+                           values(prev_bill=-1))
+        db.session.expire(self.bll3)
+        report = BillProductionRun(client_ids=self.client_ids,
+                                   print_acc=False).run()
+        self.assertIn(bill_id, report["failed"], 'Failure not reported')
+        self.assertEqual(Bills.get_bill_by_id(bill_id).status, Bills.NEW,
+                         'Failing bill changed')
+        self.assertFalse(exists(bill_path), 'Document of failed bill written')
+
+    def test_failing_document_no_accounting(self):
+        """ A bill whose document cannot be written leaves no accounting """
+
+        accountings = []
+        directory_write = DirectorySink.write
+        def fail_bill(sink, name, text):
+            if text.startswith('{"journal"'):
+                accountings.append(name)
+            else:
+                raise OSError("No space left on device")
+        DirectorySink.write = fail_bill
+        try:
+            report = BillProductionRun(client_ids=self.client_ids).run()
+        finally:
+            DirectorySink.write = directory_write
+        self.assertIn(self.bll3.bill_id, report["failed"],
+                      'Failure not reported')
+        self.assertEqual(accountings, [], 'Accounting written')
+        self.assertEqual(Bills.get_bill_by_id(self.bll3.bill_id).status,
+                         Bills.NEW, 'Failing bill changed')
+
+    def test_rendered_in_pool(self):
+        """ Bills rendered by worker processes are the same as in process """
+
+        expected = PaperBill(self.bll3.bill_id).contents()
+        report = BillProductionRun(client_ids=self.client_ids,
+                                   print_acc=False, workers=2).run()
+        self.assertEqual(report["produced"], 2, 'Not all bills produced')
+        with open('output/bill' + str(self.bll3.bill_id)) as bill_file:
+            self.assertEqual(bill_file.read(), expected,
+                             'Bill rendered differently')
+
+    def test_chunk_read_at_once(self):
+        """ The number of queries does not depend on the bills in a chunk """
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        run = BillProductionRun(client_ids=self.client_ids, print_it=False,
+                                print_acc=False)
+        bill_ids = run.new_bills()
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            run.load_chunk(bill_ids)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+        self.assertLessEqual(len(statements), 5, 'Bills read one by one')
+
+
+class TestRTFEncoding(unittest.TestCase):
+
+    def test_letters_escaped(self):
+        """ Letters outside ASCII become their code point """
+
+        self.assertEqual(rtf("Café Zürich ŁÓDŹ 中"),
+                         "Caf\\u233? Z\\u252?rich \\u321?\\u211?D\\u377? "
+                         "\\u20013?", 'Letters not escaped')
+        self.assertEqual(rtf("plain"), "plain", 'ASCII changed')
+        self.assertIsNone(rtf(None), 'No value changed')
+
+    def test_short_values_cached(self):
+        """ Short values are kept, long descriptions are not """
+
+        rtf_cached.cache_clear()
+        rtf("Złoty")
+        rtf("Złoty")
+        rtf("Ø" * 500)
+        info = rtf_cached.cache_info()
+        self.assertEqual((info.hits, info.currsize), (1, 1),
+                         'Cache not used as expected')
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tempdir = TemporaryDirectory()
+        self.environments = (rtfenvironment, htmlenvironment)
+        self.caches = [environment.bytecode_cache
+                       for environment in self.environments]
+
+    def tearDown(self):
+
+        for environment, cache in zip(self.environments, self.caches):
+            environment.bytecode_cache = cache
+        self.tempdir.cleanup()
+
+    def test_warm_up_fills_cache(self):
+        """ Warming up compiles the correspondence into the cache """
+
+        for environment in self.environments:
+            environment.bytecode_cache =\
+                FileSystemBytecodeCache(self.tempdir.name)
+            environment.cache.clear()
+        loaded = warm_up_templates()
+        self.assertGreaterEqual(loaded, 9, 'Not all templates loaded')
+        self.assertEqual(len(os.listdir(self.tempdir.name)), loaded,
+                         'Compiled templates not cached')
+        self.assertIn('paperbill.rtf',
+                      [name for _, name in rtfenvironment.cache.keys()],
+                      'Template not kept in memory')
+
+    def test_no_reload_in_production(self):
+        """ Templates are not checked for changes outside debug mode """
+
+        self.assertFalse(app.debug, 'Tests run in debug mode')
+        self.assertFalse(rtfenvironment.auto_reload, 'Templates reloaded')
+        self.assertFalse(htmlenvironment.auto_reload, 'Templates reloaded')
+
+
 if __name__ == '__main__':
     unittest.main()
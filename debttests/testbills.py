@@ -16,14 +16,18 @@
 #    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import json
 from json import dumps
 from datetime import datetime, date, timedelta
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 from flask import g
-from debtors import app, db
+from debtors import app, db, InvalidDataError
 from clientmodels.clients import Clients, Addresses, EMail, BankAccounts
 from debtmodels.debtbilling import (Bills, BillLines, DebtorPreferences,
-                                    DebtorSignal, NoClientInPreferenceError)
+                                    DebtorSignal, NoClientInPreferenceError,
+                                    ClientHasSignalError, ReplacedBillError)
 from debtviews.billsapi import BillDict, BillListDict
 from debttests.helpers import (delete_test_clients, add_addresses,
     create_clients, spread_created_at , create_bills, add_lines_to_bills,
@@ -208,6 +212,59 @@ class TestBillFromMessage(unittest.TestCase):
         self.assertEqual(len(bill17.lines), 2, 'Incorrect no of lines')
         db.session.rollback()
 
+    def test_create_from_dicts(self):
+        """ Bills are created together, with an error per bill in error """
+
+        DebtorSignal(client=self.clt2, date_start=date.today()).add()
+        db.session.flush()
+        signalled = dict(self.bill_dict, client=str(self.clt2.id))
+        paid_replaced = dict(self.bill_dict,
+                             **{"bill-replaced": str(self.bll2.bill_id)})
+        replaced = dict(self.bill_dict,
+                        **{"bill-replaced": str(self.bll1.bill_id)})
+        bills = Bills.create_from_dicts([self.bill_dict, signalled,
+                                         paid_replaced, replaced])
+        self.assertIn(bills[0], self.clt1.bills, 'Bill not added')
+        self.assertIsInstance(bills[1], ClientHasSignalError,
+                              'Signal not checked')
+        self.assertIsInstance(bills[2], ReplacedBillError,
+                              'Replaced bill not checked')
+        self.assertEqual(bills[3].prev_bill, str(self.bll1.bill_id),
+                         'Replaced bill not set')
+        self.assertEqual(len([bill for bill in self.clt1.bills
+                              if bill.date_sale == datetime(2020, 3, 29)]),
+                         2, 'Bill in error added to client')
+
+    def test_create_from_dicts_queries(self):
+        """ The number of queries does not grow with the number of bills """
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        replaced = dict(self.bill_dict,
+                        **{"bill-replaced": str(self.bll1.bill_id)})
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            bills = Bills.create_from_dicts([self.bill_dict, replaced] * 10)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+        self.assertLessEqual(len(statements), 4, 'Query per bill')
+        self.assertEqual(len([bill for bill in bills
+                              if isinstance(bill, ReplacedBillError)]), 9,
+                         'Bill replaced more than once')
+
+    def test_create_from_dicts_replace_once(self):
+        """ A bill can be replaced by one bill of a batch only """
+
+        replaced = dict(self.bill_dict,
+                        **{"bill-replaced": str(self.bll1.bill_id)})
+        bills = Bills.create_from_dicts([replaced, replaced])
+        self.assertIsInstance(bills[0], Bills, 'Replacing bill not created')
+        self.assertIsInstance(bills[1], ReplacedBillError,
+                              'Bill replaced twice')
+
 
 class TestBillFunctions(unittest.TestCase):
 
@@ -244,6 +301,52 @@ class TestBillFunctions(unittest.TestCase):
         self.assertEqual(self.bill08.total(), 243, 
                          'Incorrect total bill amount')
 
+    def test_total_stored(self):
+        """ The total of the lines is stored on the bill """
+
+        self.assertEqual(self.bill08.total_amount, 243,
+                         'Incorrect stored total')
+
+    def test_total_without_lines(self):
+        """ The stored total is used if the lines are not loaded """
+
+        bill08_id = self.bill08.bill_id
+        db.session.expire(self.bill08)
+        bill08 = Bills.get_bill_by_id(bill08_id)
+        self.assertEqual(bill08.total(), 243, 'Incorrect total')
+        self.assertNotIn('lines', bill08.__dict__, 'Lines loaded')
+
+    def test_total_follows_lines(self):
+        """ Changing, adding and deleting lines changes the stored total """
+
+        self.bl10.number_of = 6
+        db.session.flush()
+        self.assertEqual(self.bill08.total_amount, 288,
+                         'Change of line not in total')
+        self.bill08.lines.append(BillLines(short_desc='Toast',
+                                           unit_price=12, number_of=2))
+        db.session.flush()
+        self.assertEqual(self.bill08.total_amount, 312,
+                         'Added line not in total')
+        db.session.delete(self.bl09)
+        db.session.flush()
+        self.assertEqual(self.bill08.total_amount, 294,
+                         'Deleted line still in total')
+
+    def test_backfill_totals(self):
+        """ A wrong stored total is reported and recomputed """
+
+        bill08_id = self.bill08.bill_id
+        db.session.execute(db.update(Bills).
+                           where(Bills.bill_id == bill08_id).
+                           values(total_amount=1))
+        self.assertIn((bill08_id, 1, 243), Bills.wrong_totals(),
+                      'Wrong total not reported')
+        Bills.backfill_totals()
+        self.assertEqual(Bills.wrong_totals(), [], 'Totals still wrong')
+        self.assertEqual(Bills.get_bill_by_id(bill08_id).total_amount, 243,
+                         'Total not recomputed')
+
     def test_can_set_status(self):
         """ We can set the status of a bill """
 
@@ -479,6 +582,128 @@ class TestBillTransactions(unittest.TestCase):
         rv = self.app.post('/api/10/bill/new', json=self.bill_dict)
         self.assertEqual(400, rv.status_code, 'No 400 status returned')
 
+    def test_bills_by_page(self):
+        """ The bills of a client are listed a page at a time """
+
+        url = '/api/10/client/' + str(self.clt1.id) + '/bills?limit=1'
+        bill_ids = []
+        page = self.app.get(url).get_json()
+        while True:
+            self.assertEqual(len(page["bills"]), 1, 'Page size wrong')
+            bill_ids.append(page["bills"][0]["bill-id"])
+            if page["next"] is None:
+                break
+            page = self.app.get(url + '&after=' + str(page["next"])).get_json()
+        self.assertEqual(bill_ids, sorted(bill.bill_id
+                                          for bill in self.clt1.bills),
+                         'Not all bills listed in order')
+
+    def test_bills_unpaged(self):
+        """ Without after and limit all bills are listed at once """
+
+        page_size = app.config.get("API_PAGE_SIZE")
+        app.config["API_PAGE_SIZE"] = 1
+        try:
+            page = self.app.get('/api/10/client/' + str(self.clt1.id)
+                                + '/bills').get_json()
+        finally:
+            app.config["API_PAGE_SIZE"] = page_size
+        self.assertEqual([bill["bill-id"] for bill in page["bills"]],
+                         sorted(bill.bill_id for bill in self.clt1.bills),
+                         'Not all bills listed')
+        self.assertIsNone(page["next"], 'Next page announced')
+
+    def test_bills_by_status(self):
+        """ The bills listed can be limited to some statuses """
+
+        rv = self.app.get('/api/10/client/' + str(self.clt1.id)
+                          + '/bills?status=paid')
+        self.assertEqual([bill["bill-id"] for bill in rv.get_json()["bills"]],
+                         [self.bll2.bill_id], 'Wrong bills listed')
+        rv = self.app.get('/api/10/client/' + str(self.clt1.id)
+                          + '/bills?status=unknown')
+        self.assertEqual(rv.status_code, 400, 'Invalid status accepted')
+
+    def test_bills_not_modified(self):
+        """ If the bills did not change, 304 is returned """
+
+        url = '/api/10/client/' + str(self.clt1.id) + '/bills'
+        etag = self.app.get(url).headers["ETag"]
+        rv = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304, 'Not modified not returned')
+        self.bll1.status = Bills.ISSUED
+        db.session.flush()
+        rv = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 200, 'Change not seen')
+
+    def test_line_change_changes_etag(self):
+        """ A bill line changed, not its total, gives a new ETag """
+
+        url = '/api/10/client/' + str(self.clt1.id) + '/bills'
+        etag = self.app.get(url).headers["ETag"]
+        self.bll1.lines[0].long_desc = 'Another description'
+        db.session.flush()
+        rv = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 200, 'Line change not seen')
+
+    def test_add_bills_in_bulk(self):
+        """ We can add bills as lines of JSON, a result per line """
+
+        bill_dict = self.bill_dict.copy()
+        del bill_dict['date-sale']
+        body = "\n".join([dumps(self.bill_dict), dumps(bill_dict),
+                          "no json", dumps(self.bill_dict)])
+        rv = self.app.post('/api/10/bills/new', data=body,
+                           content_type='application/x-ndjson')
+        self.assertEqual(rv.status_code, 200, 'Failure')
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        self.assertEqual([result["line"] for result in results],
+                         [1, 2, 3, 4], 'Not a result per line')
+        self.assertEqual([result["status"] for result in results],
+                         ["OK", "Bad Request", "Bad Request", "OK"],
+                         'Wrong status returned')
+        bill = Bills.get_bill_by_id(results[0]["bill-id"])
+        self.assertEqual(bill.total(), 1765 + 2265, 'Bill not stored')
+
+    def test_bulk_in_batches(self):
+        """ Bills are committed in batches of the configured size """
+
+        old_size = app.config.get("BILL_BATCH_SIZE")
+        app.config["BILL_BATCH_SIZE"] = 2
+        try:
+            body = "\n".join([dumps(self.bill_dict)] * 5)
+            rv = self.app.post('/api/10/bills/new', data=body,
+                               content_type='application/x-ndjson')
+        finally:
+            app.config["BILL_BATCH_SIZE"] = old_size
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        self.assertEqual(len({result["bill-id"] for result in results}), 5,
+                         'Not all bills created')
+
+    def test_bulk_check_at_flush_reported(self):
+        """ A bill refused by a check at the flush gets its own result """
+
+        def refuse_bill(session, flush_context, instances):
+            for instance in session.new:
+                if (isinstance(instance, Bills)
+                        and instance.date_sale == datetime(2021, 1, 1)):
+                    raise InvalidDataError("Bill refused at flush")
+
+        refused = dict(self.bill_dict, **{"date-sale": "2021-01-01"})
+        body = "\n".join([dumps(self.bill_dict), dumps(refused),
+                          dumps(self.bill_dict)])
+        event.listen(Session, "before_flush", refuse_bill)
+        try:
+            rv = self.app.post('/api/10/bills/new', data=body,
+                               content_type='application/x-ndjson')
+            results = [json.loads(line) for line in rv.data.splitlines()]
+        finally:
+            event.remove(Session, "before_flush", refuse_bill)
+        self.assertEqual([result["status"] for result in results],
+                         ["OK", "Bad Request", "OK"], 'Wrong status returned')
+        self.assertEqual(results[1]["message"], "Bill refused at flush",
+                         'Error not reported')
+
     def test_get_bill_by_id(self):
         """ We can get a bill by its bill id """
 
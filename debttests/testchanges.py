@@ -0,0 +1,142 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import Session
+from debtors import app, db
+from debtmodels.changes import ChangeLog, CHANGES_LOGGED
+from debtmodels.debtbilling import Bills
+from debttests.helpers import (delete_test_clients, add_addresses,
+    create_clients, create_bills, add_lines_to_bills, delete_test_bills,
+    delete_test_prefs)
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.cursor = db.session.scalar(db.select(func.max(ChangeLog.id)))
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        db.session.flush()
+        self.app = app.test_client()
+        self.app.testing = True
+
+    def tearDown(self):
+
+        db.session.rollback()
+        delete_test_bills(self)
+        delete_test_prefs(self)
+        delete_test_clients(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def logged(self, entity):
+        """ The (entity id, operation) logged for entity since setUp """
+
+        return [(change.entity_id, change.operation)
+                for change in ChangeLog.changes_since(self.cursor, 1000)
+                if change.entity == entity]
+
+    def test_insert_logged(self):
+        """ A new bill is logged when it is flushed """
+
+        self.assertIn((self.bll1.bill_id, ChangeLog.INSERT),
+                      self.logged(Bills.CHANGE_ENTITY), 'Insert not logged')
+
+    def test_update_logged(self):
+        """ A changed bill is logged, an unchanged one is not """
+
+        cursor = db.session.scalar(db.select(func.max(ChangeLog.id)))
+        self.bll1.status = Bills.ISSUED
+        db.session.flush()
+        self.assertEqual([(change.entity, change.entity_id, change.operation)
+                          for change in ChangeLog.changes_since(cursor)],
+                         [(Bills.CHANGE_ENTITY, self.bll1.bill_id,
+                           ChangeLog.UPDATE)], 'Update not logged')
+
+    def test_bulk_logged(self):
+        """ The bills changed by backfill_totals are logged """
+
+        self.bll1.lines[0].unit_price = 1
+        db.session.flush()
+        db.session.execute(update(Bills).
+                           where(Bills.bill_id == self.bll1.bill_id).
+                           values(total_amount=0))
+        cursor = db.session.scalar(db.select(func.max(ChangeLog.id)))
+        Bills.backfill_totals()
+        self.assertIn(self.bll1.bill_id,
+                      [change.entity_id
+                       for change in ChangeLog.changes_since(cursor)],
+                      'Bulk update not logged')
+
+    def test_changes_api(self):
+        """ The committed changes are listed by the API, with the entity """
+
+        cursor = db.session.scalar(db.select(func.max(ChangeLog.position)))
+        db.session.commit()
+        url = '/api/10/changes?limit=2'
+        if cursor is not None:
+            url += '&since=' + str(cursor)
+        page = self.app.get(url).get_json()
+        self.assertEqual(len(page["changes"]), 2, 'Page size wrong')
+        self.assertTrue(page["more"], 'More changes not shown')
+        self.assertEqual(page["next"], page["changes"][-1]["cursor"],
+                         'Next cursor wrong')
+        page = self.app.get('/api/10/changes?since=' + str(cursor or 0)
+                            + '&limit=1000').get_json()
+        bill_changes = [change for change in page["changes"]
+                        if change["entity"] == Bills.CHANGE_ENTITY
+                        and change["id"] == self.bll1.bill_id]
+        self.assertEqual(bill_changes[0]["data"]["status"], self.bll1.status,
+                         'Bill not in change')
+
+    def log_in_session(self, change_id, bill_id):
+        """ Log a change to a bill under change_id in a session and commit """
+
+        with Session(db.engine) as session:
+            session.execute(insert(ChangeLog.__table__),
+                            [{"id": change_id, "entity": Bills.CHANGE_ENTITY,
+                              "entity_id": bill_id,
+                              "operation": ChangeLog.UPDATE}])
+            session.info[CHANGES_LOGGED] = True
+            session.commit()
+
+    def test_later_commit_not_missed(self):
+        """ A change committed after a reader read past it is not missed
+
+        The sessions are interleaved as two workers would be on a database
+        with a sequence: the first gets the lower id, but commits after the
+        second. SQLite has one writer at a time, so the ids are given.
+        """
+
+        db.session.commit()
+        cursor = db.session.scalar(db.select(func.max(ChangeLog.position)))
+        first_id = db.session.scalar(db.select(func.max(ChangeLog.id))) + 1
+        self.log_in_session(first_id + 1, self.bll2.bill_id)
+        read = ChangeLog.committed_since(cursor)
+        self.assertEqual([change.entity_id for change in read],
+                         [self.bll2.bill_id], 'Change of second not read')
+        self.log_in_session(first_id, self.bll1.bill_id)
+        read = ChangeLog.committed_since(read[-1].position)
+        self.assertEqual([change.entity_id for change in read],
+                         [self.bll1.bill_id], 'Change committed later missed')
@@ -20,7 +20,8 @@ from datetime import date, timedelta, datetime
 from clientmodels.clients import Clients, Addresses, NoPostalAddressError,\
     POSTAL_ADDRESS, RESIDENTIAL_ADDRESS, GENERAL_ADDRESS, EMail,\
         DuplicateMailError, TooManyPreferredMailsError, BankAccounts,\
-        NoResidentialAddressError, NoClientFoundError
+        NoResidentialAddressError, NoClientFoundError,\
+        MoreThanOnAccountError, IBANClientCache, iban_cache
 from clientviews.clients import ClientViewingList
 from debttests.helpers import delete_test_clients, add_addresses,\
     create_clients, spread_created_at 
@@ -780,6 +781,158 @@ class TestDebtorInterface(unittest.TestCase):
         self.assertEqual(len(clt_list02), 2, 'Not the correct no. of Clients returned')
 
 
+class TestIBANClientCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.clt12 = Clients(surname='Jansen', first_name='Tycho',
+                        initials='T.M.', birthdate=date(1971, 2, 23),
+                        sex='M')
+        self.clt12.add()
+        self.ba08 = BankAccounts(iban='NL83INSI0807135747',
+                            client_name='T.M. Jansen')
+        self.clt12.accounts.append(self.ba08)
+        db.session.flush()
+        iban_cache.clear()
+
+    def tearDown(self):
+
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_second_lookup_hits(self):
+        """ The second lookup of an IBAN is answered from the cache """
+
+        iban_cache.client_ids('GB33BUKB20201555555555')
+        hits, misses = iban_cache.hits, iban_cache.misses
+        self.assertEqual(iban_cache.client_ids('GB33BUKB20201555555555'),
+                         (), 'Unknown IBAN has clients')
+        self.assertEqual(iban_cache.hits, hits + 1, 'No hit counted')
+        self.assertEqual(iban_cache.misses, misses, 'Miss counted')
+
+    def test_loaded_in_bulk(self):
+        """ The accounts present are loaded on first use """
+
+        iban_cache.client_ids('GB33BUKB20201555555555')
+        hits = iban_cache.hits
+        self.assertEqual(iban_cache.client_ids(self.ba08.iban),
+                         (self.clt12.id,), 'Wrong client id')
+        self.assertEqual(iban_cache.hits, hits + 1, 'Not loaded in bulk')
+
+    def test_new_account_seen(self):
+        """ An account added is seen after the IBAN was cached """
+
+        self.assertEqual(iban_cache.client_ids('GB33BUKB20201555555555'),
+                         (), 'Unknown IBAN has clients')
+        self.clt12.accounts.append(BankAccounts(
+            iban='GB33BUKB20201555555555', client_name='Tycho Jansen'))
+        self.assertEqual(iban_cache.client_ids('GB33BUKB20201555555555'),
+                         (self.clt12.id,), 'New account not seen')
+
+    def test_changed_account_seen(self):
+        """ Changing the IBAN of an account invalidates both IBANs """
+
+        iban_cache.client_ids(self.ba08.iban)
+        self.ba08.iban = 'GB33BUKB20201555555555'
+        db.session.flush()
+        self.assertEqual(iban_cache.client_ids('NL83INSI0807135747'), (),
+                         'Old IBAN still cached')
+        self.assertEqual(iban_cache.client_ids('GB33BUKB20201555555555'),
+                         (self.clt12.id,), 'New IBAN not seen')
+
+    def test_deleted_account_seen(self):
+        """ A deleted account is no longer found """
+
+        iban_cache.client_ids(self.ba08.iban)
+        self.ba08.delete()
+        db.session.flush()
+        with self.assertRaises(NoClientFoundError):
+            Clients.get_client_by_iban('NL83INSI0807135747')
+
+    def test_rollback_seen(self):
+        """ After a rollback an account added is gone from the cache """
+
+        iban = self.ba08.iban
+        iban_cache.client_ids(iban)
+        db.session.rollback()
+        self.assertEqual(iban_cache.client_ids(iban), (),
+                         'Rolled back account still cached')
+
+    def test_commit_invalidates(self):
+        """ An owner cached between the flush and the commit is dropped """
+
+        iban = 'GB33BUKB20201555555555'
+        self.clt12.accounts.append(BankAccounts(iban=iban,
+                                                client_name='Tycho Jansen'))
+        db.session.flush()
+        with iban_cache.lock:
+            # As another session, not seeing the new account, would
+            iban_cache.store(iban, ())
+        db.session.commit()
+        try:
+            self.assertNotIn(iban, iban_cache.entries, 'Stale owner kept')
+        finally:
+            for account in self.clt12.accounts:
+                db.session.delete(account)
+            db.session.delete(self.clt12)
+            db.session.commit()
+
+    def test_old_answer_looked_up_again(self):
+        """ An account added by another process is seen when the answer
+        is too old """
+
+        iban = 'GB33BUKB20201555555555'
+        self.assertEqual(iban_cache.client_ids(iban), (),
+                         'Unknown IBAN has clients')
+        # As another process would, without the listeners of this one
+        db.session.execute(db.insert(BankAccounts.__table__).
+                           values(iban=iban, client_name='Tycho Jansen',
+                                  client_id=self.clt12.id))
+        self.assertEqual(iban_cache.client_ids(iban), (),
+                         'Answer not kept')
+        with iban_cache.lock:
+            iban_cache.entries[iban] = (
+                (), iban_cache.entries[iban][1]
+                - iban_cache.time_to_live())
+        self.assertEqual(iban_cache.client_ids(iban), (self.clt12.id,),
+                         'Old answer kept')
+
+    def test_lookup_does_not_flush(self):
+        """ A lookup answered from the cache leaves the session alone """
+
+        iban_cache.client_ids(self.ba08.iban)
+        clt13 = Clients(surname='Jansen', first_name='Arne', sex='M')
+        clt13.add()
+        self.assertEqual(iban_cache.client_ids(self.ba08.iban),
+                         (self.clt12.id,), 'Wrong client id')
+        self.assertIn(clt13, db.session.new, 'Session flushed')
+
+    def test_more_clients_for_iban(self):
+        """ An IBAN of more clients is refused """
+
+        clt13 = Clients(surname='Jansen', first_name='Arne', sex='M')
+        clt13.add()
+        clt13.accounts.append(BankAccounts(iban=self.ba08.iban,
+                                           client_name='A. Jansen'))
+        db.session.flush()
+        with self.assertRaises(MoreThanOnAccountError):
+            Clients.get_client_by_iban(self.ba08.iban)
+
+    def test_least_recently_used_dropped(self):
+        """ When full, the IBAN not used for the longest time is dropped """
+
+        cache = IBANClientCache(max_size=2)
+        cache.client_ids('NL83INSI0807135747')
+        cache.client_ids('GB33BUKB20201555555555')
+        cache.client_ids('NL83INSI0807135747')
+        cache.client_ids('NL08INGB0000001234')
+        self.assertEqual(list(cache.entries),
+                         ['NL83INSI0807135747', 'NL08INGB0000001234'],
+                         'Wrong IBAN dropped')
+
+
 class TestClientTransactions(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,322 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import socket
+import socketserver
+import unittest
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from threading import Thread, Lock
+from debtors import db, app
+from debtors.maildelivery import (SMTPConnectionPool, MailDeliveryWorker,
+                                  MailDeliveryReport)
+from debtmodels.delivery import MailDelivery
+from debtviews.physicalbill import create_physical_bill
+from debttests.helpers import (delete_test_clients, add_addresses,
+    create_clients, create_bills, add_lines_to_bills, delete_test_bills)
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """ Answers the commands of one connection like an SMTP server would
+
+    Recipients in the refused domains are refused permanently, those in
+    the busy domains temporarily.
+    """
+
+    def reply(self, line):
+
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 stand-in ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-stand-in")
+                self.reply("250 8BITMIME")
+            elif verb in ("HELO", "NOOP"):
+                self.reply("250 OK")
+            elif verb in ("MAIL", "RSET"):
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = re.search("<([^>]*)>", command).group(1)
+                domain = address.rpartition("@")[2]
+                if domain in server.refused:
+                    self.reply("550 No such user")
+                elif domain in server.busy:
+                    self.reply("451 Try again later")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    data.append(data_line)
+                with server.lock:
+                    server.messages.extend((recipient, b"".join(data))
+                                           for recipient in recipients)
+                self.reply("250 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    """ A local SMTP server that keeps the messages it receives """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, refused=(), busy=()):
+
+        super().__init__(("localhost", 0), StandInSMTPHandler)
+        self.refused = refused
+        self.busy = busy
+        self.lock = Lock()
+        self.connections = 0
+        self.messages = []
+
+
+def queue_message(recipient, number=0):
+    """ Queue a message for recipient and return the delivery """
+
+    message = EmailMessage()
+    message["From"] = "billing@debtorscompany.com"
+    if recipient:
+        message["To"] = recipient
+    message["Subject"] = f"Your bill {number}"
+    message.set_content(f"Bill {number} is overdue, please pay")
+    return MailDelivery.queue("mailfom" + str(number), message.as_string())
+
+
+class TestMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.server = StandInSMTPServer(refused=("refused.example",),
+                                        busy=("busy.example",))
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool = SMTPConnectionPool("localhost",
+                                       self.server.server_address[1], 2)
+
+    def tearDown(self):
+
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        db.session.rollback()
+        db.session.execute(db.delete(MailDelivery))
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_messages_delivered_over_pool(self):
+        """ The messages are sent in batches over a few open connections """
+
+        for number in range(40):
+            queue_message(f"client{number}@domain{number % 4}.example",
+                          number)
+        db.session.commit()
+        report = MailDeliveryWorker(batch_size=5).run(pool=self.pool)
+        self.assertEqual(report["sent"], 40, 'Not all messages sent')
+        self.assertEqual(report["batches"], 8, 'Not batched by domain')
+        self.assertEqual(len(self.server.messages), 40,
+                         'Server did not receive all messages')
+        self.assertLessEqual(self.server.connections, 2,
+                             'Connections not reused')
+        self.assertEqual(MailDelivery.status_counts(),
+                         {MailDelivery.SENT: 40}, 'Status not stored')
+
+    def test_refused_fails_busy_retried(self):
+        """ A refused message fails, a temporary error is tried later """
+
+        refused = queue_message("nobody@refused.example", 1)
+        busy = queue_message("client@busy.example", 2)
+        db.session.commit()
+        refused_id, busy_id = refused.id, busy.id
+        report = MailDeliveryWorker().run(pool=self.pool)
+        self.assertEqual(report["failed"], [refused_id],
+                         'Refused message not failed')
+        self.assertEqual(report["retried"], 1, 'Busy message not retried')
+        refused = db.session.get(MailDelivery, refused_id)
+        self.assertEqual(refused.status, MailDelivery.FAILED,
+                         'Status of refused message wrong')
+        self.assertTrue(refused.last_error.startswith("550"),
+                        'Answer of server not stored')
+        busy = db.session.get(MailDelivery, busy_id)
+        self.assertEqual(busy.status, MailDelivery.QUEUED,
+                         'Busy message not queued again')
+        self.assertEqual(busy.attempts, 1, 'Attempt not counted')
+        self.assertGreater(busy.next_attempt,
+                           datetime.now() + timedelta(seconds=50),
+                           'Retry not postponed')
+
+    def test_last_attempt_fails(self):
+        """ A message that keeps failing fails after the last attempt """
+
+        busy = queue_message("client@busy.example", 3)
+        busy.attempts = 4
+        db.session.commit()
+        busy_id = busy.id
+        MailDeliveryWorker().run(pool=self.pool)
+        busy = db.session.get(MailDelivery, busy_id)
+        self.assertEqual(busy.status, MailDelivery.FAILED,
+                         'Message not failed after last attempt')
+        self.assertEqual(busy.attempts, 5, 'Attempts wrong')
+
+    def test_unreachable_server_retried(self):
+        """ If the server cannot be reached, the messages are tried later """
+
+        with socket.socket() as closed:
+            closed.bind(("localhost", 0))
+            port = closed.getsockname()[1]
+        delivery = queue_message("client@domain1.example", 4)
+        db.session.commit()
+        delivery_id = delivery.id
+        report = MailDeliveryWorker().run(
+            pool=SMTPConnectionPool("localhost", port, 1))
+        self.assertEqual(report["retried"], 1, 'Message not retried')
+        delivery = db.session.get(MailDelivery, delivery_id)
+        self.assertEqual(delivery.status, MailDelivery.QUEUED,
+                         'Message not queued again')
+        self.assertIsNotNone(delivery.last_error, 'Error not stored')
+
+    def test_backoff_doubles(self):
+        """ The wait before a retry doubles, up to the maximum """
+
+        worker = MailDeliveryWorker()
+        now = datetime(2020, 3, 18, 12, 0)
+        self.assertEqual(worker.retry_at(3, now) - now,
+                         timedelta(seconds=240), 'Wait not doubled')
+        self.assertEqual(worker.retry_at(20, now) - now,
+                         timedelta(hours=6), 'Wait not limited')
+
+    def test_recipient_with_name(self):
+        """ Of a recipient with a name only the address is used """
+
+        delivery = queue_message("Client Name <client@Domain1.example>", 6)
+        self.assertEqual(delivery.recipient, "client@Domain1.example",
+                         'Address not taken from recipient')
+        self.assertEqual(delivery.domain, "domain1.example", 'Wrong domain')
+        db.session.commit()
+        report = MailDeliveryWorker().run(pool=self.pool)
+        self.assertEqual(report["sent"], 1, 'Message not sent')
+        self.assertEqual(self.server.messages[0][0],
+                         "client@Domain1.example", 'Sent to wrong address')
+
+    def test_claim_committed(self):
+        """ Claimed messages are kept from other workers until the claim
+        ends """
+
+        delivery = queue_message("client@domain1.example", 7)
+        db.session.commit()
+        delivery_id = delivery.id
+        claimed = MailDelivery.claim_due(10, datetime.now()
+                                         + timedelta(minutes=15))
+        db.session.commit()
+        self.assertEqual([row.id for row in claimed], [delivery_id],
+                         'Message not claimed')
+        self.assertEqual(MailDelivery.claim_due(10, datetime.now()), [],
+                         'Claimed message claimed again')
+        db.session.execute(db.update(MailDelivery).
+                           values(next_attempt=datetime.now()
+                                  - timedelta(seconds=1)))
+        claimed = MailDelivery.claim_due(10, datetime.now())
+        self.assertEqual([row.id for row in claimed], [delivery_id],
+                         'Message not due after the claim ended')
+        self.assertEqual(db.session.get(MailDelivery, delivery_id).attempts,
+                         2, 'Claims not counted as attempts')
+
+    def test_no_recipient_failed(self):
+        """ A message without a recipient is stored as failed """
+
+        delivery = queue_message(None, 5)
+        self.assertEqual(delivery.status, MailDelivery.FAILED,
+                         'Message without recipient not failed')
+
+    def test_report_text(self):
+        """ The report shows the counts """
+
+        report = MailDeliveryReport()
+        report.update(sent=10, batches=2, elapsed=2.0)
+        self.assertIn("5.0 messages/second", str(report),
+                      'Throughput not shown')
+
+
+class TestMailBillQueued(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        db.session.flush()
+        self.mail_delivery = app.config.get("MAIL_DELIVERY")
+
+    def tearDown(self):
+
+        app.config["MAIL_DELIVERY"] = self.mail_delivery
+        db.session.rollback()
+        db.session.execute(db.delete(MailDelivery))
+        delete_test_bills(self)
+        delete_test_clients(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_mail_bill_queued(self):
+        """ With mail delivery on, a mail bill is queued when produced """
+
+        app.config["MAIL_DELIVERY"] = True
+        create_physical_bill(self.bll1.bill_id)
+        delivery = db.session.scalars(
+            db.select(MailDelivery).
+            where(MailDelivery.bill_id == self.bll1.bill_id)).one()
+        self.assertEqual(delivery.name, "mail" + str(self.bll1.bill_id),
+                         'Name of message wrong')
+        self.assertIn("Subject: Your bill", delivery.message,
+                      'Message not stored')
+
+    def test_mail_bill_not_queued(self):
+        """ Without mail delivery, a mail bill is not queued """
+
+        app.config["MAIL_DELIVERY"] = None
+        create_physical_bill(self.bll1.bill_id)
+        self.assertEqual(MailDelivery.backlog(), 0, 'Message queued')
+
+
+if __name__ == '__main__':
+    unittest.main()
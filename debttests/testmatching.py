@@ -0,0 +1,222 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import random
+from datetime import date
+from xml.sax import parse
+from sqlalchemy import func
+from debtors import app, db
+from debtmodels.payments import (IncomingAmounts, AmountQueued,
+                                 AssignedAmounts)
+from debtmodels.debtbilling import Bills, BillLines
+from debtmodels.matching import BatchMatcher
+from debtmodels.changes import ChangeLog
+from debtmodels.allocation import (greedy_allocation, best_fit_allocation,
+                                   allocation_strategy, UnknownStrategyError)
+from debtors.processCAMT import CAMT53Handler
+from debttests.helpers import (delete_test_clients, add_addresses,
+    create_clients, create_bills, add_lines_to_bills, delete_test_bills,
+    delete_test_prefs, delete_imported_statements)
+
+
+class TestAllocation(unittest.TestCase):
+
+    def test_greedy_largest_first(self):
+        """ Greedy pays the largest bills that fit """
+
+        self.assertEqual(greedy_allocation([50, 40, 30, 30], 100), [0, 1],
+                         'Wrong bills chosen')
+
+    def test_best_fit_exact(self):
+        """ Best fit finds the bills that add up to the payment """
+
+        chosen = best_fit_allocation([50, 40, 30, 30], 100)
+        self.assertEqual(sum([50, 40, 30, 30][index] for index in chosen),
+                         100, 'No exact match found')
+
+    def test_best_fit_smallest_remainder(self):
+        """ Without an exact match the remainder is as small as can be """
+
+        totals = [700, 400, 345, 340]
+        chosen = best_fit_allocation(totals, 1090)
+        self.assertEqual(sum(totals[index] for index in chosen), 1085,
+                         'Remainder not minimal')
+
+    def test_best_fit_never_worse(self):
+        """ Best fit uses at least as much of the payment as greedy """
+
+        generator = random.Random(8)
+        for _ in range(50):
+            totals = sorted((generator.randint(1, 5000) for _ in range(30)),
+                            reverse=True)
+            amount = generator.randint(1, 40000)
+            greedy = sum(totals[index]
+                         for index in greedy_allocation(totals, amount))
+            chosen = best_fit_allocation(totals, amount)
+            best = sum(totals[index] for index in chosen)
+            self.assertGreaterEqual(best, greedy, 'Worse than greedy')
+            self.assertLessEqual(best, amount, 'More than the payment')
+            self.assertEqual(len(chosen), len(set(chosen)),
+                             'Bill paid twice')
+
+    def test_search_bounded(self):
+        """ If the search is too large, greedy is used """
+
+        self.assertEqual(best_fit_allocation([50, 40, 30, 30], 100,
+                                             max_bits=10),
+                         [0, 1], 'Search not bounded')
+
+    def test_unknown_strategy(self):
+        """ An unknown strategy is refused """
+
+        with self.assertRaises(UnknownStrategyError):
+            allocation_strategy('random')
+
+
+class TestBatchMatcher(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        for number_of, unit_price in ((5, 2), (2, 116), (1, 10)):
+            bill = Bills(billing_ccy='JPY',
+                         date_sale=date(year=2020, month=2, day=16),
+                         date_bill=date(year=2020, month=2, day=16),
+                         status='issued')
+            bill.lines.append(BillLines(short_desc='sec bill',
+                                        number_of=number_of,
+                                        unit_price=unit_price))
+            bill.client = self.clt5
+            bill.add()
+        db.session.flush()
+        with open('debttests/SEPA transacties test assignment.xml') as infile:
+            parse(infile, CAMT53Handler())
+        self.ia01 = IncomingAmounts(payment_ccy='JPY',
+                                    creditor_iban='NL76INGB0594788005',
+                                    payment_amount=1890)
+        self.ia01.add()
+        self.ia02 = IncomingAmounts(payment_ccy='JPY',
+                                    client_ref=f'{self.bll4.bill_id} paid',
+                                    payment_amount=100000)
+        self.ia02.add()
+        db.session.flush()
+
+    def tearDown(self):
+
+        db.session.rollback()
+        delete_test_bills(self)
+        delete_test_prefs(self)
+        delete_test_clients(self)
+        db.session.query(AmountQueued).delete()
+        db.session.query(AssignedAmounts).delete()
+        db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def amounts(self):
+        """ The amounts to assign, in order of id """
+
+        return (db.session.query(IncomingAmounts).
+                order_by(IncomingAmounts.id).all())
+
+    def assignment_rows(self):
+        """ The assignments in the database, to compare """
+
+        return sorted((aa.amount_id, aa.bill_id, aa.ccy, aa.amount_assigned)
+                      for aa in db.session.query(AssignedAmounts).all())
+
+    def one_at_a_time(self, strategy=None):
+        """ Assign with assign_amount and return the results """
+
+        savepoint = db.session.begin_nested()
+        for amount in self.amounts():
+            if (amount.debcred == IncomingAmounts.CREDIT
+                    and not amount.rvslind):
+                amount.assign_amount(strategy)
+        db.session.flush()
+        assignments = self.assignment_rows()
+        amounts = [(amount.id, amount.client_id, amount.fully_assigned)
+                   for amount in self.amounts()]
+        savepoint.rollback()
+        return assignments, amounts
+
+    def test_same_assignments(self):
+        """ The matcher assigns as assign_amount does """
+
+        expected_assignments, expected_amounts = self.one_at_a_time()
+        self.assertTrue(expected_assignments, 'Test has no assignments')
+        BatchMatcher(self.amounts()).assign()
+        self.assertEqual(self.assignment_rows(), expected_assignments,
+                         'Assignments differ')
+        self.assertEqual([(amount.id, amount.client_id,
+                           amount.fully_assigned)
+                          for amount in self.amounts()], expected_amounts,
+                         'Amounts differ')
+
+    def test_bills_paid(self):
+        """ The bills assigned to are paid """
+
+        assignments = BatchMatcher(self.amounts()).assign()
+        for _, bill_id, _, _ in assignments:
+            self.assertEqual(Bills.get_bill_by_id(bill_id).status, 'paid',
+                             'Bill not paid')
+
+    def test_bill_paid_once(self):
+        """ A bill is not paid from two payments in the batch """
+
+        assignments = BatchMatcher(self.amounts()).assign()
+        bill_ids = [bill_id for _, bill_id, _, _ in assignments]
+        self.assertEqual(len(bill_ids), len(set(bill_ids)),
+                         'Bill paid twice')
+
+    def test_changes_logged(self):
+        """ The bulk writes of the matcher are in the change log """
+
+        cursor = db.session.scalar(db.select(func.max(ChangeLog.id)))
+        assignments = BatchMatcher(self.amounts()).assign()
+        logged = {(change.entity, change.entity_id)
+                  for change in ChangeLog.changes_since(cursor)}
+        for amount_id, bill_id, _, _ in assignments:
+            self.assertIn((Bills.CHANGE_ENTITY, bill_id), logged,
+                          'Paid bill not logged')
+            self.assertIn((IncomingAmounts.CHANGE_ENTITY, amount_id), logged,
+                          'Payment not logged')
+        self.assertEqual(len([entity for entity, _ in logged
+                              if entity == AssignedAmounts.CHANGE_ENTITY]),
+                         len(assignments), 'Assignments not logged')
+
+    def test_assigned_amount_skipped(self):
+        """ An amount already assigned is not assigned again """
+
+        BatchMatcher(self.amounts()).assign()
+        matcher = BatchMatcher(self.amounts())
+        self.assertEqual(matcher.assign(), [], 'Assigned again')
+
+    def test_same_assignments_best_fit(self):
+        """ With best fit the matcher assigns as assign_amount does """
+
+        expected_assignments, _ = self.one_at_a_time('best-fit')
+        BatchMatcher(self.amounts(), 'best-fit').assign()
+        self.assertEqual(self.assignment_rows(), expected_assignments,
+                         'Assignments differ')
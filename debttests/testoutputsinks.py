@@ -0,0 +1,221 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import tarfile
+import unittest
+import zipfile
+from tempfile import TemporaryDirectory
+from threading import Thread
+from debtors import app
+from debtviews.outputsinks import (OutputSink, DirectorySink, ZipSink,
+                                   TarSink, JSONLinesSink, output_sink,
+                                   run_output, close_process_sink,
+                                   UnknownOutputSinkError)
+
+
+class TestOutputSinks(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.tempdir = TemporaryDirectory()
+        self.config = {key: app.config.get(key) for key in
+                       ("OUTPUT_SINK", "OUTPUT_DIRECTORY", "OUTPUT_FAN_OUT")}
+        app.config["OUTPUT_DIRECTORY"] = self.tempdir.name
+        close_process_sink()
+
+    def tearDown(self):
+
+        close_process_sink()
+        app.config.update(self.config)
+        self.tempdir.cleanup()
+        self.ctx.pop()
+
+    def test_directory_fan_out(self):
+        """ With a fan out, documents are spread over sub-directories """
+
+        sink = DirectorySink(self.tempdir.name, fan_out=2)
+        sink.write("bill12", "Text of bill 12")
+        path = sink.path("bill12")
+        self.assertEqual(len(os.path.relpath(path, self.tempdir.name).
+                             split(os.sep)), 3, 'Not two levels deep')
+        with open(path) as bill_file:
+            self.assertEqual(bill_file.read(), "Text of bill 12",
+                             'Text not written')
+
+    def test_archives_hold_run(self):
+        """ The zip and tar sinks write all documents to one file """
+
+        with ZipSink(self.tempdir.name, "run") as sink:
+            sink.write("bill1", "One")
+            sink.write("fl2", "Twø")
+        with zipfile.ZipFile(sink.path) as archive:
+            self.assertEqual(archive.namelist(), ["bill1", "fl2"],
+                             'Documents not in zip')
+            self.assertEqual(archive.read("fl2").decode(), "Twø",
+                             'Text in zip wrong')
+        with TarSink(self.tempdir.name, "run") as sink:
+            sink.write("bill1", "One")
+        with tarfile.open(sink.path) as archive:
+            self.assertEqual(archive.extractfile("bill1").read(), b"One",
+                             'Text in tar wrong')
+
+    def test_json_lines(self):
+        """ The jsonl sink writes a line per document """
+
+        with JSONLinesSink(self.tempdir.name, "run") as sink:
+            sink.write("bill1", "One\nline")
+            sink.write("bill2", "Two")
+        with open(sink.path) as lines:
+            documents = [json.loads(line) for line in lines]
+        self.assertEqual(documents[0], {"name": "bill1", "text": "One\nline"},
+                         'Document not written')
+        self.assertEqual(len(documents), 2, 'Not a line per document')
+
+    def test_streamed_documents(self):
+        """ A document written in pieces is the same as written at once """
+
+        pieces = ["{\\rtf1 ", "Zo\"ë\n" * 1000, "}"]
+        with ZipSink(self.tempdir.name, "run") as sink:
+            sink.write_stream("fl1", iter(pieces))
+        with zipfile.ZipFile(sink.path) as archive:
+            self.assertEqual(archive.read("fl1").decode(), "".join(pieces),
+                             'Zip member wrong')
+        with TarSink(self.tempdir.name, "run") as sink:
+            sink.write_stream("fl1", iter(pieces))
+        with tarfile.open(sink.path) as archive:
+            self.assertEqual(archive.extractfile("fl1").read().decode(),
+                             "".join(pieces), 'Tar member wrong')
+        with JSONLinesSink(self.tempdir.name, "run") as sink:
+            sink.write_stream("fl1", iter(pieces))
+        with open(sink.path) as lines:
+            self.assertEqual(json.loads(lines.readline())["text"],
+                             "".join(pieces), 'JSON line wrong')
+
+    def test_failed_stream_not_written(self):
+        """ A document failing while it is written leaves nothing behind """
+
+        def failing_pieces():
+            yield "{\\rtf1 " * 1000
+            raise ValueError("Template failed")
+
+        directory = DirectorySink(self.tempdir.name)
+        with self.assertRaises(ValueError):
+            directory.write_stream("fl1", failing_pieces())
+        self.assertEqual(os.listdir(self.tempdir.name), [],
+                         'File of failed document left')
+        with ZipSink(self.tempdir.name, "run") as sink:
+            with self.assertRaises(ValueError):
+                sink.write_stream("fl1", failing_pieces())
+            sink.write("fl2", "Two")
+        with zipfile.ZipFile(sink.path) as archive:
+            self.assertEqual(archive.namelist(), ["fl2"],
+                             'Member of failed document left')
+        with TarSink(self.tempdir.name, "run") as sink:
+            with self.assertRaises(ValueError):
+                sink.write_stream("fl1", failing_pieces())
+        with tarfile.open(sink.path) as archive:
+            self.assertEqual(archive.getnames(), [],
+                             'Member of failed document left')
+        with JSONLinesSink(self.tempdir.name, "run") as sink:
+            with self.assertRaises(ValueError):
+                sink.write_stream("fl1", failing_pieces())
+            sink.write("fl2", "Two")
+        with open(sink.path) as lines:
+            self.assertEqual([json.loads(line)["name"] for line in lines],
+                             ["fl2"], 'Line of failed document left')
+
+    def test_run_output_from_config(self):
+        """ A run writes to its own sink of the configured kind """
+
+        app.config["OUTPUT_SINK"] = "zip"
+        with run_output("night") as sink:
+            self.assertIs(output_sink(), sink, 'Sink of run not used')
+            output_sink().write("bill1", "One")
+        self.assertIsNot(output_sink(), sink, 'Sink of run still used')
+        with zipfile.ZipFile(os.path.join(self.tempdir.name,
+                                          "night.zip")) as archive:
+            self.assertEqual(archive.read("bill1"), b"One",
+                             'Document not in sink of run')
+
+    def test_configured_sink_outside_run(self):
+        """ Outside of a run, in other threads too, the sink of the process
+        is of the configured kind """
+
+        app.config["OUTPUT_SINK"] = "zip"
+        process_sink = output_sink()
+        self.assertIsInstance(process_sink, ZipSink,
+                              'Configured sink not used outside of a run')
+        process_sink.write("bill1", "One")
+        in_thread = []
+        with run_output("night") as sink:
+            thread = Thread(target=lambda: in_thread.append(output_sink()))
+            thread.start()
+            thread.join()
+        self.assertIsNot(in_thread[0], sink, 'Sink of run used by thread')
+        self.assertIs(in_thread[0], process_sink,
+                      'Thread not writing to sink of process')
+        close_process_sink()
+        with zipfile.ZipFile(process_sink.path) as archive:
+            self.assertEqual(archive.read("bill1"), b"One",
+                             'Document not in sink of process')
+
+    def test_sink_must_write(self):
+        """ A sink that cannot write documents cannot be created """
+
+        class NoWriteSink(OutputSink):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoWriteSink()
+
+    def test_threads_write_archive(self):
+        """ Documents written from more threads at once are all readable """
+
+        def write_documents(thread_number):
+            for number in range(25):
+                sink.write_stream(f"bill{thread_number}-{number}",
+                                  iter(["One ", "and ", str(number)]))
+
+        with ZipSink(self.tempdir.name, "run") as sink:
+            threads = [Thread(target=write_documents, args=(thread_number,))
+                       for thread_number in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        with zipfile.ZipFile(sink.path) as archive:
+            self.assertIsNone(archive.testzip(), 'Archive corrupted')
+            self.assertEqual(len(archive.namelist()), 200,
+                             'Documents missing')
+            self.assertEqual(archive.read("bill7-24"), b"One and 24",
+                             'Document wrong')
+
+    def test_unknown_sink_fails(self):
+        """ A sink that does not exist is refused """
+
+        app.config["OUTPUT_SINK"] = "floppy"
+        with self.assertRaises(UnknownOutputSinkError):
+            with run_output():
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
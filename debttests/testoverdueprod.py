@@ -37,7 +37,9 @@ from debtviews.overdue_processors import (FirstLetterProcessor,
                                            BagatelleAccounting)
 from debtmodels.debtbilling import Bills, BillLines, DebtorSignal
 from debtmodels.payments import (IncomingAmounts, AssignedAmounts)
-from debtviews.physicaloverdue import PaperLetter, OverdueDictView
+from debtviews.physicaloverdue import (PaperLetter, OverdueDictView,
+                                       HTMLMailFirstOverdue)
+from debtviews.rendering import rendering_pool, render_documents
 
 
 class TestCreateOverdueDict(unittest.TestCase):
@@ -137,6 +139,23 @@ class TestCreateOverdueDict(unittest.TestCase):
         self.assertEqual(self.bll7.date_bill.strftime("%d %B %Y"), 
                          bill7["date_bill"], "Bill date not correct")
 
+    def test_letters_rendered_in_pool(self):
+        """ Letters and mails are rendered from a plain view by workers """
+
+        bill_id = self.bll4.bill_id
+        view = dict(OverdueDictView(bill_id=bill_id))
+        documents = [("fl", PaperLetter, ("firstletter.rtf",), view),
+                     ("mailfom", HTMLMailFirstOverdue, (bill_id,), view)]
+        with rendering_pool(2) as pool:
+            rendered = list(render_documents(documents, pool))
+        self.assertEqual([error for _, _, error in rendered], [None, None],
+                         'Rendering failed')
+        self.assertEqual(rendered[0][1],
+                         PaperLetter("firstletter.rtf", view=view).text,
+                         'Letter rendered differently')
+        self.assertIn(self.mad05.mail_address, rendered[1][1],
+                      'Mail not addressed')
+
 
 class TestCreateFirstLetterProcessor(unittest.TestCase):
 
@@ -16,22 +16,36 @@
 #    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import os
+import re
+import gzip
+import shutil
+import zipfile
+from tempfile import TemporaryDirectory
 from datetime import datetime, date
 from dateutil import parser
 from dateutil.tz import tzoffset
 from werkzeug.datastructures import ImmutableMultiDict
 from debtviews.monetary import edited_amount
 from debtors import app, db
-from debtmodels.payments import IncomingAmounts, AmountQueued, AssignedAmounts
+from debtmodels.payments import (IncomingAmounts, AmountQueued, AssignedAmounts,
+                                 IncomingAmountsBatch, ImportedStatements,
+                                 IncomingAmountInvalidCcyError,
+                                 StatementNotIdentifiedError,
+                                 StatementChangedError)
 from debtmodels.debtbilling import Bills, BillLines
 from debtviews.payments import (PaymentAccounting, AssignmentAccounting,
                                 PaymentReversalAccounting,
                                 AssignmentReversalAccounting)
 from debttests.helpers import (delete_test_clients, add_addresses,
     create_clients, spread_created_at, create_bills, add_lines_to_bills,
-    delete_test_bills, delete_amountq, delete_test_prefs)
-from debtors.processCAMT import CAMT53Handler
-from xml.sax import ContentHandler, make_parser, parse
+    delete_test_bills, delete_amountq, delete_test_prefs,
+    delete_imported_statements)
+from debtors.processqueue import AssignmentWorker
+from debtors.processCAMT import (CAMT53Handler, process_statement_files,
+                                 import_statement_file)
+from xml.sax import ContentHandler, make_parser, parse, parseString
+from sqlalchemy import event, update
 
 
 class TestCreatePayment(unittest.TestCase):
@@ -231,6 +245,43 @@ class TestCAMTEntryHandler(unittest.TestCase):
                             None, 
                             f'Our reference incorrect: {unassigned.our_ref}')
 
+    def test_text_in_parts(self):
+        """ Text the parser delivers in parts is processed as a whole """
+
+        with open('debttests/SEPA credit entry.xml', 'rb') as sce:
+            for piece in iter(lambda: sce.read(7), b''):
+                self.parser.feed(piece)
+            self.parser.close()
+        unassigned = self.camthandler.unassigned_amount
+        self.assertEqual(unassigned.payment_amount, 35000,
+                         'Wrong amount parsed')
+        self.assertEqual(unassigned.bank_ref,
+                         '011111333306999888000000008',
+                         'Wrong bank reference  parsed')
+        self.assertEqual(unassigned.client_name, 'ING Testrekening',
+                         'Wrong client name  parsed')
+
+    def test_other_amounts_ignored(self):
+        """ Only the amount of the entry is the payment amount """
+
+        entry = ('<Ntry><Amt Ccy="EUR">350.00</Amt><NtryDtls><TxDtls>'
+                 '<AmtDtls><InstdAmt><Amt Ccy="USD">400.00</Amt></InstdAmt>'
+                 '</AmtDtls></TxDtls></NtryDtls></Ntry>')
+        self.parser.feed(entry)
+        self.parser.close()
+        unassigned = self.camthandler.unassigned_amount
+        self.assertEqual(unassigned.payment_amount, 35000,
+                         'Wrong amount parsed')
+        self.assertEqual(unassigned.payment_ccy, 'EUR',
+                         'Wrong currency parsed')
+
+    def test_invalid_currency_fails(self):
+        """ An entry with an invalid currency is refused """
+
+        entry = '<Ntry><Amt Ccy="XYZ">350.00</Amt></Ntry>'
+        with self.assertRaises(IncomingAmountInvalidCcyError):
+            self.parser.feed(entry)
+
 
 class TestMoreTransactions(unittest.TestCase):
 
@@ -250,6 +301,7 @@ class TestMoreTransactions(unittest.TestCase):
         self.infile.close()
         delete_amountq(self)
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -314,6 +366,30 @@ class TestMoreTransactions(unittest.TestCase):
         one_amount = db.session.query(IncomingAmounts).filter_by(bank_ref='011111333306999888000000008').first()
         self.assertTrue(one_amount, "No entry for bank reference")
 
+    def test_root_entry_stored(self):
+        """ An entry that is the root of the message is stored at once """
+
+        handler = CAMT53Handler()
+        with open('debttests/SEPA credit entry.xml') as sce:
+            parse(sce, handler)
+        self.assertEqual(handler.entries_stored, 1, 'Entry not counted')
+        amount = db.session.query(IncomingAmounts).one()
+        self.assertEqual((amount.bank_ref, amount.payment_amount),
+                         ('011111333306999888000000008', 35000),
+                         'Wrong entry stored')
+        self.assertTrue(AmountQueued.is_queued(amount.id), 'Entry not queued')
+
+    def test_entries_not_in_session(self):
+        """ The entries are inserted without model instances """
+
+        parse(self.infile, self.camthandler)
+        self.assertFalse([instance for instance in db.session
+                          if isinstance(instance, IncomingAmounts)],
+                         'Entries kept in the session')
+        self.assertTrue(AmountQueued.is_queued(
+            db.session.query(IncomingAmounts).first().id),
+            'Entry not queued')
+
     def test_reversal_indicator_set(self):
         """ We translate the reversal indicator from CAMT053 """
 
@@ -325,6 +401,354 @@ class TestMoreTransactions(unittest.TestCase):
             self.assertEqual(entry[0], "Db", "Entry not debit")
             self.assertEqual(entry[1], True, "Entry no reversal")
 
+    def test_statement_fingerprint_stored(self):
+        """ The fingerprint of an imported statement is stored """
+
+        parse(self.infile, self.camthandler)
+        imported = db.session.query(ImportedStatements).one()
+        self.assertEqual(imported.account_iban, 'NL08INGB0000001234',
+                         'Wrong account in fingerprint')
+        self.assertEqual(imported.statement_id, '201401030009999',
+                         'Wrong statement id in fingerprint')
+        self.assertEqual(len(imported.content_hash), 64, 'No content hash')
+
+    def test_statement_imported_once(self):
+        """ Importing a statement again does not store it again """
+
+        parse(self.infile, self.camthandler)
+        handler = CAMT53Handler()
+        parse('debttests/ING transactievoorbeelden.xml', handler)
+        self.assertEqual(handler.statements_skipped, 1,
+                         'Statement not skipped')
+        self.assertEqual(handler.entries_stored, 0, 'Entries stored again')
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 6,
+                         'Entries stored twice')
+
+    def test_changed_statement_reported(self):
+        """ A statement imported before with other entries is an error """
+
+        parse(self.infile, self.camthandler)
+        handler = CAMT53Handler()
+        with self.assertRaises(StatementChangedError):
+            parse('debttests/SEPA transacties test assignment.xml', handler)
+        db.session.rollback()
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 6,
+                         'Entries of changed statement stored')
+
+    def test_statement_without_account_refused(self):
+        """ A statement without an account cannot be recognised later """
+
+        message = re.sub(r'<Acct>.*?</Acct>', '', self.infile.read(),
+                         count=1, flags=re.DOTALL)
+        with self.assertRaises(StatementNotIdentifiedError):
+            parseString(message.encode(), self.camthandler)
+        db.session.rollback()
+        self.assertEqual(db.session.query(ImportedStatements).count(), 0,
+                         'Statement without account imported')
+
+    def test_entries_stored_before(self):
+        """ Entries stored before from another statement are skipped """
+
+        parse(self.infile, self.camthandler)
+        with open('debttests/ING transactievoorbeelden.xml') as infile:
+            resent = infile.read().replace('2014-01-04T01:55:04.378',
+                                           '2014-01-05T02:12:00.000')
+        handler = CAMT53Handler()
+        parser = make_parser()
+        parser.setContentHandler(handler)
+        parser.feed(resent)
+        parser.close()
+        self.assertEqual(handler.entries_skipped, 6, 'Entries not skipped')
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 6,
+                         'Entries stored twice')
+
+    def test_entries_checked_in_one_query(self):
+        """ The entries of a statement are checked in one query """
+
+        parse(self.infile, self.camthandler)
+        with open('debttests/ING transactievoorbeelden.xml') as infile:
+            resent = infile.read().replace('2014-01-04T01:55:04.378',
+                                           '2014-01-05T02:12:00.000')
+        statements = []
+        def keep_statement(conn, cursor, statement, *args):
+            if 'FROM payments' in statement:
+                statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", keep_statement)
+        try:
+            parser = make_parser()
+            parser.setContentHandler(CAMT53Handler())
+            parser.feed(resent)
+            parser.close()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", keep_statement)
+        self.assertEqual(len(statements), 1, 'Entries checked one by one')
+
+    def test_entries_without_timestamp_stored_before(self):
+        """ Entries of a statement without a timestamp are also skipped """
+
+        parse(self.infile, self.camthandler)
+        with open('debttests/ING transactievoorbeelden.xml') as infile:
+            resent = re.sub('<CreDtTm>[^<]*</CreDtTm>', '', infile.read())
+        handler = CAMT53Handler()
+        parser = make_parser()
+        parser.setContentHandler(handler)
+        parser.feed(resent)
+        parser.close()
+        self.assertEqual(handler.entries_skipped, 6, 'Entries not skipped')
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 6,
+                         'Entries stored twice')
+
+
+class TestBatchedTransactions(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.camthandler = CAMT53Handler(batch_size=4)
+        self.infile = open('debttests/ING transactievoorbeelden.xml', 'r')
+
+    def tearDown(self):
+
+        self.camthandler = None
+        self.infile.close()
+        db.session.rollback()
+        delete_amountq(self)
+        db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_all_entries_stored(self):
+        """ All entries are stored when inserting in batches """
+
+        parse(self.infile, self.camthandler)
+        self.assertEqual(len(self.camthandler.entries), 6,
+                         'Too many/little entries')
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 6,
+                         'Not all entries stored')
+
+    def test_all_entries_queued(self):
+        """ Each entry stored in batches is queued for assignment """
+
+        parse(self.infile, self.camthandler)
+        for amount in db.session.query(IncomingAmounts).all():
+            self.assertTrue(AmountQueued.is_queued(amount.id),
+                            f'Amount {amount.id} not queued')
+
+    def test_entry_data_stored(self):
+        """ The data of an entry is stored and defaults are filled """
+
+        parse(self.infile, self.camthandler)
+        one_amount = db.session.query(IncomingAmounts).\
+            filter_by(bank_ref='011111333306999888000000008').first()
+        self.assertEqual(one_amount.payment_amount, 35000,
+                         'Wrong amount stored')
+        self.assertEqual(one_amount.debcred, 'Cr', 'Wrong debit/credit')
+        self.assertFalse(one_amount.rvslind, 'Reversal indicator not filled')
+
+    def test_entries_queued_without_returning(self):
+        """ Without RETURNING from the database, each entry is queued once """
+
+        engine = db.session.get_bind()
+        dialect = engine.dialect
+        flag = "insert_executemany_returning_sort_by_parameter_order"
+        returning = getattr(dialect, flag)
+        setattr(dialect, flag, False)
+        inserts = []
+        def count_insert(conn, cursor, statement, parameters, context,
+                         executemany):
+            if statement.startswith("INSERT INTO payments"):
+                inserts.append(statement)
+        event.listen(engine, "before_cursor_execute", count_insert)
+        try:
+            parse(self.infile, self.camthandler)
+        finally:
+            event.remove(engine, "before_cursor_execute", count_insert)
+            setattr(dialect, flag, returning)
+        amount_ids = sorted(amount.id for amount in
+                            db.session.query(IncomingAmounts).all())
+        queued_ids = sorted(queued.amount_id for queued in
+                            db.session.query(AmountQueued).all())
+        self.assertEqual(len(amount_ids), 6, 'Not all entries stored')
+        self.assertEqual(queued_ids, amount_ids, 'Entries not queued once')
+        self.assertEqual(len(inserts), 2, 'Not one insert per batch')
+
+    def test_statement_for_wrong_account(self):
+        """ A statement for a wrong account is not stored in batches """
+
+        self.camthandler.accounts = ['NL21INGB0001234568']
+        parse(self.infile, self.camthandler)
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 0,
+                         'Entries stored for wrong account')
+
+    def test_failing_statement_not_stored(self):
+        """ If the statement fails after a batch was inserted, nothing
+        of the statement is stored """
+
+        self.camthandler.batch_size = 2
+        batch_insert = IncomingAmountsBatch.insert_batch
+        def insert_then_fail(batch):
+            if batch.stored:
+                raise ValueError("Failure after first batch")
+            batch_insert(batch)
+        IncomingAmountsBatch.insert_batch = insert_then_fail
+        try:
+            with self.assertRaises(ValueError):
+                parse(self.infile, self.camthandler)
+        finally:
+            IncomingAmountsBatch.insert_batch = batch_insert
+        db.session.rollback()
+        self.assertEqual(db.session.query(IncomingAmounts).count(), 0,
+                         'Part of statement stored')
+
+
+class TestStatementFiles(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.tempdir = TemporaryDirectory()
+        shutil.copy('debttests/ING transactievoorbeelden.xml',
+                    self.tempdir.name)
+        # the second statement needs a fingerprint of its own
+        with open('debttests/SEPA transacties test assignment.xml') as sf,\
+                open(os.path.join(self.tempdir.name, 'sepa.xml'), 'w') as tf:
+            tf.write(sf.read().replace('<Id>201401030009999</Id>',
+                                       '<Id>201401030009998</Id>'))
+        with open(os.path.join(self.tempdir.name, 'broken.xml'), 'w') as bf:
+            bf.write('<Document><Stmt><Id>1</Id>')
+
+    def tearDown(self):
+
+        self.tempdir.cleanup()
+        db.session.rollback()
+        delete_amountq(self)
+        db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_all_files_processed(self):
+        """ The entries of all good files are stored """
+
+        report = process_statement_files(self.tempdir.name, workers=2)
+        self.assertEqual(report.files, 3, 'Not all files processed')
+        self.assertEqual(report.statements, 2, 'Wrong number of statements')
+        self.assertEqual(db.session.query(IncomingAmounts).count(),
+                         report.entries, 'Report does not match database')
+        self.assertEqual(db.session.query(AmountQueued).count(),
+                         report.entries, 'Entries not queued')
+
+    def test_failing_file_reported(self):
+        """ A failing file is reported, the others are stored """
+
+        report = process_statement_files(self.tempdir.name, workers=2)
+        broken = os.path.join(self.tempdir.name, 'broken.xml')
+        self.assertEqual(report.failed, [broken], 'Failure not reported')
+        self.assertTrue(report[broken]['error'], 'No error message')
+        ing = os.path.join(self.tempdir.name,
+                           'ING transactievoorbeelden.xml')
+        self.assertEqual(report[ing]['entries'], 6,
+                         'Good file influenced by failing one')
+
+    def test_account_filter_in_workers(self):
+        """ The accounts to process are passed to the workers """
+
+        report = process_statement_files(self.tempdir.name,
+                                         accounts=['NL21INGB0001234568'],
+                                         workers=2)
+        self.assertEqual(report.entries, 0, 'Entries for wrong account')
+
+    def test_progress_per_file(self):
+        """ Progress is reported for each file """
+
+        done = []
+        process_statement_files(self.tempdir.name, workers=2,
+                                progress=done.append)
+        self.assertEqual(len(done), 3, 'Progress not reported per file')
+
+
+class TestCompressedStatements(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.camthandler = CAMT53Handler()
+        self.tempdir = TemporaryDirectory()
+        self.ing_file = 'debttests/ING transactievoorbeelden.xml'
+        self.sepa_file = 'debttests/SEPA transacties test assignment.xml'
+
+    def tearDown(self):
+
+        self.tempdir.cleanup()
+        db.session.rollback()
+        delete_amountq(self)
+        db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_plain_file(self):
+        """ A plain statement file is imported """
+
+        import_statement_file(self.ing_file, self.camthandler)
+        self.assertEqual(self.camthandler.entries_stored, 6,
+                         'Wrong number of entries stored')
+
+    def test_gzipped_file(self):
+        """ A gzipped statement file is imported """
+
+        gz_name = os.path.join(self.tempdir.name, 'statement.xml.gz')
+        with open(self.ing_file, 'rb') as infile,\
+                gzip.open(gz_name, 'wb') as gz_file:
+            shutil.copyfileobj(infile, gz_file)
+        import_statement_file(gz_name, self.camthandler)
+        self.assertEqual(self.camthandler.entries_stored, 6,
+                         'Wrong number of entries stored')
+
+    def test_zip_archive(self):
+        """ All statements in a zip archive are imported """
+
+        zip_name = os.path.join(self.tempdir.name, 'statements.zip')
+        with zipfile.ZipFile(zip_name, 'w',
+                             compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.write(self.ing_file, 'ing.xml')
+            archive.write(self.ing_file, 'ing again.xml')
+        import_statement_file(zip_name, self.camthandler)
+        # the second statement was imported with the first
+        self.assertEqual(self.camthandler.statements_stored
+                         + self.camthandler.statements_skipped, 2,
+                         'Not all statements in the archive processed')
+        self.assertEqual(db.session.query(IncomingAmounts).count(),
+                         self.camthandler.entries_stored,
+                         'Entries not stored')
+
+    def test_gzipped_member_of_zip(self):
+        """ A gzipped statement in a zip archive is imported """
+
+        gz_name = os.path.join(self.tempdir.name, 'ing.xml.gz')
+        with open(self.ing_file, 'rb') as infile,\
+                gzip.open(gz_name, 'wb') as gz_file:
+            shutil.copyfileobj(infile, gz_file)
+        zip_name = os.path.join(self.tempdir.name, 'statements.zip')
+        with zipfile.ZipFile(zip_name, 'w') as archive:
+            archive.write(gz_name, 'ing.xml.gz')
+        import_statement_file(zip_name, self.camthandler)
+        self.assertEqual(self.camthandler.entries_stored, 6,
+                         'Wrong number of entries stored')
+
+    def test_report_from_archive(self):
+        """ Archives can be processed in parallel """
+
+        zip_name = os.path.join(self.tempdir.name, 'statements.zip')
+        with zipfile.ZipFile(zip_name, 'w') as archive:
+            archive.write(self.ing_file, 'ing.xml')
+        report = process_statement_files([zip_name], workers=1)
+        self.assertEqual(report.entries, 6, 'Entries not reported')
+
 
 class TestAssignAmounts(unittest.TestCase):
 
@@ -568,6 +992,7 @@ class TestAssignment(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -877,6 +1302,102 @@ class TestAssignment(unittest.TestCase):
         self.assertNotIn(ia64, ial12, "Reversible item other ccy returned")
 
 
+class TestAssignmentWorker(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        add_lines_to_bills(self)
+        db.session.flush()
+        with open('debttests/SEPA transacties test assignment.xml') as infile:
+            parse(infile, CAMT53Handler())
+        self.queued = db.session.query(AmountQueued).count()
+
+    def tearDown(self):
+
+        db.session.rollback()
+        delete_test_bills(self)
+        delete_test_prefs(self)
+        delete_test_clients(self)
+        db.session.query(AmountQueued).delete()
+        db.session.query(AssignedAmounts).delete()
+        db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_queue_drained(self):
+        """ The worker empties the queue """
+
+        report = AssignmentWorker(batch_size=2).run()
+        self.assertEqual(report['processed'], self.queued,
+                         'Not all queued amounts processed')
+        self.assertEqual(report['backlog'], 0, 'Backlog not reported')
+        self.assertEqual(db.session.query(AmountQueued).count(), 0,
+                         'Queue not empty')
+
+    def test_amounts_assigned(self):
+        """ The worker assigns the amounts it takes from the queue """
+
+        report = AssignmentWorker().run()
+        ia01 = db.session.query(IncomingAmounts).\
+            filter_by(bank_ref='011111333306999888000000008').first()
+        self.assertTrue(ia01.fully_assigned, 'Amount not assigned')
+        self.assertEqual(ia01.used_in[0].bill.status, 'paid',
+                         'Bill not paid')
+        self.assertGreaterEqual(report['assigned'], 1,
+                                'Assignments not reported')
+
+    def test_claims_do_not_overlap(self):
+        """ Amounts claimed are not claimed again """
+
+        first_claim = AmountQueued.claim(2)
+        second_claim = AmountQueued.claim(100)
+        self.assertEqual(len(first_claim), 2, 'Wrong number claimed')
+        self.assertFalse(set(first_claim) & set(second_claim),
+                         'Amount claimed twice')
+        self.assertEqual(len(first_claim) + len(second_claim), self.queued,
+                         'Not all amounts claimed')
+
+    def test_claim_delete_without_limit(self):
+        """ The claimed entries are deleted by id, not with a LIMIT """
+
+        statements = []
+
+        def keep_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", keep_statement)
+        try:
+            AmountQueued.claim(2)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", keep_statement)
+        deletes = [statement for statement in statements
+                   if statement.lstrip().upper().startswith("DELETE")]
+        self.assertEqual(len(deletes), 1, 'Claimed entries not deleted')
+        self.assertNotIn("LIMIT", deletes[0].upper(), 'LIMIT in DELETE')
+
+    def test_rollback_returns_claim(self):
+        """ Claimed amounts are back in the queue after a rollback """
+
+        AmountQueued.claim(2)
+        db.session.rollback()
+        self.assertEqual(AmountQueued.backlog(), self.queued,
+                         'Claimed amounts not back in queue')
+
+    def test_max_batches(self):
+        """ The worker stops after the maximum number of batches """
+
+        report = AssignmentWorker(batch_size=1).run(max_batches=2)
+        self.assertEqual(report['processed'], 2, 'Too many processed')
+        self.assertEqual(report['backlog'], self.queued - 2,
+                         'Wrong backlog')
+
+
 class TestAssignToPayment(unittest.TestCase):
 
     def setUp(self):
@@ -921,6 +1442,7 @@ class TestAssignToPayment(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -1268,6 +1790,7 @@ class TestAssignmentReversal(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -1411,6 +1934,64 @@ class TestAssignmentReversal(unittest.TestCase):
                          "Incorrect external key")
         self.assertEqual(len(ara01["journal"]["postings"]), 2, "Wrong number of postings")
 
+    def test_assigned_total_kept(self):
+        """ Assigning and reversing keep the assigned total up to date """
+
+        ia107 = IncomingAmounts(payment_ccy='JPY',
+                                payment_amount=2535,
+                                creditor_iban= 'NL08INGB0212977817',
+                                client_name='T. Heerziel',
+                                our_ref='Ref 4assi',
+                                bank_ref='11990')
+        ia107.add()
+        db.session.flush()
+        aa33 = ia107.assign_to_bill(self.bll4)
+        db.session.flush()
+        self.assertEqual(ia107.assigned_total, 1880, 'Assigned total wrong')
+        self.assertEqual(ia107.open_amount, 655, 'Open amount wrong')
+        ia107.reverse_assignment(aa33)
+        db.session.flush()
+        self.assertEqual(ia107.assigned_total, 0, 'Reversal not subtracted')
+
+    def test_open_amount_in_query(self):
+        """ Payments with an open amount can be selected in SQL """
+
+        ia108 = IncomingAmounts(payment_ccy='JPY',
+                                payment_amount=1880,
+                                our_ref='Ref 5assi')
+        ia108.add()
+        db.session.flush()
+        ia108.assign_to_bill(self.bll4)
+        db.session.flush()
+        open_payments = (db.session.query(IncomingAmounts).
+                         filter(IncomingAmounts.open_amount > 0).all())
+        self.assertNotIn(ia108, open_payments, 'Assigned payment is open')
+        self.assertIn(self.ia95, open_payments, 'Open payment missing')
+
+    def test_backfill_assigned_totals(self):
+        """ A wrong assigned total is reported and recomputed """
+
+        ia109 = IncomingAmounts(payment_ccy='JPY',
+                                payment_amount=2535,
+                                our_ref='Ref 6assi')
+        ia109.add()
+        db.session.flush()
+        ia109.assign_to_bill(self.bll4)
+        db.session.flush()
+        ia109_id = ia109.id
+        db.session.execute(update(IncomingAmounts).
+                           where(IncomingAmounts.id == ia109_id).
+                           values(assigned_total=5))
+        self.assertIn((ia109_id, 5, 1880),
+                      IncomingAmounts.wrong_assigned_totals(),
+                      'Wrong total not reported')
+        self.assertGreaterEqual(IncomingAmounts.backfill_assigned_totals(), 1,
+                                'Nothing updated')
+        self.assertEqual(IncomingAmounts.wrong_assigned_totals(), [],
+                         'Totals still wrong')
+        self.assertEqual(IncomingAmounts.get_payment_by_id(ia109_id).
+                         assigned_total, 1880, 'Total not recomputed')
+
 
 class TestAssignmentReversalTransactions(unittest.TestCase):
 
@@ -1458,6 +2039,7 @@ class TestAssignmentReversalTransactions(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -1577,6 +2159,7 @@ class TestPaymentAccounting(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -1724,6 +2307,7 @@ class TestPaymentTransactions(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -1953,6 +2537,7 @@ class TestPaymentAssignToPayment(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -2115,6 +2700,7 @@ class TestPaymentReversal(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
@@ -2314,6 +2900,7 @@ class TestPaymentsAndDebt(unittest.TestCase):
         db.session.query(AmountQueued).delete()
         db.session.query(AssignedAmounts).delete()
         db.session.query(IncomingAmounts).delete()
+        delete_imported_statements(self)
         db.session.commit()
         self.ctx.pop()
 
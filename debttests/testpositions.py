@@ -26,6 +26,11 @@ from debttests.helpers import (create_clients, create_bills, add_addresses,
                                delete_test_payments, delete_overdue_actions,
                                create_bills_for_positions)
 from debtors import app, db, config
+from debtmodels.debtbilling import Bills
+from debtmodels.positions import (PositionSnapshot, DebtPositions,
+                                  BillPositions, PositionRuns,
+                                  PositionNotFoundError,
+                                  SnapshotOutOfOrderError, age_limits)
 from debtmodels.overdue import (OverdueProcessor, OverdueSteps,
                                 OverdueActions)
 from debtviews.overdue_processors import (FirstLetterProcessor,
@@ -103,6 +108,122 @@ class TestDebtPosition(unittest.TestCase):
         self.assertEqual(recent_debt[self.bll10.billing_ccy],
                          self.bll10.total() + self.bll15.total(),
                          "Currency debt incorrect")
+    def test_all_ages_in_one_go(self):
+        """ The debt of all ages is returned by one call """
+
+        debt_by_age = Bills.debt_by_age([30, 60, 90])
+        self.assertEqual(debt_by_age[0][self.bll10.billing_ccy],
+                         self.bll10.total() + self.bll15.total(),
+                         "Recent debt incorrect")
+        self.assertEqual(debt_by_age[1][self.bll11.billing_ccy],
+                         self.bll11.total(), "Older debt incorrect")
+        self.assertEqual(debt_by_age[2][self.bll12.billing_ccy],
+                         self.bll12.total(), "Worrying debt incorrect")
+
+    def test_same_as_debt_for_period(self):
+        """ The debt by age is what debt_for_period returns """
+
+        older_date = date.today() - timedelta(days=60)
+        young_date = date.today() - timedelta(days=30)
+        self.assertEqual(Bills.debt_by_age([30, 60])[1],
+                         Bills.debt_for_period(older_date, young_date),
+                         "Debt by age differs")
+
+
+class TestPositionSnapshot(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        create_clients(self)
+        add_addresses(self)
+        create_bills(self)
+        create_bills_for_positions(self)
+        add_lines_to_bills(self)
+        db.session.flush()
+
+    def tearDown(self):
+
+        db.session.rollback()
+        db.session.query(DebtPositions).delete()
+        db.session.query(BillPositions).delete()
+        db.session.query(PositionRuns).delete()
+        delete_test_bills(self)
+        delete_test_clients(self)
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_snapshot_as_live(self):
+        """ The snapshot holds the same debt as the live query """
+
+        PositionSnapshot().build()
+        self.assertEqual(DebtPositions.by_age(date.today()),
+                         Bills.debt_by_age(age_limits()),
+                         "Snapshot differs")
+
+    def test_changed_bill_counted_again(self):
+        """ A bill paid after the last run leaves the snapshot """
+
+        yesterday = date.today() - timedelta(days=1)
+        PositionSnapshot(yesterday).build()
+        total = DebtPositions.by_age(yesterday)[0]["EUR"]
+        self.bll10.status = Bills.PAID
+        db.session.flush()
+        snapshot = PositionSnapshot().build()
+        self.assertEqual(DebtPositions.by_age(date.today())[0]["EUR"],
+                         total - self.bll10.total(), "Paid bill counted")
+        self.assertEqual(DebtPositions.by_age(yesterday)[0]["EUR"], total,
+                         "Earlier snapshot changed")
+        self.assertEqual(snapshot.changed, 1, "Unchanged bills counted")
+
+    def test_aged_bills_move(self):
+        """ Incrementally built, bills that aged are in the older bucket """
+
+        PositionSnapshot(date.today() - timedelta(days=25)).build()
+        PositionSnapshot().build()
+        incremental = DebtPositions.by_age(date.today())
+        PositionSnapshot().build_all()
+        self.assertEqual(incremental, DebtPositions.by_age(date.today()),
+                         "Aged bills not moved")
+        self.assertEqual(incremental[1]["EUR"], self.bll11.total(),
+                         "Bill not aged")
+
+    def test_trend(self):
+        """ The trend holds a total for each day with a snapshot """
+
+        yesterday = date.today() - timedelta(days=1)
+        PositionSnapshot(yesterday).build()
+        PositionSnapshot().build()
+        trend = DebtPositions.trend(yesterday, date.today())
+        self.assertEqual([day for day, _ in trend], [yesterday, date.today()],
+                         "Wrong days in trend")
+
+    def test_historical_age_report(self):
+        """ The debt by age of an earlier day is read from the snapshot """
+
+        yesterday = date.today() - timedelta(days=1)
+        PositionSnapshot(yesterday).build()
+        self.bll10.status = Bills.PAID
+        db.session.flush()
+        debt_by_age = DebtByAge(as_of=yesterday)
+        self.assertEqual(debt_by_age.recent_debt()["EUR"],
+                         DebtPositions.by_age(yesterday)[0]["EUR"],
+                         "Not read from the snapshot")
+
+    def test_no_snapshot_fails(self):
+        """ Asking for a day without snapshot fails """
+
+        with self.assertRaises(PositionNotFoundError):
+            DebtPositions.by_age(date.today() - timedelta(days=3))
+
+    def test_snapshot_in_order(self):
+        """ A snapshot cannot be built before the latest one """
+
+        PositionSnapshot().build()
+        with self.assertRaises(SnapshotOutOfOrderError):
+            PositionSnapshot(date.today() - timedelta(days=1)).build()
+
 
 class TestPhysicalReport(unittest.TestCase):
 
@@ -297,6 +418,25 @@ class TestOtherActionsAndTotal(unittest.TestCase):
         debt = debt_by_status.transferred()
         self.assertTrue(debt["EUR"], "No debt for transfers")
 
+    def test_all_steps_in_one_go(self):
+        """ The debt of all steps is returned by one call """
+
+        action_dubious = OverdueActions(date_action=date.today())
+        action_dubious.step = self.st18
+        action_dubious.bill = self.bll13
+        action_dubious.add()
+        db.session.flush()
+        debt_by_step = OverdueActions.debt_by_last_step()
+        self.assertEqual(debt_by_step["transfer"]["EUR"],
+                         self.bll11.total() + self.bll12.total(),
+                         "Transfer debt incorrect")
+        self.assertEqual(debt_by_step["dubious"]["JPY"], self.bll13.total(),
+                         "Debt for other step missing")
+        self.assertEqual([step.processor for step, _
+                          in DebtByStatus().all_steps()],
+                         ["firstletter", "secondletter", "transfer",
+                          "dubious"], "Not all steps in order")
+
 
 class TestPhysicalDebtStatusReport(unittest.TestCase):
 
@@ -344,3 +484,16 @@ class TestPhysicalDebtStatusReport(unittest.TestCase):
         debt_status_report = DebtStatusReport()
         debt_status_report.write_file()
         self.assertTrue(debt_status_report.text, "Create failed")
+
+    def test_other_steps_on_report(self):
+        """ Steps other than letters and transfer are on the report """
+
+        action_dubious = OverdueActions(date_action=date.today())
+        action_dubious.step = self.st18
+        action_dubious.bill = self.bll13
+        action_dubious.add()
+        db.session.flush()
+        debt_status_report = DebtStatusReport()
+        debt_status_report.write_report()
+        self.assertIn(self.st18.step_name, debt_status_report.text,
+                      "Other step not on report")
@@ -15,17 +15,40 @@
 #    You should have received a copy of the GNU Lesser General Public License
 #    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import hashlib
 from datetime import date
-from flask import jsonify, abort, request
+from flask import jsonify, abort, request, Response, stream_with_context
 from flask.views import MethodView
+from sqlalchemy.exc import SQLAlchemyError
 from debtors import config
 from debtmodels.debtbilling import (Bills, db, InvalidDataError,
-                                    DebtorSignal)
+                                    DebtorSignal, ArchivedBills,
+                                    BillNotFoundError, BULK_ERRORS)
 from clientmodels.clients import Clients, db as cdb, NoClientFoundError
 
 
 class ClientBillsView(MethodView):
-    """ A view that enables listings of outstanding bills for a client """
+    """ A view that enables listings of outstanding bills for a client
+
+    The bills are returned in order of bill id. The query string may
+    hold:
+
+        :status: The statuses of the bills to list, repeated or comma
+            separated; default all bills
+        :after: The bill id to start after, the "next" of the previous
+            page
+        :limit: The number of bills on a page, by default API_PAGE_SIZE
+            from the configuration, else 100; at most 1000
+
+    Without after and limit all bills are returned in one list.
+
+    The response has an ETag that changes when the bills or signals of
+    the client change. If it matches If-None-Match, 304 is returned
+    without reading the bills.
+    """
+
+    MAX_PAGE_SIZE = 1000
 
     def get(self, client_number=None):
         """ Get the list of outstanding bills for a client """
@@ -34,7 +57,56 @@ class ClientBillsView(MethodView):
             client = Clients.get_by_id(client_number)
         except NoClientFoundError as ncfe:
             abort(404, str(ncfe))
-        return jsonify(BillListDict(client=client))
+        signals = DebtorSignal.signals_for_client(client)
+        etag = client_bills_etag(client, signals)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        statuses = [status for arg in request.args.getlist("status")
+                    for status in arg.split(",") if status]
+        if "after" not in request.args and "limit" not in request.args:
+            bills = Bills.client_bills_page(client, statuses, None, None)
+            bill_list = BillListDict(client=client, bill_list=bills,
+                                     signals=signals)
+            bill_list["next"] = None
+        else:
+            bill_list = self.bills_page(client, statuses, signals)
+        response = jsonify(bill_list)
+        response.set_etag(etag)
+        return response
+
+    def bills_page(self, client, statuses, signals):
+        """ The page of bills asked for by after and limit """
+
+        try:
+            after = request.args.get("after")
+            after = None if after is None else int(after)
+            limit = int(request.args.get("limit")
+                        or config.get("API_PAGE_SIZE") or 100)
+        except ValueError:
+            abort(400, "after and limit must be numbers")
+        limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+        bills = Bills.client_bills_page(client, statuses, after, limit + 1)
+        bill_list = BillListDict(client=client, bill_list=bills[:limit],
+                                 signals=signals)
+        bill_list["next"] = (bills[limit - 1].bill_id
+                             if len(bills) > limit else None)
+        return bill_list
+
+
+def client_bills_etag(client, signals):
+    """ The ETag for the bills of a client
+
+    It is made from the number of bills and their last change, the
+    name of the client and the signals in force today.
+    """
+
+    version = (client.id, client.initials, client.surname,
+               Bills.client_bills_changed(client), date.today(),
+               sorted((signal.id, signal.date_start, signal.date_end)
+                      for signal in signals))
+    return hashlib.sha1(repr(version).encode()).hexdigest()
 
 
 class BillView(MethodView):
@@ -48,7 +120,10 @@ class BillView(MethodView):
     def get(self, bill_id=None):
         """ Get the bill for the passed in bill_id """
 
-        bill = Bills.get_bill_by_id(bill_id)
+        try:
+            bill = Bills.get_bill_by_id(bill_id)
+        except BillNotFoundError:
+            bill = ArchivedBills.get_bill_by_id(bill_id)
         return jsonify(BillDict(bill))
 
 
@@ -68,6 +143,127 @@ class BillCreateView(MethodView):
         return jsonify(create_success_response({"bill-id" : bill.bill_id}))
 
 
+class BillsBulkCreateView(MethodView):
+    """ This view makes it possible to create many bills in one request
+
+    The body is newline delimited JSON: each line is a bill in the format
+    of Bills.create_from_dict. The bills are created in batches of
+    BILL_BATCH_SIZE (configuration, default 500) bills, each batch in its
+    own transaction. A bill that is in error does not stop the others.
+
+    The response is streamed, also newline delimited JSON. For each line
+    of the request a result is returned once its batch is committed,
+    with the line number and the bill id or the error message. The body
+    is read as the bills are created, so the memory used does not depend
+    on the size of the request.
+    """
+
+    def post(self):
+        """ Post the bills, one per line """
+
+        batch_size = config.get("BILL_BATCH_SIZE") or 500
+        lines = bill_lines(request.stream)
+
+        def results():
+            batch = []
+            for line in lines:
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    yield from batch_results(batch)
+                    batch = []
+            if batch:
+                yield from batch_results(batch)
+
+        return Response(stream_with_context(results()),
+                        mimetype="application/x-ndjson")
+
+
+def bill_lines(stream):
+    """ Read the bill dictionaries from a stream of JSON lines
+
+    Yields the line number with the dictionary or the error reading it.
+    Empty lines are skipped.
+    """
+
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as ve:
+            yield line_number, ve
+
+
+# The errors of a bill, also those raised by the checks at the flush,
+# reported for the bill in the response
+BATCH_ERRORS = BULK_ERRORS + (SQLAlchemyError,)
+
+
+def create_bill_batch(batch):
+    """ Create the bills of a batch and commit them
+
+    Returns a result for each line in the batch: the bill or the error.
+    The bills are created together, in a savepoint, and flushed at once.
+    If the flush fails, on the database or in a check at the flush, the
+    savepoint is rolled back and the bills are
+    created again one at a time, so only the bills in error are left
+    out.
+    """
+
+    try:
+        with db.session.begin_nested(), db.session.no_autoflush:
+            results = create_bills(batch)
+            db.session.flush()
+    except BATCH_ERRORS:
+        return create_bills_one_by_one(batch)
+    db.session.commit()
+    return results
+
+
+def create_bills(batch):
+    """ Create and add the bills of a batch, return a result per line """
+
+    bill_dicts = [bill_dict for _, bill_dict in batch
+                  if not isinstance(bill_dict, Exception)]
+    bills = iter(Bills.create_from_dicts(bill_dicts))
+    results = []
+    for line_number, bill_dict in batch:
+        result = bill_dict if isinstance(bill_dict, Exception) else next(bills)
+        if not isinstance(result, Exception):
+            result.add()
+        results.append((line_number, result))
+    return results
+
+
+def create_bills_one_by_one(batch):
+    """ Create the bills of a batch each in a savepoint, then commit """
+
+    results = []
+    for line in batch:
+        try:
+            with db.session.begin_nested(), db.session.no_autoflush:
+                result = create_bills([line])[0]
+                db.session.flush()
+        except BATCH_ERRORS as error:
+            result = (line[0], error)
+        results.append(result)
+    db.session.commit()
+    return results
+
+
+def batch_results(batch):
+    """ Create the bills of a batch and yield a JSON line per bill """
+
+    for line_number, result in create_bill_batch(batch):
+        if isinstance(result, Exception):
+            response = {"line": line_number, "status": "Bad Request",
+                        "message": str(result)}
+        else:
+            response = create_success_response({"line": line_number,
+                                                "bill-id": result.bill_id})
+        yield json.dumps(response) + "\n"
+
+
 class BillDict(dict):
     """ This class is used to convert a bill to a dictionary
     
@@ -76,7 +272,7 @@ class BillDict(dict):
     solves that issue.
     """
 
-    def __init__(self, bill):
+    def __init__(self, bill, signals=None):
 
         self['bill-id'] = None if bill.bill_id is None\
             else int(bill.bill_id)
@@ -86,7 +282,8 @@ class BillDict(dict):
         if bill.prev_bill:
             self['bill-replaced'] = bill.prev_bill
         self['status'] = bill.STATUS_NAME[bill.status]
-        signals = DebtorSignal.signals_for(bill=bill)
+        if signals is None:
+            signals = DebtorSignal.signals_for(bill=bill)
         if signals:
             dates = [signal.date_start for signal in signals]
             if dates:
@@ -100,21 +297,24 @@ class BillListDict(dict):
     
     The list is a list of bills for one client. We convert the list
     from the model to a (nested) dictionary. This makes it easy
-    to use it in the views
+    to use it in the views. The signals of the client are read once,
+    for all bills, unless they are passed in.
     """
 
-    def __init__(self, client=None, bill_list=None):
+    def __init__(self, client=None, bill_list=None, signals=None):
 
-        if client is not None:
-            bill_list = client.bills
-        elif bill_list:
+        if client is None:
+            if not bill_list:
+                raise TypeError('One of client or bill list must be filled')
             client = bill_list[0].client
-        else:
-            raise TypeError('One of client or bill list must be filled')
+        if bill_list is None:
+            bill_list = client.bills
+        if signals is None:
+            signals = DebtorSignal.signals_for_client(client)
 
         self['client'] = client.id
         self['name'] =  client.initials + ' ' + client.surname
-        self['bills'] = [BillDict(bill) for bill in client.bills]
+        self['bills'] = [BillDict(bill, signals) for bill in bill_list]
 
 def create_success_response(payload):
     """ Create an OK response after a transaction.
@@ -0,0 +1,130 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This file holds the API view on the change log.
+
+External systems read the changes committed since their cursor a page
+at a time, with the entities changed as they are now.
+"""
+
+from collections import defaultdict
+from datetime import date, datetime
+from flask import jsonify, abort, request
+from flask.views import MethodView
+from sqlalchemy import inspect
+from debtors import db, config
+from debtmodels.changes import ChangeLog
+from debtmodels.debtbilling import Bills, DebtorSignal, ArchivedBills
+from debtmodels.payments import (IncomingAmounts, AssignedAmounts,
+                                 ArchivedAssignments)
+from debtmodels.overdue import OverdueActions, ArchivedActions
+
+LOGGED_MODELS = {model.CHANGE_ENTITY: model
+                 for model in (Bills, IncomingAmounts, AssignedAmounts,
+                               OverdueActions, DebtorSignal)}
+ARCHIVED_MODELS = {Bills.CHANGE_ENTITY: ArchivedBills,
+                   AssignedAmounts.CHANGE_ENTITY: ArchivedAssignments,
+                   OverdueActions.CHANGE_ENTITY: ArchivedActions}
+
+
+class ChangesView(MethodView):
+    """ A view that lists the changes after a cursor
+
+    The query string may hold:
+
+        :since: The cursor, the "next" of the previous page; without it
+            the changes are listed from the start
+        :limit: The number of changes on a page, by default
+            CHANGES_PAGE_SIZE from the configuration, else 500; at most
+            5000
+
+    """
+
+    MAX_PAGE_SIZE = 5000
+
+    def get(self):
+        """ Get a page of changes """
+
+        try:
+            since = request.args.get("since")
+            since = None if since is None else int(since)
+            limit = int(request.args.get("limit")
+                        or config.get("CHANGES_PAGE_SIZE") or 500)
+        except ValueError:
+            abort(400, "since and limit must be numbers")
+        limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+        changes = ChangeLog.committed_since(since, limit)
+        return jsonify(ChangeListDict(changes, since, limit))
+
+
+class ChangeListDict(dict):
+    """ This class converts a page of changes to a dictionary
+
+    The entities changed are read with one query for each kind of
+    entity. An entity deleted has no data.
+    """
+
+    def __init__(self, changes, since=None, limit=None):
+
+        entities = changed_entities(changes)
+        self["changes"] = [
+            {"cursor": change.position,
+             "entity": change.entity,
+             "id": change.entity_id,
+             "operation": change.operation,
+             "changed-at": change.changed_at.isoformat(),
+             "data": entities.get((change.entity, change.entity_id))}
+            for change in changes]
+        self["next"] = changes[-1].position if changes else since
+        self["more"] = limit is not None and len(changes) >= limit
+
+
+def changed_entities(changes):
+    """ Read the entities changed, return their data by entity and id
+
+    Entities not found are looked for in the archive.
+    """
+
+    entity_ids = defaultdict(set)
+    for change in changes:
+        if change.operation != ChangeLog.DELETE:
+            entity_ids[change.entity].add(change.entity_id)
+    entities = {}
+    for entity, ids in entity_ids.items():
+        for model in (LOGGED_MODELS.get(entity),
+                      ARCHIVED_MODELS.get(entity)):
+            if model is None or not ids:
+                continue
+            key = inspect(model).primary_key[0]
+            for instance in db.session.scalars(
+                    db.select(model).where(key.in_(ids))):
+                entity_id = getattr(instance, key.key)
+                entities[(entity, entity_id)] = entity_data(instance)
+                ids.discard(entity_id)
+    return entities
+
+
+def entity_data(instance):
+    """ The columns of an entity as a dictionary for JSON """
+
+    data = {}
+    for attribute in inspect(instance).mapper.column_attrs:
+        value = getattr(instance, attribute.key)
+        if isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        data[attribute.key.replace("_", "-")] = value
+    return data
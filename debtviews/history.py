@@ -29,7 +29,7 @@ from clientviews.forms import ClientSearchForm
 from clientmodels.clients import (Clients, NoClientFoundError,
                                   NoPostalAddressError)
 from debtors import config
-from debtmodels.debtbilling import Bills
+from debtmodels.debtbilling import Bills, ArchivedBills
 from debtmodels.overdue import OverdueSteps
 
 
@@ -125,6 +125,7 @@ class History(dict):
         bill_payments = []
         bill_payments.extend(self.client.payments)
         bill_payments.extend(self.client.bills)
+        bill_payments.extend(ArchivedBills.bills_for_client(self.client))
         bill_payments = sorted(bill_payments, key=_get_bill_date, reverse=True)
         for bill_or_payment in bill_payments:
             if hasattr(bill_or_payment, "bill_id"):
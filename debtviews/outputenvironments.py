@@ -21,19 +21,116 @@ Originally built for bill production, it was also useful for overdue
 processing and split off to its own module.
 """
 
-from jinja2 import Environment, PackageLoader
+import os
+from functools import lru_cache
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+TEMPLATE_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'debtors', 'templates')
 
 rtfenvironment = Environment(
-    loader=PackageLoader('debtors', 'templates'),
+    loader=FileSystemLoader(TEMPLATE_DIRECTORY),
     block_start_string='<%', block_end_string='%>',
     variable_start_string='<<', variable_end_string='>>',
     trim_blocks=True, lstrip_blocks=True,
     autoescape=False)
 
 htmlenvironment = Environment(
-    loader=PackageLoader('debtors', 'templates'),
+    loader=FileSystemLoader(TEMPLATE_DIRECTORY),
     autoescape=True)
 
+
+def is_correspondence(template_name):
+    """ Is the template one of the mails filled by htmlenvironment? """
+
+    return (template_name.startswith("mail")
+            or template_name == "printbase.html")
+
+
+def configure_environments(app):
+    """ Set up template caching for the environments of the app
+
+    The compiled templates are kept in JINJA_CACHE_DIRECTORY from the
+    configuration (by default a directory for the user in the temporary
+    directory), so a new process loads them instead of compiling them.
+    Templates are only checked for changes if TEMPLATES_AUTO_RELOAD is
+    set, or if it is not set and the app runs in debug mode; this is the
+    setting Flask uses for the web templates.
+    """
+
+    directory = app.config.get("JINJA_CACHE_DIRECTORY")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    bytecode_cache = FileSystemBytecodeCache(directory or None)
+    auto_reload = app.config.get("TEMPLATES_AUTO_RELOAD")
+    if auto_reload is None:
+        auto_reload = app.debug
+    for environment in (rtfenvironment, htmlenvironment):
+        environment.bytecode_cache = bytecode_cache
+        environment.auto_reload = auto_reload
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=bytecode_cache)
+
+
+def warm_up_templates(app=None):
+    """ Load all correspondence templates, and web templates if app passed
+
+    Loading compiles the template, or reads it from the bytecode cache.
+    A process that warms up renders its first letter as fast as the
+    next ones. Returns the number of templates loaded.
+    """
+
+    environments = [(rtfenvironment, lambda name: name.endswith(".rtf")),
+                    (htmlenvironment, is_correspondence)]
+    if app is not None:
+        environments.append((app.jinja_env, lambda name:
+                             name.endswith(".html")
+                             and not is_correspondence(name)))
+    loaded = 0
+    for environment, wanted in environments:
+        for template_name in environment.list_templates(
+                filter_func=wanted):
+            environment.get_template(template_name)
+            loaded += 1
+    return loaded
+
+
+RTF_CACHE_SIZE = 4096
+RTF_CACHED_LENGTH = 64
+
+
+class RTFEscapes(dict):
+    """ The translate table for rtf, from code point to its rtf form
+
+    ASCII letters stay as they are, the others become \\u<code point>?.
+    The Latin letters are in the table from the start, other letters are
+    added when they are first met.
+    """
+
+    def __missing__(self, code_point):
+
+        escape = "\\u" + str(code_point) + '?'
+        self[code_point] = escape
+        return escape
+
+
+rtf_escapes = RTFEscapes({code_point: chr(code_point)
+                          for code_point in range(128)})
+rtf_escapes.update({code_point: "\\u" + str(code_point) + '?'
+                    for code_point in range(128, 0x250)})
+
+
+@lru_cache(maxsize=RTF_CACHE_SIZE)
+def rtf_cached(to_encode):
+    """ rtf for short values that are used over and over again
+
+    Names of currencies, dates and the like come back in every letter.
+    """
+
+    return to_encode.translate(rtf_escapes)
+
+
 def rtf(to_encode):
     """ This routine transcripts Unicode strings to be usable in
     rtf (rich text format) files.
@@ -43,14 +140,8 @@ def rtf(to_encode):
     you have to insert a replacement character. The replacement character is simply the question mark for debtors.
     """
 
-    result = ""
-    if not to_encode:
+    if not to_encode or to_encode.isascii():
         return to_encode
-    for letter in to_encode:
-        i = ord(letter)
-        if i < 128:
-            result = result + letter
-        else:
-            result = result + "\\u" + str(i) + '?'
-    return result
-
+    if len(to_encode) <= RTF_CACHED_LENGTH:
+        return rtf_cached(to_encode)
+    return to_encode.translate(rtf_escapes)
@@ -0,0 +1,366 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module holds the sinks the documents are written to.
+
+Bills, letters, mails, accounting and reports are written under a name,
+e.g. "bill12" or "fl12", to the output sink. Which sink is used is set
+in the configuration:
+
+    :OUTPUT_SINK: "directory" (the default), "zip", "tar" or "jsonl"
+    :OUTPUT_DIRECTORY: The directory written to, default "output"
+    :OUTPUT_FAN_OUT: For the directory sink, the number of levels of
+        sub-directories, named after the hash of the document name; the
+        default 0 writes all documents in the directory itself
+
+The zip, tar and jsonl sinks write all documents of a run to one file in
+the directory, named after the start of the run. A production run opens
+its own sink with run_output, which is closed at the end of the run; it
+is only used by the run (the context it runs in), not by requests
+handled at the same time in other threads. Documents written outside of
+a run, e.g. by a request, go to the sink of the process, of the same
+kind. It is shared by the threads of the process and closed when the
+process exits; an archive of a process that is killed is unreadable.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import tarfile
+import zipfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from hashlib import sha1
+from tempfile import SpooledTemporaryFile
+from threading import Lock, get_ident
+from time import time
+from debtors import config
+
+
+SPOOL_SIZE = 1024 * 1024
+SPOOL_BLOCK_SIZE = 64 * 1024
+
+
+class UnknownOutputSinkError(ValueError):
+    """ The sink in the configuration does not exist """
+
+    pass
+
+
+def spool(chunks):
+    """ Return a temporary file with the pieces of text, at its start
+
+    The file is kept in memory up to SPOOL_SIZE bytes. If getting the
+    pieces fails, the file is closed and the error raised.
+    """
+
+    data = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        for chunk in chunks:
+            data.write(chunk.encode())
+    except BaseException:
+        data.close()
+        raise
+    data.seek(0)
+    return data
+
+
+class OutputSink(ABC):
+    """ Abstract ancestor of the sinks for documents
+
+    A sink is a context manager, it is closed at the end of the with
+    statement.
+    """
+
+    @abstractmethod
+    def write(self, name, text):
+        """ Write the text of a document under name """
+
+        pass
+
+    def write_stream(self, name, chunks):
+        """ Write the text of a document, given as pieces, under name
+
+        Sinks that can write the pieces as they come override this, so
+        the document need not be in memory as a whole. If getting the
+        pieces fails, e.g. rendering a template, nothing is written.
+        """
+
+        self.write(name, "".join(chunks))
+
+    def close(self):
+        """ Finish writing to the sink """
+
+        pass
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+class DirectorySink(OutputSink):
+    """ Writes each document to its own file in a directory
+
+    With a fan out, the files are spread over sub-directories named after
+    the first bytes of the hash of the name, e.g. output/3f/a2/bill12 for
+    a fan out of 2, so no directory holds too many files.
+    """
+
+    def __init__(self, directory="output", fan_out=0):
+
+        self.directory = directory
+        self.fan_out = fan_out
+
+    def path(self, name):
+        """ The path of the file for name """
+
+        digest = sha1(name.encode()).hexdigest()
+        levels = [digest[2 * level:2 * level + 2]
+                  for level in range(self.fan_out)]
+        return os.path.join(self.directory, *levels, name)
+
+    def write(self, name, text):
+        """ Write the text to the file for name """
+
+        self.write_stream(name, (text,))
+
+    def write_stream(self, name, chunks):
+        """ Write the pieces of text to the file for name
+
+        The pieces go to a temporary file first, which gets the name when
+        all is written.
+        """
+
+        path = self.path(name)
+        if self.fan_out:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}-{get_ident()}.part"
+        try:
+            with open(partial, 'w') as f:
+                f.writelines(chunks)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, path)
+
+
+class RunFileSink(OutputSink):
+    """ Abstract ancestor of the sinks writing a run to one file
+
+    The file is named after the moment the sink is opened and the
+    process id, so runs in parallel do not write to the same file. The
+    documents are written one at a time, also from more threads.
+    """
+
+    EXTENSION = None
+
+    def __init__(self, directory="output", run_name=None):
+
+        os.makedirs(directory, exist_ok=True)
+        run_name = run_name or (datetime.now().strftime("run%Y%m%d-%H%M%S")
+                                + "-" + str(os.getpid()))
+        self.path = os.path.join(directory, run_name + self.EXTENSION)
+        self.lock = Lock()
+
+
+class ZipSink(RunFileSink):
+    """ Writes the documents of a run to a zip archive """
+
+    EXTENSION = ".zip"
+
+    def __init__(self, directory="output", run_name=None):
+
+        super().__init__(directory, run_name)
+        self.archive = zipfile.ZipFile(self.path, 'a',
+                                       compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, name, text):
+        """ Add the text as a member name to the archive """
+
+        with self.lock:
+            self.archive.writestr(name, text)
+
+    def write_stream(self, name, chunks):
+        """ Add the pieces of text as a member name to the archive
+
+        A member cannot be taken out again, so the text is collected
+        first, on disk if it is large.
+        """
+
+        with spool(chunks) as data, self.lock,\
+                self.archive.open(name, 'w', force_zip64=True) as member:
+            shutil.copyfileobj(data, member)
+
+    def close(self):
+        """ Write the directory of the archive and close it """
+
+        with self.lock:
+            self.archive.close()
+
+
+class TarSink(RunFileSink):
+    """ Writes the documents of a run to a tar archive """
+
+    EXTENSION = ".tar"
+
+    def __init__(self, directory="output", run_name=None):
+
+        super().__init__(directory, run_name)
+        self.archive = tarfile.open(self.path, 'a')
+
+    def write(self, name, text):
+        """ Add the text as a member name to the archive """
+
+        self.write_stream(name, (text,))
+
+    def write_stream(self, name, chunks):
+        """ Add the pieces of text as a member name to the archive
+
+        A tar member starts with its size, so the text is collected
+        first, on disk if it is large.
+        """
+
+        with spool(chunks) as data:
+            member = tarfile.TarInfo(name)
+            member.size = data.seek(0, os.SEEK_END)
+            member.mtime = time()
+            data.seek(0)
+            with self.lock:
+                self.archive.addfile(member, data)
+
+    def close(self):
+        """ Close the archive """
+
+        with self.lock:
+            self.archive.close()
+
+
+class JSONLinesSink(RunFileSink):
+    """ Writes the documents of a run as lines of JSON to one file
+
+    Each line holds the name and the text of a document.
+    """
+
+    EXTENSION = ".jsonl"
+
+    def __init__(self, directory="output", run_name=None):
+
+        super().__init__(directory, run_name)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def write(self, name, text):
+        """ Append a line with the document """
+
+        line = json.dumps({"name": name, "text": text}) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def write_stream(self, name, chunks):
+        """ Append a line with the document, a piece at a time
+
+        The pieces are escaped for JSON one by one and collected first,
+        so no partial line is written.
+        """
+
+        with spool(json.dumps(chunk)[1:-1] for chunk in chunks) as data,\
+                self.lock:
+            self.file.write('{"name": ' + json.dumps(name) + ', "text": "')
+            # The escaped text is ASCII, a block is not split in a letter
+            for block in iter(lambda: data.read(SPOOL_BLOCK_SIZE), b""):
+                self.file.write(block.decode())
+            self.file.write('"}\n')
+
+    def close(self):
+        """ Close the file """
+
+        with self.lock:
+            self.file.close()
+
+
+SINKS = {"directory": DirectorySink, "zip": ZipSink, "tar": TarSink,
+         "jsonl": JSONLinesSink}
+
+process_sink = None
+process_sink_lock = Lock()
+run_sink = ContextVar("run_sink", default=None)
+
+
+def create_sink(run_name=None):
+    """ Create the sink set in the configuration """
+
+    kind = config.get("OUTPUT_SINK") or "directory"
+    directory = config.get("OUTPUT_DIRECTORY") or "output"
+    try:
+        sink_class = SINKS[kind]
+    except KeyError:
+        raise UnknownOutputSinkError(f"Output sink {kind} does not exist")
+    if sink_class is DirectorySink:
+        return DirectorySink(directory, config.get("OUTPUT_FAN_OUT") or 0)
+    return sink_class(directory, run_name)
+
+
+def output_sink():
+    """ Return the sink documents are written to now
+
+    Within run_output this is the sink of the run. Outside of a run it is
+    the sink of the process, of the kind the configuration sets, created
+    on first use.
+    """
+
+    sink = run_sink.get()
+    if sink is not None:
+        return sink
+    global process_sink
+    with process_sink_lock:
+        if process_sink is None:
+            process_sink = create_sink()
+        return process_sink
+
+
+@atexit.register
+def close_process_sink():
+    """ Close the sink of the process; the next one is created anew """
+
+    global process_sink
+    with process_sink_lock:
+        if process_sink is not None:
+            process_sink.close()
+            process_sink = None
+
+
+@contextmanager
+def run_output(run_name=None):
+    """ Write the documents of a run to a sink of its own
+
+    Within the with statement, output_sink returns the sink of the run
+    in this context (thread); it is closed at the end.
+    """
+
+    with create_sink(run_name) as sink:
+        token = run_sink.set(sink)
+        try:
+            yield sink
+        finally:
+            run_sink.reset(token)
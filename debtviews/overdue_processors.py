@@ -46,13 +46,14 @@ class FirstLetterProcessor(OverdueProcessor):
 
         self.first_letter = PaperLetter(template_name="firstletter.rtf",
                                         bill=bill)
-        with open("output/fl" + str(bill.bill_id), "wt") as letter_file:
-            letter_file.write(self.first_letter.text)
+        self.first_letter.write_file("fl" + str(bill.bill_id))
 
         if bill.client.debtor_prefs\
             and bill.client.debtor_prefs[0].letter_medium == "mail":
             self.first_mail = HTMLMailFirstOverdue(bill.bill_id)
             self.first_mail.write_file()
+            if config.get("MAIL_DELIVERY"):
+                self.first_mail.queue_delivery()
 
 
 class SecondLetterProcessor(OverdueProcessor):
@@ -66,13 +67,14 @@ class SecondLetterProcessor(OverdueProcessor):
 
         self.second_letter = PaperLetter(template_name="secondletter.rtf",
                                          bill=bill)
-        with open("output/sl" + str(bill.bill_id), "wt") as letter_file:
-            letter_file.write(self.second_letter.text)
+        self.second_letter.write_file("sl" + str(bill.bill_id))
 
         if bill.client.debtor_prefs\
             and bill.client.debtor_prefs[0].letter_medium == "mail":
             self.second_mail = HTMLMailSecondOverdue(bill.bill_id)
             self.second_mail.write_file()
+            if config.get("MAIL_DELIVERY"):
+                self.second_mail.queue_delivery()
 
 
 class DebtTransferProcessor(OverdueProcessor):
@@ -86,13 +88,14 @@ class DebtTransferProcessor(OverdueProcessor):
 
         self.transfer_letter = PaperLetter(template_name="transferletter.rtf",
                                            bill=bill)
-        with open("output/dtm" + str(bill.bill_id), "wt") as letter_file:
-            letter_file.write(self.transfer_letter.text)
+        self.transfer_letter.write_file("dtm" + str(bill.bill_id))
 
         if bill.client.debtor_prefs\
             and bill.client.debtor_prefs[0].letter_medium == "mail":
             self.transfer_mail = HTMLMailDebtTransfer(bill.bill_id)
             self.transfer_mail.write_file()
+            if config.get("MAIL_DELIVERY"):
+                self.transfer_mail.queue_delivery()
 
         self.transfer_message = JSONDebtTransfer(bill_id=bill.bill_id)
         self.transfer_message.write_file()
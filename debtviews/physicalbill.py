@@ -26,14 +26,21 @@ into printable data.
 from datetime import date
 from email.message import EmailMessage
 from json import dumps
+from time import perf_counter
 from iso4217 import raw_table as currencytable
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
 from debtviews.monetary import edited_amount
-from debtors import config
+from debtors import config, db
+from clientmodels.clients import Clients
 from debtmodels.debtbilling import Bills, DebtorPreferences
 from debtmodels.accounting import AccountingTemplate
+from debtmodels.delivery import MailDelivery
 from debtviews.outputenvironments import (rtfenvironment, htmlenvironment,
                                           rtf)
 from debtviews.physicalentities import GeneralCorrespondence
+from debtviews.rendering import rendering_pool, render_documents
+from debtviews.outputsinks import output_sink, run_output
 
 
 class BillDictView(dict, GeneralCorrespondence):
@@ -46,9 +53,9 @@ class BillDictView(dict, GeneralCorrespondence):
     conversions to string in this class.
     """
 
-    def __init__(self, bill_id=None):
+    def __init__(self, bill_id=None, bill=None):
 
-        self.bill = Bills.get_bill_by_id(bill_id)
+        self.bill = bill if bill is not None else Bills.get_bill_by_id(bill_id)
         self.client = self.bill.client
         self["bill"] = self._create_bill_dict(self.bill)
         self["client"] = self._create_client_dict(self.client)
@@ -64,32 +71,48 @@ class PaperBill(object):
     is produced from the Bills model.
     """
 
-    def __init__(self, bill_id):
+    FILE_NAME = "bill{}"
+
+    def __init__(self, bill_id, bill=None, view=None):
 
         self.bill_id = bill_id
-        bill_dict = BillDictView(bill_id)
-        bill_template = rtfenvironment.get_template("paperbill.rtf")
-        self.text = bill_template.render(bill_dict)
+        self.view = view if view is not None else BillDictView(bill_id, bill)
+        self.template = rtfenvironment.get_template("paperbill.rtf")
+
+    @property
+    def text(self):
+        """ The text of the bill """
+
+        return self.template.render(self.view)
+
+    def contents(self):
+        """ The text written for the bill """
+
+        return self.text
 
     def write_file(self):
-        """ Writes the text of the bill to a file """
+        """ Writes the text of the bill to the output sink
 
-        with open("output/bill" + str(self.bill_id), 'w') as f:
-            f.write(self.text)
+        The text is written as it is rendered, it is not kept in memory.
+        """
+
+        output_sink().write_stream(self.FILE_NAME.format(self.bill_id),
+                                   self.template.generate(self.view))
 
 
 class HTMLMailBill(object):
     """ This class creates a HTML mail bill.
 
-    The bill can be stored as text on the file system and be sent
-    immediately to an SMTP server to be sent to the client.
-    TODO Create the link to the SMTP server
+    The bill can be stored as text in the output sink and be queued for
+    delivery to the client, see debtors.maildelivery.
     """
 
-    def __init__(self, bill_id):
+    FILE_NAME = "mail{}"
+
+    def __init__(self, bill_id, bill=None, view=None):
 
         self.bill_id = bill_id
-        bill_dict = BillDictView(bill_id)
+        bill_dict = view if view is not None else BillDictView(bill_id, bill)
         bill_template = htmlenvironment.get_template('mailbill.txt')
         self.text = bill_template.render(bill_dict)
         html_template = htmlenvironment.get_template('mailbill.html')
@@ -106,11 +129,22 @@ class HTMLMailBill(object):
         self.html_message.set_content(self.text)
         self.multipart_message.add_alternative(self.text)
 
+    def contents(self):
+        """ The mail message as text """
+
+        return self.multipart_message.as_string()
+
     def write_file(self):
-        """ Writes the text of the bill to a file """
+        """ Writes the text of the bill to the output sink """
+
+        output_sink().write(self.FILE_NAME.format(self.bill_id),
+                            self.contents())
+
+    def queue_delivery(self):
+        """ Queue the mail message for delivery to the client """
 
-        with open("output/mail" + str(self.bill_id), 'w') as f:
-            f.write(self.multipart_message.as_string())
+        return MailDelivery.queue(self.FILE_NAME.format(self.bill_id),
+                                  self.contents(), self.bill_id)
 
 
 class BillAccounting(AccountingTemplate):
@@ -154,10 +188,9 @@ class BillAccounting(AccountingTemplate):
         return dumps(self)
 
     def write_file(self):
-        """ Write the json for the accounting to a file """
+        """ Write the json for the accounting to the output sink """
 
-        with open("output/" + str(self["journal"]["extkey"]), 'w') as f:
-            f.write(self.as_json())
+        output_sink().write(str(self["journal"]["extkey"]), self.as_json())
 
 
 class BillReplaceAccounting(BillAccounting):
@@ -189,21 +222,213 @@ def create_physical_bill(bill_id, print_it=False, print_acc=False):
     At the end update the bill
     """
 
-    bill = Bills.get_bill_by_id(bill_id)
-    if bill and bill.client.debtor_prefs and\
-        bill.client.debtor_prefs[0].bill_medium ==\
-            DebtorPreferences.PREF_MAIL:
-        physical_bill = HTMLMailBill(bill_id)
-    else:
-        physical_bill = PaperBill(bill_id)
+    produce_bill(Bills.get_bill_by_id(bill_id), print_it, print_acc)
+
+
+def produce_bill(bill, print_it=False, print_acc=False):
+    """ Perform physical billing for a bill that has been read """
+
+    physical_bill = bill_document_class(bill)(bill.bill_id, bill)
+    if config.get("MAIL_DELIVERY") and isinstance(physical_bill, HTMLMailBill):
+        physical_bill.queue_delivery()
+    accountings = account_for_bill(bill)
     if print_it:
         physical_bill.write_file()
-    accounting = BillAccounting(bill)
     if print_acc:
-        accounting.write_file()
+        for accounting in accountings:
+            accounting.write_file()
+
+
+def bill_document_class(bill):
+    """ The class of the document to produce for the bill """
+
+    if bill.client.debtor_prefs and\
+        bill.client.debtor_prefs[0].bill_medium ==\
+            DebtorPreferences.PREF_MAIL:
+        return HTMLMailBill
+    return PaperBill
+
+
+def bill_document(bill):
+    """ The document to render for a bill, see debtviews.rendering """
+
+    document_class = bill_document_class(bill)
+    return (document_class.FILE_NAME.format(bill.bill_id), document_class,
+            (bill.bill_id,), dict(BillDictView(bill=bill)))
+
+
+def account_for_bill(bill):
+    """ Do the accounting for a bill produced and update the bill
+
+    The bill is flushed and the accountings are returned, to be written
+    after the document of the bill: a bill that cannot be stored fails
+    before anything is written, and a bill document that cannot be
+    written leaves no accounting behind. The replaced bill is read by its
+    key, so a production run that has read the replaced bills already
+    does not read them again.
+    """
+
+    accountings = [BillAccounting(bill)]
     if bill.prev_bill:
-        reversal_accounting =\
-            BillReplaceAccounting(Bills.get_bill_by_id(bill.prev_bill))
-        if print_acc:
-            reversal_accounting.write_file()
+        accountings.append(
+            BillReplaceAccounting(db.session.get(Bills, bill.prev_bill)))
     bill.update_for_bill_production()
+    db.session.flush()
+    return accountings
+
+
+class BillRunReport(dict):
+    """ The result of a bill production run
+
+        :chunks: The number of chunks produced
+        :produced: The number of bills produced
+        :failed: The ids of the bills that could not be produced
+        :elapsed: The seconds spent producing
+
+    """
+
+    def __init__(self):
+
+        super().__init__(chunks=0, produced=0, failed=[], elapsed=0.0)
+
+    def throughput(self):
+        """ The number of bills produced per second """
+
+        if not self["elapsed"]:
+            return 0.0
+        return self["produced"] / self["elapsed"]
+
+    def __str__(self):
+
+        return (f"{self['produced']} bills in {self['chunks']} chunks, "
+                f"{len(self['failed'])} failed, "
+                f"{self.throughput():.1f} bills/second")
+
+
+class BillProductionRun(object):
+    """ Produces all new bills, a chunk at a time
+
+    The bills of a chunk are read with one query, together with
+    everything the templates need: the lines, the client with its
+    addresses, mail addresses and preferences, and the bills they
+    replace. The views of the bills are made here and rendered by
+    debtviews.rendering, in a pool of worker processes if there is more
+    than one worker. The rendered bills come back in order; each is
+    written to the output sink of the run and accounted for in a
+    savepoint. A bill that fails is reported and stays new, the rest of
+    the chunk is produced. Each chunk is committed.
+
+        :chunk_size: The number of bills in a chunk, by default
+            BILL_RUN_CHUNK_SIZE from the configuration, else 500
+        :client_ids: If passed, only the bills of these clients
+        :sold_until: If passed, only the bills sold on or before this date
+        :print_it: Write the bills to files
+        :print_acc: Write the accounting to files
+        :workers: The number of processes rendering, by default
+            RENDER_WORKERS from the configuration, else 1
+        :report: The BillRunReport for this run
+
+    """
+
+    def __init__(self, chunk_size=None, client_ids=None, sold_until=None,
+                 print_it=True, print_acc=True, workers=None):
+
+        self.chunk_size = (chunk_size or config.get("BILL_RUN_CHUNK_SIZE")
+                           or 500)
+        self.client_ids = client_ids
+        self.sold_until = sold_until
+        self.print_it = print_it
+        self.print_acc = print_acc
+        self.workers = workers
+        self.report = BillRunReport()
+
+    def new_bills(self, after_id=None):
+        """ Return the ids of the next chunk of new bills """
+
+        bills = select(Bills.bill_id).where(Bills.status == Bills.NEW)
+        if self.client_ids:
+            bills = bills.where(Bills.client_id.in_(self.client_ids))
+        if self.sold_until:
+            bills = bills.where(Bills.date_sale <= self.sold_until)
+        if after_id is not None:
+            bills = bills.where(Bills.bill_id > after_id)
+        bills = bills.order_by(Bills.bill_id).limit(self.chunk_size)
+        return db.session.scalars(bills).all()
+
+    @staticmethod
+    def load_chunk(bill_ids):
+        """ Read the bills with all that is needed to produce them """
+
+        client = joinedload(Bills.client)
+        bills = db.session.scalars(
+            select(Bills).where(Bills.bill_id.in_(bill_ids)).
+            options(selectinload(Bills.lines),
+                    client.selectinload(Clients.addrs),
+                    client.selectinload(Clients.emails),
+                    client.selectinload(Clients.debtor_prefs)).
+            order_by(Bills.bill_id)).all()
+        replaced = {bill.prev_bill for bill in bills if bill.prev_bill}
+        if replaced:
+            db.session.scalars(
+                select(Bills).where(Bills.bill_id.in_(replaced))).all()
+        return bills
+
+    def produce_chunk(self, bill_ids, pool=None):
+        """ Produce the bills of a chunk and commit them """
+
+        start = perf_counter()
+        bills = []
+        documents = []
+        for bill in self.load_chunk(bill_ids):
+            try:
+                documents.append(bill_document(bill))
+            except Exception:
+                self.report["failed"].append(bill.bill_id)
+                continue
+            bills.append(bill)
+        rendered = render_documents(documents, pool)
+        deliver_mail = config.get("MAIL_DELIVERY")
+        for bill, document, (file_name, text, error) in zip(bills, documents,
+                                                            rendered):
+            if error is not None:
+                self.report["failed"].append(bill.bill_id)
+                continue
+            # The bill is stored before its document is written and the
+            # accounting after it, a bill that fails leaves no accounting
+            # behind to be written again
+            try:
+                with db.session.begin_nested():
+                    if deliver_mail and document[1] is HTMLMailBill:
+                        MailDelivery.queue(file_name, text, bill.bill_id)
+                    accountings = account_for_bill(bill)
+                    if self.print_it:
+                        output_sink().write(file_name, text)
+                    if self.print_acc:
+                        for accounting in accountings:
+                            accounting.write_file()
+            except Exception:
+                self.report["failed"].append(bill.bill_id)
+                continue
+            self.report["produced"] += 1
+        db.session.commit()
+        self.report["chunks"] += 1
+        self.report["elapsed"] += perf_counter() - start
+
+    def run(self, progress=None):
+        """ Produce the new bills, chunk by chunk
+
+        If passed, progress is called with the report after each chunk.
+        """
+
+        db.session.flush()
+        after_id = None
+        with run_output(), rendering_pool(self.workers) as pool:
+            while True:
+                bill_ids = self.new_bills(after_id)
+                if not bill_ids:
+                    break
+                after_id = bill_ids[-1]
+                self.produce_chunk(bill_ids, pool)
+                if progress:
+                    progress(self.report)
+        return self.report
@@ -30,9 +30,11 @@ from debtors import config
 from debtviews.monetary import edited_amount
 from debtmodels.debtbilling import Bills
 from debtmodels.overdue import OverdueProcessor
+from debtmodels.delivery import MailDelivery
 from debtviews.outputenvironments import (rtfenvironment, htmlenvironment,
                                           rtf)
 from debtviews.physicalentities import GeneralCorrespondence
+from debtviews.outputsinks import output_sink
 
 
 class OverdueDictView(dict, GeneralCorrespondence):
@@ -129,11 +131,30 @@ def add_transfer_date(bill_dict, date_bill):
 class PaperLetter():
     """ This models a paper interface, created from a rtf template """
 
-    def __init__(self, template_name=None, bill=None):
+    def __init__(self, template_name=None, bill=None, view=None):
 
         self.template = rtfenvironment.get_template(template_name)
-        bill_dict = OverdueDictView(bill.bill_id)
-        self.text = self.template.render(bill_dict)
+        self.view = view if view is not None else OverdueDictView(bill.bill_id)
+
+    @property
+    def text(self):
+        """ The text of the letter """
+
+        return self.template.render(self.view)
+
+    def contents(self):
+        """ The text of the letter """
+
+        return self.text
+
+    def write_file(self, name):
+        """ Writes the letter to the output sink under name
+
+        The text is written as it is rendered, so a letter listing many
+        bills is not kept in memory as a whole.
+        """
+
+        output_sink().write_stream(name, self.template.generate(self.view))
 
 
 class HTMLMailTemplate(object):
@@ -143,10 +164,10 @@ class HTMLMailTemplate(object):
     (multipart_message)
     """
 
-    def __init__(self, bill_id, mail_source_stem):
+    def __init__(self, bill_id, mail_source_stem, view=None):
 
         self.bill_id = bill_id
-        overdue_dict = OverdueDictView(bill_id)
+        overdue_dict = view if view is not None else OverdueDictView(bill_id)
         text_mail_template =\
             htmlenvironment.get_template(mail_source_stem + '.txt')
         self.text = text_mail_template.render(overdue_dict)
@@ -165,62 +186,64 @@ class HTMLMailTemplate(object):
         self.html_message.set_content(self.text)
         self.multipart_message.add_alternative(self.text)
 
+    def contents(self):
+        """ The mail message as text """
+
+        return self.multipart_message.as_string()
+
+    def write_file(self):
+        """ Writes the mail message to the output sink """
+
+        output_sink().write(self.FILE_NAME.format(self.bill_id),
+                            self.contents())
+
+    def queue_delivery(self):
+        """ Queue the mail message for delivery to the client """
+
+        return MailDelivery.queue(self.FILE_NAME.format(self.bill_id),
+                                  self.contents(), self.bill_id)
+
 
 class HTMLMailFirstOverdue(HTMLMailTemplate):
     """ This class creates a HTML mail for bills overdue.
 
-    The overdue mail can be stored as text on the file system and be sent
-    immediately to an SMTP server to be sent to the client.
-    TODO Create the link to the SMTP server
+    The overdue mail can be stored as text in the output sink and be
+    queued for delivery to the client, see debtors.maildelivery.
     """
 
-    def __init__(self, bill_id):
-
-        super().__init__(bill_id, "mailfom")
+    FILE_NAME = "mailfom{}"
 
-    def write_file(self):
-        """ Writes the text of the bill to a file """
+    def __init__(self, bill_id, view=None):
 
-        with open("output/mailfom" + str(self.bill_id), 'w') as f:
-            f.write(self.multipart_message.as_string())
+        super().__init__(bill_id, "mailfom", view)
 
 
 class HTMLMailSecondOverdue(HTMLMailTemplate):
     """ This class creates a HTML mail for bills overdue.
 
-    The overdue mail can be stored as text on the file system and be sent
-    immediately to an SMTP server to be sent to the client.
-    TODO Create the link to the SMTP server
+    The overdue mail can be stored as text in the output sink and be
+    queued for delivery to the client, see debtors.maildelivery.
     """
 
-    def __init__(self, bill_id):
-
-        super().__init__(bill_id, "mailsom")
+    FILE_NAME = "mailsom{}"
 
-    def write_file(self):
-        """ Writes the text of the bill to a file """
+    def __init__(self, bill_id, view=None):
 
-        with open("output/mailsom" + str(self.bill_id), 'w') as f:
-            f.write(self.multipart_message.as_string())
+        super().__init__(bill_id, "mailsom", view)
 
 
 class HTMLMailDebtTransfer(HTMLMailTemplate):
     """ This class creates a HTML mail for bills overdue.
 
-    The overdue mail can be stored as text on the file system and be sent
-    immediately to an SMTP server to be sent to the client.
-    TODO Create the link to the SMTP server
+    The overdue mail can be stored as text in the output sink and be
+    queued for delivery to the client, see debtors.maildelivery.
     """
 
-    def __init__(self, bill_id):
-
-        super().__init__(bill_id, "maildtm")
+    FILE_NAME = "maildtm{}"
 
-    def write_file(self):
-        """ Writes the text of the bill to a file """
+    def __init__(self, bill_id, view=None):
 
-        with open("output/maildtm" + str(self.bill_id), 'w') as f:
-            f.write(self.multipart_message.as_string())
+        super().__init__(bill_id, "maildtm", view)
 
 
 class JSONDebtTransfer():
@@ -230,15 +253,21 @@ class JSONDebtTransfer():
     may want the message in another format, or with different data. YMMV
     """
 
-    def __init__(self, bill_id):
+    FILE_NAME = "trfmsg{}.json"
+
+    def __init__(self, bill_id, view=None):
 
         self.bill_id = bill_id
-        overdue_dict = OverdueDictView(bill_id)
+        overdue_dict = view if view is not None else OverdueDictView(bill_id)
         self.transfer_message = json.dumps(overdue_dict)
 
+    def contents(self):
+        """ The transfer message as text """
+
+        return self.transfer_message
+
     def write_file(self):
-        """ Writes the generated json to a file """
+        """ Writes the generated json to the output sink """
 
-        with open("output/trfmsg" + str(self.bill_id) + ".json",
-                  'w') as f:
-            f.write(self.transfer_message)
+        output_sink().write(self.FILE_NAME.format(self.bill_id),
+                            self.contents())
@@ -22,50 +22,71 @@ Each viewpoint will enable decision makers to check the debt position, but
 organized to different viewpoints, e.g. the debt by age.
 """
 
-from datetime import date, timedelta, datetime
+from datetime import date, datetime
 from flask import render_template, abort
 from flask.views import MethodView
-from debtors import config
+from debtors import db, config
 from debtmodels.debtbilling import Bills
-from debtmodels.overdue import OverdueActions
+from debtmodels.overdue import OverdueActions, OverdueSteps
+from debtmodels.positions import DebtPositions
 from debtviews.monetary import edited_amount
 from debtviews.outputenvironments import rtfenvironment
+from debtviews.outputsinks import output_sink
 
 
 class DebtByAge(object):
 
-    """ Debt ordered by age """
+    """ Debt ordered by age
+
+    The debt of all ages is read from the database in one go, the first
+    time one of the ages is asked for. The edges of the age buckets are
+    AGE_BUCKETS from the configuration, by default the ages below.
+
+    If as_of is passed and is before today, the debt is read from the
+    snapshot of the debt position of that day (see debtmodels.positions).
+    """
 
     AGE_RECENT_DEBT = 30
     AGE_OLDER_DEBT = 60
     AGE_WORRYING = 90
     AGE_TOO_OLD = 360
 
+    def __init__(self, as_of=None):
+
+        self.as_of = as_of
+        self.debt_by_age = None
+
+    def age_limits(self):
+        """ The edges of the age buckets """
+
+        return (config.get("AGE_BUCKETS")
+                or [self.AGE_RECENT_DEBT, self.AGE_OLDER_DEBT,
+                    self.AGE_WORRYING, self.AGE_TOO_OLD])
+
+    def debt_in_bucket(self, bucket):
+        """ Return the debt by currency for one of the age buckets """
+
+        if self.debt_by_age is None:
+            if self.as_of and self.as_of < date.today():
+                self.debt_by_age = DebtPositions.by_age(self.as_of)
+            else:
+                self.debt_by_age = Bills.debt_by_age(self.age_limits())
+        return self.debt_by_age.get(bucket, dict())
+
     def recent_debt(self):
         """ Return debt recently invoiced """
 
-        young_debt_period = (date.today()
-                             - timedelta(days=self.AGE_RECENT_DEBT))
-        return Bills.debt_for_period(young_debt_period, None)
+        return self.debt_in_bucket(0)
 
     def older_debt(self):
         """ Return debt not very long overdue """
 
-        young_debt_period = (date.today()
-                             - timedelta(days=self.AGE_RECENT_DEBT))
-        older_debt_period = (date.today()
-                             - timedelta(days=self.AGE_OLDER_DEBT))
-        return Bills.debt_for_period(older_debt_period, young_debt_period)
+        return self.debt_in_bucket(1)
 
     def worrying_debt(self):
         """ Return debt unpaid for a long period. """
 
-        older_debt_period = (date.today()
-                             - timedelta(days=self.AGE_OLDER_DEBT))
-        worrying_debt_period = (date.today()
-                                - timedelta(days=self.AGE_WORRYING))
-        return Bills.debt_for_period(worrying_debt_period,
-                                     older_debt_period)
+        return self.debt_in_bucket(2)
 
 
 class DebtAgeReport():
@@ -107,15 +128,14 @@ class DebtAgeReport():
         self.text = self.template.render(age_data=report_data)
 
     def write_file(self):
-        """ Output the age report to a file. """
+        """ Output the age report to the output sink. """
 
         if not (hasattr(self, "text") and self.text):
             self.write_report()
         age_report_name = ("Age-report" +
                            date.today().strftime(config["DATE_FORMAT"]) +
                            datetime.today().strftime("%H:%M"))
-        with open("output/" + age_report_name, "w") as report_file:
-            report_file.write(self.text)
+        output_sink().write(age_report_name, self.text)
 
 
 class DebtByStatus(object):
@@ -128,19 +148,21 @@ class DebtByStatus(object):
     For each status a small dictionary will be built for debt totals
     per currency, for it obviously is useless to have a position
     where part is Euro and part is Yen.
+
+    The totals for all statuses are read in one query, the first time
+    one of them is asked for.
     """
 
+    def __init__(self):
+
+        self.debt_by_step = None
+
     def _get_totals_by_currency(self, action):
         """ Return totals by currency for this action """
 
-        actions = OverdueActions.get_all_last_action(action)
-        totals_by_currency = dict()
-        for action in actions:
-            if action.bill.billing_ccy in totals_by_currency:
-                totals_by_currency[action.bill.billing_ccy] += action.bill.total()
-            else:
-                totals_by_currency[action.bill.billing_ccy] = action.bill.total()
-        return totals_by_currency
+        if self.debt_by_step is None:
+            self.debt_by_step = OverdueActions.debt_by_last_step()
+        return self.debt_by_step.get(action, dict())
 
     def transferred(self):
         """ Return the totals of debt in for status transfer """
@@ -157,47 +179,65 @@ class DebtByStatus(object):
 
         return self._get_totals_by_currency("firstletter")
 
+    def all_steps(self):
+        """ Return (step, totals by currency) for each overdue step
+
+        The steps are in the order they are taken.
+        """
+
+        steps = (db.session.query(OverdueSteps).
+                 order_by(OverdueSteps.number_of_days).all())
+        return [(step, self._get_totals_by_currency(step.processor))
+                for step in steps]
+
+
+def edited_totals(totals):
+    """ The totals by currency as a list for a report """
+
+    return [{"ccy": ccy, "amount": edited_amount(amount, currency=ccy)}
+            for ccy, amount in totals.items()]
+
+
 class DebtStatusReport():
     """ This object creates and renders the debt report by last action """
 
+    REPORTED_APART = {"firstletter": "first_letter",
+                      "secondletter": "second_letter",
+                      "transfer": "transferred"}
+
     def __init__(self):
 
         self.template = rtfenvironment.get_template("debtstatusreport.rtf")
 
     def write_report(self):
-        """ Create the data and write the report """
+        """ Create the data and write the report
+
+        The first letter, second letter and transfer have a section of
+        their own, the other steps follow in the order they are taken.
+        """
 
         debt_by_status = DebtByStatus()
         report_data = dict()
         report_data["date_report"] = date.today().strftime(config["DATE_FORMAT"])
         report_data["time_report"] = datetime.today().strftime("%H:%M")
-        debt_by_ccy = []
-        debt_first_letter = debt_by_status.first_letter()
-        for k, v in debt_first_letter.items():
-            ccy_debt = {"ccy": k, "amount": edited_amount(v, currency=k)}
-            debt_by_ccy.append(ccy_debt)
-        report_data["first_letter"] = debt_by_ccy
-        debt_by_ccy = []
-        debt_second_letter = debt_by_status.second_letter()
-        for k, v in debt_second_letter.items():
-            ccy_debt = {"ccy": k, "amount": edited_amount(v, currency=k)}
-            debt_by_ccy.append(ccy_debt)
-        report_data["second_letter"] = debt_by_ccy
-        debt_by_ccy = []
-        debt_transferred = debt_by_status.transferred()
-        for k, v in debt_transferred.items():
-            ccy_debt = {"ccy": k, "amount": edited_amount(v, currency=k)}
-            debt_by_ccy.append(ccy_debt)
-        report_data["transferred"] = debt_by_ccy
+        for key in self.REPORTED_APART.values():
+            report_data[key] = []
+        report_data["other_steps"] = []
+        for step, totals in debt_by_status.all_steps():
+            if step.processor in self.REPORTED_APART:
+                report_data[self.REPORTED_APART[step.processor]] =\
+                    edited_totals(totals)
+            elif totals:
+                report_data["other_steps"].append(
+                    {"name": step.step_name, "debt": edited_totals(totals)})
         self.text = self.template.render(status_data=report_data)
 
     def write_file(self):
-        """ Output the status report to a file. """
+        """ Output the status report to the output sink. """
 
         if not (hasattr(self, "text") and self.text):
             self.write_report()
         status_report_name = ("Status-report" +
                            date.today().strftime(config["DATE_FORMAT"]) +
                            datetime.today().strftime("%H:%M"))
-        with open("output/" + status_report_name, "w") as report_file:
-            report_file.write(self.text)
+        output_sink().write(status_report_name, self.text)
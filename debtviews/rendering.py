@@ -0,0 +1,98 @@
+#    Copyright 2020 Menno Hölscher
+#
+#    This file is part of debtors.
+
+#    debtors is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    debtors is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with debtors.  If not, see <http://www.gnu.org/licenses/>.
+
+""" This module renders documents in a pool of worker processes.
+
+Filling the templates and building the mail messages does not need the
+database. The view dictionaries (e.g. of BillDictView or OverdueDictView)
+are made in the process that has the session, as plain dictionaries, and
+sent to the workers with the document class to render them with. The
+rendered texts come back in the order the documents were passed in, so
+the process with the session writes them and updates the database.
+
+A document is a tuple of
+
+    :file_name: The name the text is to be written under in the output
+        sink
+    :document_class: A class that takes the view as keyword view and has
+        a method contents, e.g. PaperBill or HTMLMailFirstOverdue
+    :args: The positional arguments for the class, e.g. (bill_id,)
+    :view: The view dictionary, with only plain data in it
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from debtors import app, db, config
+from debtviews.outputenvironments import warm_up_templates
+
+RENDER_CHUNK_SIZE = 20
+
+
+def start_render_worker():
+    """ Prepare a worker process for rendering
+
+    The worker does not use the database. The connections it inherited
+    from the process that started it are left alone. The templates are
+    loaded before the first document comes in.
+    """
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+    warm_up_templates()
+
+
+def render_document(document):
+    """ Render one document, return the file name, text and error
+
+    If rendering fails, the text is None and the error holds the message,
+    so one failing document does not stop the others.
+    """
+
+    file_name, document_class, args, view = document
+    try:
+        return file_name, document_class(*args, view=view).contents(), None
+    except Exception as exc:
+        return file_name, None, f"{type(exc).__name__}: {exc}"
+
+
+def rendering_pool(workers=None):
+    """ Return the pool to render in, to be used in a with statement
+
+    The number of workers is taken from RENDER_WORKERS in the
+    configuration, else 1. With one worker no pool is started and the
+    documents are rendered in this process.
+    """
+
+    workers = workers or config.get("RENDER_WORKERS") or 1
+    if workers <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=workers,
+                               initializer=start_render_worker)
+
+
+def render_documents(documents, pool=None):
+    """ Render the documents, in the pool if passed
+
+    Returns an iterator of (file name, text, error) in the order of the
+    documents.
+    """
+
+    if pool is None:
+        return map(render_document, documents)
+    return pool.map(render_document, documents, chunksize=RENDER_CHUNK_SIZE)
+